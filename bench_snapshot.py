@@ -0,0 +1,101 @@
+"""
+Benchmark the section snapshot codecs on a synthetic user database.
+
+    python bench_snapshot.py [users]
+
+Compares file size, encode time and load time (decode + the conversion the
+loader needs) of the JSON and binary codecs, and of the lazily loaded users
+index (load = open + one lookup). Defaults to 100k users.
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+from datetime import datetime, timedelta
+
+# bot.py refuses to import without these - the benchmark never talks to Telegram
+os.environ.setdefault('BOT_TOKEN', 'benchmark')
+os.environ.setdefault('ADMIN_ID', '1')
+
+import bot
+
+
+def build_users(count: int) -> dict:
+    """Users spread over a few channels, like a long-running bot"""
+    channels = [-1001000000000 - i for i in range(8)]
+    start = datetime(2023, 1, 1)
+    users = {}
+    for user_id in range(100000000, 100000000 + count):
+        memberships = {}
+        for channel_id in random.sample(channels, random.randint(1, 3)):
+            requested = start + timedelta(minutes=random.randint(0, 900000))
+            approved = random.random() < 0.8
+            memberships[channel_id] = {
+                'channel_name': f"Channel {channel_id}",
+                'status': 'approved' if approved else 'pending',
+                'request_date': requested,
+                'approval_date': requested + timedelta(seconds=30) if approved else None
+            }
+        users[user_id] = {
+            'first_name': f"User{user_id % 9973}",
+            'last_name': '',
+            'username': f"user{user_id}" if user_id % 3 else '',
+            'channels': memberships
+        }
+    return users
+
+
+def timed(func, *args, repeat: int = 3):
+    """Best wall time of a few runs, plus the last result"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def json_load(payload: bytes) -> dict:
+    stored = json.loads(payload)
+    stored['data'] = bot._decode_json_state(stored['data'])
+    return stored
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    random.seed(42)
+    stored = {
+        'format': bot.SECTION_FORMAT, 'section': 'users', 'version': 1,
+        'journal_seq': 0, 'data': {'user_database': build_users(count)}
+    }
+
+    codecs = {
+        'json': (lambda obj: json.dumps(obj, default=str).encode('utf-8'), json_load),
+        'binary': (bot.encode_snapshot, bot.decode_snapshot)
+    }
+
+    print(f"users section with {count:,} users")
+    print(f"{'codec':<8}{'size':>12}{'encode':>12}{'load':>12}")
+    for name, (encode, decode) in codecs.items():
+        encode_time, payload = timed(encode, stored)
+        load_time, loaded = timed(decode, payload)
+        sample = loaded['data']['user_database'][100000000]
+        assert isinstance(next(iter(sample['channels'])), int)
+        assert isinstance(next(iter(sample['channels'].values()))['request_date'], datetime)
+        print(f"{name:<8}{len(payload) / 1e6:>10.1f}MB{encode_time * 1000:>10.0f}ms{load_time * 1000:>10.0f}ms")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'users.idx')
+        meta = {key: value for key, value in stored.items() if key != 'data'}
+        store = bot.UserStore(records=stored['data']['user_database'])
+        encode_time, _ = timed(store.write_index, path, meta)
+        load_time, user = timed(lambda: bot.UserStore(bot.UserIndexFile(path))[100000000])
+        assert isinstance(next(iter(user['channels'])), int)
+        print(f"{'index':<8}{os.path.getsize(path) / 1e6:>10.1f}MB{encode_time * 1000:>10.0f}ms{load_time * 1000:>10.0f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -5,14 +5,41 @@ import random
 import string
 import re
 import asyncio
+import bisect
+import gc
+import gzip
+import heapq
 import json
+import mmap
+import pickle
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
 from io import BytesIO
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ChatJoinRequestHandler, ContextTypes, filters
+from telegram.ext import Application, BaseRateLimiter, CommandHandler, MessageHandler, CallbackQueryHandler, ChatJoinRequestHandler, ContextTypes, filters
 from telegram.constants import ChatMemberStatus
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 
+try:
+    import httpx  # Installed with supabase - only needed for STORAGE_BACKEND=supabase
+except ImportError:
+    httpx = None
+
+try:
+    import numpy as np  # Optional - vectorizes score_names()
+except ImportError:
+    np = None
+
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 ADMIN_ID = int(os.environ.get('ADMIN_ID', '0'))
 
@@ -24,15 +51,20 @@ if ADMIN_ID == 0:
 
 MIN_ACCOUNT_AGE_DAYS = 15
 REQUIRE_PROFILE_PHOTO = False
-CODE_EXPIRY_MINUTES = 5
+CODE_EXPIRY_MINUTES = int(os.environ.get('CODE_EXPIRY_MINUTES', '5'))  # Pending verification lifetime
 
 VERIFIED_USERS = set([ADMIN_ID])
 MANAGED_CHANNELS = {}
 PENDING_POSTS = {}
-PENDING_VERIFICATIONS = {}
+PENDING_VERIFICATIONS = {}  # {user_id: {'chat_ids', 'code', 'captcha_question', 'timestamp', 'reason'}}
+DEFERRED_OPS = {}  # {op_id: {'op', 'args', 'attempts', 'due', 'error'}} - Bot API calls awaiting retry
+OUTBOX = {}  # {message_id: {'user_id', 'text', 'attempts', 'due'}} - DMs waiting for outbox_job()
+UNREACHABLE_USERS = {}  # {user_id: epoch} - users the bot couldn't message, see DM OUTBOX
 VERIFIED_FOR_CHANNELS = {}
 BLOCKED_USERS = set()
 BULK_APPROVAL_MODE = {}
+VERIFICATION_POLICIES = {}  # {channel_id: policy} - see VERIFICATION POLICY; others use the default
+CHANNEL_EXPIRY_ACTIONS = {}  # {channel_id: 'decline'/'approve'/'escalate'} - others use PENDING_EXPIRY_ACTION
 
 UPLOADED_IMAGES = []
 CHANNEL_SPECIFIC_IMAGES = {}
@@ -43,6 +75,7 @@ POSTING_INTERVAL_HOURS = 1
 # Promo image storage
 PROMO_IMAGES = {}  # {channel_id: {'promo1': {...}, 'promo2': {...}}}
 POST_COUNTER = {}  # {channel_id: count} - tracks total posts for promo pattern
+AUTO_POST_FAILURES = {}  # {channel_id: consecutive transient failures} - backoff exponent
 
 # NEW: Global fallback channel for rejected users
 GLOBAL_FALLBACK_CHANNEL = ""  # Set via /set_fallback command
@@ -74,13 +107,11 @@ CAPTION_EMOJIS = [
 
 USER_DATABASE = {}
 USER_ACTIVITY_LOG = []
-RECENT_ACTIVITY = []  # Store recent approvals/rejections for batch viewing
+# RECENT_ACTIVITY / UNAUTHORIZED_ATTEMPTS are bounded logs - see ACTIVITY LOGS
 
 DEFAULT_CAPTION = ""
 CHANNEL_DEFAULT_CAPTIONS = {}
 
-UNAUTHORIZED_ATTEMPTS = []
-
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -96,461 +127,3943 @@ if not os.path.exists(STORAGE_DIR):
         logger.warning("⚠️ Using current directory for storage")
         STORAGE_DIR = "."
 
-STORAGE_FILE = os.path.join(STORAGE_DIR, "bot_data.json")
+STORAGE_FILE = os.path.join(STORAGE_DIR, "bot_data.json")  # Legacy single-file snapshot
+JOURNAL_FILE = os.path.join(STORAGE_DIR, "bot_data.journal")
+STATE_DIR = os.path.join(STORAGE_DIR, "state")  # One file per state section
+SQLITE_FILE = os.path.join(STORAGE_DIR, "bot_data.sqlite3")
+
+# Storage backend: 'json' (snapshot + journal), 'sqlite' (normalized tables)
+# or 'supabase' (same tables over PostgREST)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'json').lower()
+STORAGE = None  # StorageBackend instance, created by load_data()
+
+# Supabase / PostgREST settings (STORAGE_BACKEND=supabase)
+SUPABASE_URL = os.environ.get('SUPABASE_URL', '')
+SUPABASE_KEY = os.environ.get('SUPABASE_KEY', '')
+SUPABASE_BATCH_SIZE = int(os.environ.get('SUPABASE_BATCH_SIZE', '500'))
+SUPABASE_POOL_SIZE = int(os.environ.get('SUPABASE_POOL_SIZE', '4'))
+SUPABASE_PAGE_SIZE = 1000
+SUPABASE_TIMEOUT_SECONDS = 15
+SUPABASE_RETRIES = 3
+
+# Journal compaction: fold the journal into the state files once it holds this many records
+JOURNAL_COMPACT_RECORDS = int(os.environ.get('JOURNAL_COMPACT_RECORDS', '2000'))
+JOURNAL_COMPACT_CHECK_MINUTES = 5
+
+JOURNAL_SEQ = 0  # Sequence number of the last journal record
+JOURNAL_RECORDS = 0  # Records written since the last compaction
+
+# Debounced flush: changes are coalesced in memory and written once per window
+PERSIST_FLUSH_SECONDS = float(os.environ.get('PERSIST_FLUSH_SECONDS', '2'))
+PENDING_CHANGES = {}  # {coalesce_key: record} - in insertion (= seq) order
+PERSIST_FLUSH_HANDLE = None  # asyncio TimerHandle of the scheduled flush
+PERSIST_HOLDS = 0  # Running batches holding flushes back until they finish
+
+# Single worker thread: journal appends and compactions never overlap
+PERSIST_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='persist')
+
+# Retention: users/activity past these ages move to compressed cold files in
+# ARCHIVE_DIR (0 disables a policy)
+ARCHIVE_DIR = os.path.join(STORAGE_DIR, "archive")
+ARCHIVE_PENDING_DAYS = int(os.environ.get('ARCHIVE_PENDING_DAYS', '30'))  # Never approved
+ARCHIVE_INACTIVE_DAYS = int(os.environ.get('ARCHIVE_INACTIVE_DAYS', '180'))  # No request/approval since
+ARCHIVE_ACTIVITY_DAYS = int(os.environ.get('ARCHIVE_ACTIVITY_DAYS', '7'))  # RECENT_ACTIVITY entries
+ARCHIVE_CHECK_HOURS = 24
+ARCHIVE_SCAN_CHUNK = 1000  # Users checked per event-loop slice during a retention scan
+
+# Activity logs: fixed-size rings, spilled to ACTIVITY_FILE so they survive restarts
+RECENT_ACTIVITY_CAPACITY = int(os.environ.get('RECENT_ACTIVITY_CAPACITY', '500'))  # Per type
+UNAUTHORIZED_CAPACITY = 200
+ACTIVITY_FILE = os.path.join(STORAGE_DIR, "activity.snap")
+ACTIVITY_SPILL_MINUTES = 5
+
+# Legitimacy cache: get_chat/profile-photo results and verdicts per user
+LEGITIMACY_CACHE_SIZE = int(os.environ.get('LEGITIMACY_CACHE_SIZE', '10000'))
+LEGITIMACY_CACHE_TTL_MINUTES = int(os.environ.get('LEGITIMACY_CACHE_TTL_MINUTES', '30'))
+CACHE_WARM_START = os.environ.get('CACHE_WARM_START', '1') == '1'  # Save/restore across restarts
+CACHE_FILE = os.path.join(STORAGE_DIR, "cache.snap")
+
+# Account age estimate: ID -> registration date anchors, refreshed from our own users
+ACCOUNT_AGE_FILE = os.path.join(STORAGE_DIR, "account_ages.snap")
+ACCOUNT_AGE_MAX_ANCHORS = 256  # Observed bounds kept per refresh
+
+# Imported ban lists: memory-mapped sorted ID file with a bloom filter in front
+BLOCKLIST_FILE = os.path.join(STORAGE_DIR, "blocklist.idx")
+BLOCKLIST_BLOOM_BITS_PER_ID = int(os.environ.get('BLOCKLIST_BLOOM_BITS_PER_ID', '10'))  # 0 disables the filter
+
+# Join requests: handled by a worker pool, channels served round-robin
+JOIN_WORKERS = int(os.environ.get('JOIN_WORKERS', '8'))
+JOIN_QUEUE_LIMIT = int(os.environ.get('JOIN_QUEUE_LIMIT', '10000'))  # submit() waits beyond this
+
+# Outgoing Bot API calls: one global budget plus Telegram's per-chat limits
+RATE_LIMIT_GLOBAL_PER_SECOND = float(os.environ.get('RATE_LIMIT_GLOBAL_PER_SECOND', '25'))
+RATE_LIMIT_PRIVATE_PER_SECOND = 1  # Messages into one private chat
+RATE_LIMIT_GROUP_PER_MINUTE = 20  # Messages into one group/channel
+RATE_LIMIT_CHAT_BUCKETS = 5000  # Per-chat buckets kept (least recently used dropped)
+RATE_LIMIT_RETRIES = 2  # Retries of a call that hit a flood limit (RetryAfter)
+
+# Calls that still fail transiently are deferred and retried with backoff
+RETRY_BASE_SECONDS = float(os.environ.get('RETRY_BASE_SECONDS', '2'))  # Doubles per attempt
+RETRY_MAX_SECONDS = 600
+DEFERRED_MAX_ATTEMPTS = int(os.environ.get('DEFERRED_MAX_ATTEMPTS', '8'))
+
+# DM outbox: user DMs are sent in the background with their own budget
+OUTBOX_PER_SECOND = float(os.environ.get('OUTBOX_PER_SECOND', '5'))
+OUTBOX_SEND_SECONDS = 5
+UNREACHABLE_DAYS = int(os.environ.get('UNREACHABLE_DAYS', '30'))  # How long a user who can't be messaged is skipped
+DEFERRED_CHECK_SECONDS = 15
+
+# Raid mode: a join spike switches the channel to decisions from the request alone
+RAID_JOINS_PER_MINUTE = int(os.environ.get('RAID_JOINS_PER_MINUTE', '30'))  # 0 disables raid mode
+RAID_BUCKET_SECONDS = 5  # Resolution of the one-minute join-rate window
+RAID_SUMMARY_MINUTES = 5
+RAID_CHECK_SECONDS = 10
+
+# Pending verifications unanswered for CODE_EXPIRY_MINUTES get their channel's action
+PENDING_EXPIRY_ACTION = os.environ.get('PENDING_EXPIRY_ACTION', 'escalate')  # decline/approve/escalate
+PENDING_SWEEP_SECONDS = 30
+EXPIRY_BATCH_SIZE = 100  # Expired users resolved per batch
+EXPIRY_CONCURRENCY = 10  # Resolutions in flight within a batch
+PENDING_LIST_LIMIT = 30  # Users shown by /pending_users
+
+# Borderline-user notices: collected for a window and sent as one paged digest
+DIGEST_WINDOW_SECONDS = int(os.environ.get('DIGEST_WINDOW_SECONDS', '60'))  # 0 = one message per user
+DIGEST_PAGE_SIZE = 8  # Users per digest page
+DIGEST_KEEP = 50  # Recent digests whose buttons still work
+
+# Batch operations (/approve_all_pending): parallel Bot API calls, flushed in large writes
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '10'))
+BATCH_PROGRESS_SECONDS = 5  # How often the progress message is edited (and changes flushed)
+BATCH_FLUSH_EVERY = 500  # Items between flushes during a batch
+BATCH_LOCK = asyncio.Lock()  # One batch at a time - they share the pending records
+
+# /bulk_approve lines: user ID, optionally a channel ID after a comma/semicolon/tab.
+# Each must end its column, so a longer number is invalid rather than cut short.
+BULK_LINE_PATTERN = re.compile(
+    rb'[ \t]*"?(\d{1,18})"?[ ]*(?:[,;\t][ \t]*"?(-\d{1,18})"?[ \t]*)?(?:[,;\t]|\r?$)')
+BULK_DEDUPE_WINDOW = 10_000  # Recent distinct lines checked for repeats
+
+# Snapshot key -> module global holding that piece of state
+STATE_GLOBALS = {
+    'managed_channels': 'MANAGED_CHANNELS',
+    'uploaded_images': 'UPLOADED_IMAGES',
+    'channel_specific_images': 'CHANNEL_SPECIFIC_IMAGES',
+    'default_caption': 'DEFAULT_CAPTION',
+    'channel_default_captions': 'CHANNEL_DEFAULT_CAPTIONS',
+    'auto_post_enabled': 'AUTO_POST_ENABLED',
+    'current_image_index': 'CURRENT_IMAGE_INDEX',
+    'bulk_approval_mode': 'BULK_APPROVAL_MODE',
+    'blocked_users': 'BLOCKED_USERS',
+    'user_database': 'USER_DATABASE',
+    'promo_images': 'PROMO_IMAGES',
+    'post_counter': 'POST_COUNTER',
+    # NEW additions
+    'global_fallback_channel': 'GLOBAL_FALLBACK_CHANNEL',
+    'channel_media_queue': 'CHANNEL_MEDIA_QUEUE',
+    'channel_links': 'CHANNEL_LINKS',
+    'channel_link_index': 'CHANNEL_LINK_INDEX',
+    'channel_content_type': 'CHANNEL_CONTENT_TYPE',
+    'channel_intervals': 'CHANNEL_INTERVALS',
+    'pending_verifications': 'PENDING_VERIFICATIONS',
+    'deferred_ops': 'DEFERRED_OPS',
+    'outbox': 'OUTBOX',
+    'unreachable_users': 'UNREACHABLE_USERS',
+    'verification_policies': 'VERIFICATION_POLICIES',
+    'channel_expiry_actions': 'CHANNEL_EXPIRY_ACTIONS'
+}
+
+# State sections: each is saved to its own file under STATE_DIR, so compaction
+# rewrites only the subsystems that changed since the last one
+STATE_SECTIONS = {
+    'channels': [
+        'managed_channels', 'default_caption', 'channel_default_captions',
+        'auto_post_enabled', 'bulk_approval_mode', 'blocked_users',
+        'global_fallback_channel', 'channel_content_type', 'channel_intervals',
+        'verification_policies', 'channel_expiry_actions'
+    ],
+    'media': [
+        'uploaded_images', 'channel_specific_images', 'promo_images',
+        'channel_media_queue'
+    ],
+    'links': ['channel_links'],
+    'users': ['user_database'],
+    'counters': ['current_image_index', 'post_counter', 'channel_link_index'],
+    'pending': ['pending_verifications', 'deferred_ops', 'outbox', 'unreachable_users']
+}
+SECTION_OF_KEY = {key: section for section, keys in STATE_SECTIONS.items() for key in keys}
+SECTION_FORMAT = 1  # Bump when the layout of a section file changes
+
+# Section file codec: 'binary' (typed snapshot, see SNAPSHOT CODEC) or 'json'
+SNAPSHOT_CODEC = os.environ.get('SNAPSHOT_CODEC', 'binary').lower()
+
+# Dictionaries whose channel/user IDs come back from JSON as strings
+INT_KEYED_STATE = [
+    'managed_channels', 'channel_specific_images', 'auto_post_enabled',
+    'current_image_index', 'bulk_approval_mode', 'channel_default_captions',
+    'promo_images', 'post_counter', 'channel_media_queue', 'channel_links',
+    'channel_link_index', 'channel_content_type', 'channel_intervals',
+    'user_database', 'pending_verifications', 'deferred_ops', 'verification_policies',
+    'channel_expiry_actions', 'outbox', 'unreachable_users'
+]
 
 
-def save_data():
-    """Save all bot data to file"""
-    try:
-        data = {
-            'managed_channels': MANAGED_CHANNELS,
-            'uploaded_images': UPLOADED_IMAGES,
-            'channel_specific_images': CHANNEL_SPECIFIC_IMAGES,
-            'default_caption': DEFAULT_CAPTION,
-            'channel_default_captions': CHANNEL_DEFAULT_CAPTIONS,
-            'auto_post_enabled': AUTO_POST_ENABLED,
-            'current_image_index': CURRENT_IMAGE_INDEX,
-            'bulk_approval_mode': BULK_APPROVAL_MODE,
-            'blocked_users': list(BLOCKED_USERS),
-            'user_database': USER_DATABASE,
-            'promo_images': PROMO_IMAGES,
-            'post_counter': POST_COUNTER,
-            # NEW additions
-            'global_fallback_channel': GLOBAL_FALLBACK_CHANNEL,
-            'channel_media_queue': CHANNEL_MEDIA_QUEUE,
-            'channel_links': CHANNEL_LINKS,
-            'channel_link_index': CHANNEL_LINK_INDEX,
-            'channel_content_type': CHANNEL_CONTENT_TYPE,
-            'channel_intervals': CHANNEL_INTERVALS
-        }
-        with open(STORAGE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, default=str)
-        logger.info("✅ Data saved")
-    except Exception as e:
-        logger.error(f"Save failed: {e}")
+def convert_keys(d):
+    """Convert numeric string keys back to int"""
+    return {
+        int(k) if str(k).lstrip('-').isdigit() else k: v
+        for k, v in d.items()
+    }
 
 
-def load_data():
-    """Load all bot data from file"""
-    global MANAGED_CHANNELS, UPLOADED_IMAGES, CHANNEL_SPECIFIC_IMAGES
-    global DEFAULT_CAPTION, CHANNEL_DEFAULT_CAPTIONS, AUTO_POST_ENABLED
-    global CURRENT_IMAGE_INDEX, BULK_APPROVAL_MODE, BLOCKED_USERS, USER_DATABASE
-    global PROMO_IMAGES, POST_COUNTER
-    global GLOBAL_FALLBACK_CHANNEL, CHANNEL_MEDIA_QUEUE, CHANNEL_LINKS
-    global CHANNEL_LINK_INDEX, CHANNEL_CONTENT_TYPE, CHANNEL_INTERVALS
+def _restore_user(user: dict) -> dict:
+    """Restore int channel keys and datetimes inside a user record loaded from JSON"""
+    if isinstance(user.get('channels'), dict):
+        user['channels'] = convert_keys(user['channels'])
+        for membership in user['channels'].values():
+            for field in ('request_date', 'approval_date'):
+                if isinstance(membership.get(field), str):
+                    membership[field] = _parse_date(membership[field])
+    return user
 
-    try:
-        if os.path.exists(STORAGE_FILE):
-            with open(STORAGE_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
 
-            MANAGED_CHANNELS = data.get('managed_channels', {})
-            UPLOADED_IMAGES = data.get('uploaded_images', [])
-            CHANNEL_SPECIFIC_IMAGES = data.get('channel_specific_images', {})
-            DEFAULT_CAPTION = data.get('default_caption', "")
-            CHANNEL_DEFAULT_CAPTIONS = data.get('channel_default_captions', {})
-            AUTO_POST_ENABLED = data.get('auto_post_enabled', {})
-            CURRENT_IMAGE_INDEX = data.get('current_image_index', {})
-            BULK_APPROVAL_MODE = data.get('bulk_approval_mode', {})
-            BLOCKED_USERS = set(data.get('blocked_users', []))
-            USER_DATABASE = data.get('user_database', {})
-            PROMO_IMAGES = data.get('promo_images', {})
-            POST_COUNTER = data.get('post_counter', {})
-
-            # NEW additions
-            GLOBAL_FALLBACK_CHANNEL = data.get('global_fallback_channel', "")
-            CHANNEL_MEDIA_QUEUE = data.get('channel_media_queue', {})
-            CHANNEL_LINKS = data.get('channel_links', {})
-            CHANNEL_LINK_INDEX = data.get('channel_link_index', {})
-            CHANNEL_CONTENT_TYPE = data.get('channel_content_type', {})
-            CHANNEL_INTERVALS = data.get('channel_intervals', {})
-
-            # Convert string keys to int for all dictionaries
-            def convert_keys(d):
-                return {
-                    int(k) if str(k).lstrip('-').isdigit() else k: v
-                    for k, v in d.items()
-                }
-
-            MANAGED_CHANNELS = convert_keys(MANAGED_CHANNELS)
-            CHANNEL_SPECIFIC_IMAGES = convert_keys(CHANNEL_SPECIFIC_IMAGES)
-            AUTO_POST_ENABLED = convert_keys(AUTO_POST_ENABLED)
-            CURRENT_IMAGE_INDEX = convert_keys(CURRENT_IMAGE_INDEX)
-            BULK_APPROVAL_MODE = convert_keys(BULK_APPROVAL_MODE)
-            CHANNEL_DEFAULT_CAPTIONS = convert_keys(CHANNEL_DEFAULT_CAPTIONS)
-            PROMO_IMAGES = convert_keys(PROMO_IMAGES)
-            POST_COUNTER = convert_keys(POST_COUNTER)
-            CHANNEL_MEDIA_QUEUE = convert_keys(CHANNEL_MEDIA_QUEUE)
-            CHANNEL_LINKS = convert_keys(CHANNEL_LINKS)
-            CHANNEL_LINK_INDEX = convert_keys(CHANNEL_LINK_INDEX)
-            CHANNEL_CONTENT_TYPE = convert_keys(CHANNEL_CONTENT_TYPE)
-            CHANNEL_INTERVALS = convert_keys(CHANNEL_INTERVALS)
-
-            logger.info(
-                f"✅ Loaded: {len(MANAGED_CHANNELS)} channels, {len(UPLOADED_IMAGES)} images"
-            )
-        else:
-            logger.info("No saved data")
-    except Exception as e:
-        logger.error(f"Load failed: {e}")
+def _restore_verification(verification: dict) -> dict:
+    """Restore the timestamp of a pending verification loaded from JSON"""
+    if isinstance(verification.get('timestamp'), str):
+        verification['timestamp'] = _parse_date(verification['timestamp'])
+    if 'chat_id' in verification:
+        # Records from before one verification covered several channels
+        verification['chat_ids'] = [verification.pop('chat_id')]
+    return verification
 
 
-def is_verified(user_id: int) -> bool:
-    return user_id in VERIFIED_USERS or user_id == ADMIN_ID
+def _decode_json_state(data: dict) -> dict:
+    """Turn a snapshot dict parsed from JSON back into typed state (int IDs, datetimes)"""
+    for key in INT_KEYED_STATE:
+        if key in data:
+            data[key] = convert_keys(data[key])
+    for user in data.get('user_database', {}).values():
+        _restore_user(user)
+    return data
 
 
-async def is_bot_admin(context: ContextTypes.DEFAULT_TYPE,
-                       chat_id: int) -> bool:
+def _state_container(key: str, item=None):
+    """Return the live object a journal record for key/item operates on"""
+    state = globals()[STATE_GLOBALS[key]]
+    if item is None:
+        return state
+    return state.setdefault(item, [])
+
+
+def persist_change(key: str, op: str, item=None, value=None):
+    """
+    Append one state mutation to the journal instead of rewriting the state files.
+    Call it AFTER changing the in-memory state.
+
+    Ops:
+    - set: state[item] = value (or replace the whole key when item is None)
+    - del: state.pop(item)
+    - clear: state.clear()
+    - append/extend: add value(s) to the list at state[item]
+    - add/discard: set membership (blocked users)
+    """
+    global JOURNAL_SEQ
+
+    JOURNAL_SEQ += 1
+    record = {'seq': JOURNAL_SEQ, 'key': key, 'op': op}
+    if item is not None:
+        record['item'] = item
+    if op != 'del' and op != 'clear':
+        record['value'] = value
+
+    # Record where appended items landed so replay stays idempotent
+    if op == 'append':
+        record['index'] = len(_state_container(key, item)) - 1
+    elif op == 'extend':
+        record['index'] = len(_state_container(key, item)) - len(value)
+
+    # Later set/del of the same entry replaces the earlier record (the value is
+    # the live object, so it is serialized as it looks at flush time)
+    coalesce_key = _coalesce_key(record)
+    PENDING_CHANGES.pop(coalesce_key, None)
+    PENDING_CHANGES[coalesce_key] = record
+
+    mark_dirty()
+
+
+def _coalesce_key(record: dict) -> tuple:
+    """PENDING_CHANGES key of a record: set/del of one entry (or one set member) share a slot"""
+    op = record['op']
+    if op in ('set', 'del'):
+        return (record['key'], record.get('item'))
+    if op in ('add', 'discard'):
+        return (record['key'], record['value'])
+    return (record['key'], op, record['seq'])
+
+
+def mark_dirty():
+    """Schedule a flush of pending changes at the end of the current window"""
+    global PERSIST_FLUSH_HANDLE
+
+    if PERSIST_FLUSH_HANDLE is not None or PERSIST_HOLDS:
+        return  # A flush is already scheduled (or held) - this change rides along
+
     try:
-        bot_member = await context.bot.get_chat_member(chat_id, context.bot.id)
-        return bot_member.status in [
-            ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER
-        ]
-    except:
-        return False
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # No event loop (startup/shutdown) - write right away
+        records = _take_pending_changes()
+        if not _write_changes(records):
+            _requeue_changes(records)  # Retried with the next change or flush
+        return
 
+    PERSIST_FLUSH_HANDLE = loop.call_later(
+        PERSIST_FLUSH_SECONDS, lambda: asyncio.ensure_future(flush_changes()))
 
-def generate_verification_code() -> str:
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
 
+def hold_persistence():
+    """Hold flushes back (for a batch); every hold needs a release_persistence()"""
+    global PERSIST_HOLDS, PERSIST_FLUSH_HANDLE
 
-def is_name_suspicious(name: str) -> bool:
-    """Check if name looks suspicious (bot-like)"""
-    if not name or len(name) < 2:
-        return True
+    PERSIST_HOLDS += 1
+    if PERSIST_FLUSH_HANDLE is not None:
+        PERSIST_FLUSH_HANDLE.cancel()
+        PERSIST_FLUSH_HANDLE = None
 
-    # Check for "User" followed by numbers (typical bot pattern)
-    if re.match(r'^User\d+$', name, re.IGNORECASE):
-        return True
 
-    # Check if name is mostly numbers
-    letters_and_numbers = re.sub(r'[^a-zA-Z0-9]', '', name)
-    if len(letters_and_numbers) < 2:
-        return True
+async def release_persistence():
+    """End a hold; the last one writes everything changed meanwhile in one flush"""
+    global PERSIST_HOLDS
+
+    PERSIST_HOLDS -= 1
+    if not PERSIST_HOLDS:
+        await flush_changes()
+
+
+def _take_pending_changes() -> list:
+    """Detach the pending records so new changes start a fresh batch"""
+    global PENDING_CHANGES
+    records = list(PENDING_CHANGES.values())
+    PENDING_CHANGES = {}
+    return records
+
 
-    numbers = re.sub(r'\D', '', name)
-    if len(numbers) > len(name) * 0.6:  # More than 60% numbers
+def _write_changes(records: list) -> bool:
+    """Worker thread: hand a batch of records to the storage backend; False if it failed"""
+    global JOURNAL_RECORDS
+
+    if not records:
         return True
+    try:
+        STORAGE.write(records)
+        JOURNAL_RECORDS += len(records)
+    except Exception as e:
+        logger.error(f"Storage write failed ({STORAGE.name}), {len(records)} changes kept for retry: {e}")
+        return False
+    return True
 
-    return False
 
+def _requeue_changes(records: list):
+    """
+    Put a batch that failed to write back in front of PENDING_CHANGES (event
+    loop only). A newer change to the same entry wins over the failed record.
+    Replay is idempotent, so records written before the failure can repeat.
+    """
+    global PENDING_CHANGES
+    requeued = {}
+    for record in records:
+        coalesce_key = _coalesce_key(record)
+        if coalesce_key not in PENDING_CHANGES:
+            requeued[coalesce_key] = record
+    requeued.update(PENDING_CHANGES)
+    PENDING_CHANGES = requeued
+
+
+async def flush_changes():
+    """Write everything changed during the last window from the worker thread"""
+    global PERSIST_FLUSH_HANDLE
+
+    if PERSIST_FLUSH_HANDLE is not None:
+        PERSIST_FLUSH_HANDLE.cancel()
+        PERSIST_FLUSH_HANDLE = None
+
+    records = _take_pending_changes()
+    if records:
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(PERSIST_EXECUTOR, _write_changes, records):
+            _requeue_changes(records)
+            mark_dirty()  # Try again next window
+
+
+def _replay_record(record: dict):
+    """Apply one journal record to the in-memory state"""
+    key = record['key']
+    if key not in STATE_GLOBALS:
+        return
+
+    op = record['op']
+    item = record.get('item')
+    value = record.get('value')
 
-async def check_user_legitimacy(context: ContextTypes.DEFAULT_TYPE,
-                                user_id: int) -> dict:
+    if key == 'user_database' and isinstance(value, dict):
+        value = _restore_user(value)
+    elif key == 'pending_verifications' and isinstance(value, dict):
+        value = _restore_verification(value)
+
+    if op == 'set':
+        if item is None:
+            globals()[STATE_GLOBALS[key]] = set(value) if key == 'blocked_users' else value
+        else:
+            globals()[STATE_GLOBALS[key]][item] = value
+    elif op == 'del':
+        globals()[STATE_GLOBALS[key]].pop(item, None)
+    elif op == 'clear':
+        globals()[STATE_GLOBALS[key]].clear()
+    elif op == 'add':
+        globals()[STATE_GLOBALS[key]].add(value)
+    elif op == 'discard':
+        globals()[STATE_GLOBALS[key]].discard(value)
+    elif op in ('append', 'extend'):
+        target = _state_container(key, item)
+        values = [value] if op == 'append' else value
+        for offset, entry in enumerate(values):
+            position = record['index'] + offset
+            if position < len(target):
+                target[position] = entry
+            else:
+                target.append(entry)
+
+
+def _collect_state(keys=None) -> dict:
+    """Build the snapshot dict from the in-memory state (optionally only some keys)"""
+    data = {key: globals()[STATE_GLOBALS[key]] for key in (keys or STATE_GLOBALS)}
+    if 'blocked_users' in data:
+        data['blocked_users'] = list(BLOCKED_USERS)
+    if isinstance(data.get('user_database'), UserStore):
+        data['user_database'] = dict(USER_DATABASE.items())
+    return data
+
+
+def save_data():
     """
-    Enhanced user legitimacy checker with detailed scoring
-    Returns: {"legitimate": bool, "score": int, "reason": str}
+    Compact the storage backend (JSON: rewrite changed sections + truncate the journal).
+    Day-to-day mutations go through persist_change() instead.
+    Runs on PERSIST_EXECUTOR so it never overlaps a write.
     """
+    global JOURNAL_RECORDS
     try:
-        user = await context.bot.get_chat(user_id)
+        STORAGE.compact()
+        JOURNAL_RECORDS = 0
+        logger.info("✅ Data saved")
+    except Exception as e:
+        logger.error(f"Save failed: {e}")
 
-        score = 0
-        reasons = []
 
-        # Check 1: Is it a bot?
-        if user.type == "bot":
-            return {"legitimate": False, "reason": "Bot account", "score": 0}
+async def compact_journal_job():
+    """Periodic job: fold the journal into the state files once it grows large"""
+    if JOURNAL_RECORDS >= JOURNAL_COMPACT_RECORDS:
+        logger.info(f"🗜️ Compacting journal ({JOURNAL_RECORDS} records)")
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(PERSIST_EXECUTOR, save_data)
 
-        # Check 2: Name quality (40 points)
-        if not user.first_name or is_name_suspicious(user.first_name):
-            reasons.append("Suspicious name")
-        else:
-            score += 40
 
-        # Check 3: Has username? (30 points)
-        if user.username:
-            score += 30
-        else:
-            reasons.append("No username")
+async def on_startup(app: Application):
+    """Start the join-request workers once the event loop runs"""
+    JOIN_QUEUE.start(JOIN_WORKERS)
 
-        # Check 4: Has profile photo? (30 points)
-        if REQUIRE_PROFILE_PHOTO:
-            try:
-                photos = await context.bot.get_user_profile_photos(user_id, limit=1)
-                if photos.total_count > 0:
-                    score += 30
-                else:
-                    reasons.append("No profile photo")
-            except:
-                reasons.append("Cannot check photo")
-        else:
-            # Give score anyway if not required
-            score += 30
-
-        # Scoring system:
-        # 100 = Legitimate (auto-approve)
-        # 1-99 = Borderline (manual check with captcha)
-        # 0 = Suspicious (auto-reject)
-
-        if score >= 70:
-            return {"legitimate": True, "score": 100}
-        elif score >= 30:
-            return {"legitimate": False, "score": 50, "reason": ", ".join(reasons)}
-        else:
-            return {"legitimate": False, "score": 0, "reason": ", ".join(reasons)}
 
+async def on_shutdown(app: Application):
+    """Final flush so nothing from the last window is lost on restart"""
+    # Requests still queued stay pending in Telegram and can be approved later
+    await JOIN_QUEUE.stop()
+    await flush_changes()
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(PERSIST_EXECUTOR, save_data)
+    await spill_activity_job()
+    try:
+        await loop.run_in_executor(PERSIST_EXECUTOR, save_cache)
     except Exception as e:
-        logger.error(f"Legitimacy check failed: {e}")
-        return {"legitimate": False, "reason": "Error checking user", "score": 0}
+        logger.error(f"Cache save failed: {e}")
+    PERSIST_EXECUTOR.shutdown(wait=True)
+    STORAGE.close()
+    logger.info("✅ Final state flush complete")
 
 
-def track_user_activity(user_id: int,
-                        channel_id: int,
-                        action: str,
-                        user_data: dict = None):
-    """Track user activity in database"""
-    if user_id not in USER_DATABASE:
-        USER_DATABASE[user_id] = {
-            'first_name':
-            user_data.get('first_name', 'Unknown') if user_data else 'Unknown',
-            'last_name': user_data.get('last_name', ''),
-            'username': user_data.get('username', ''),
-            'channels': {}
-        }
-    if channel_id not in USER_DATABASE[user_id]['channels']:
-        USER_DATABASE[user_id]['channels'][channel_id] = {
-            'channel_name':
-            MANAGED_CHANNELS.get(channel_id, {}).get('name', 'Unknown'),
-            'status':
-            action,
-            'request_date':
-            datetime.now(),
-            'approval_date':
-            None
-        }
-    else:
-        USER_DATABASE[user_id]['channels'][channel_id]['status'] = action
-        if action == 'approved':
-            USER_DATABASE[user_id]['channels'][channel_id][
-                'approval_date'] = datetime.now()
-    save_data()
+def _apply_state(data: dict, typed: bool = False):
+    """
+    Install a loaded snapshot dict as the module-level state.
+    typed=True skips the JSON key/date conversion (binary snapshots are already typed).
+    """
+    if not typed:
+        data = _decode_json_state(data)
+    for key, name in STATE_GLOBALS.items():
+        if key in data:
+            globals()[name] = data[key]
 
+    globals()['BLOCKED_USERS'] = set(BLOCKED_USERS)
+    for verification in PENDING_VERIFICATIONS.values():
+        _restore_verification(verification)
+
+
+def load_data():
+    """Load all bot data from the configured storage backend"""
+    global STORAGE
+
+    # Outside the try: a misconfigured backend should stop the bot, not start it empty
+    STORAGE = create_storage(STORAGE_BACKEND)
 
-async def alert_owner_unauthorized_access(context: ContextTypes.DEFAULT_TYPE,
-                                          user_id: int, username: str,
-                                          first_name: str, command: str):
-    """Alert owner of unauthorized access attempts"""
     try:
-        UNAUTHORIZED_ATTEMPTS.append({
-            'user_id': user_id,
-            'username': username,
-            'first_name': first_name,
-            'command': command,
-            'timestamp': datetime.now()
-        })
+        if STORAGE.name != 'json' and STORAGE.is_empty():
+            # First start on this backend - import the JSON snapshot + journal once
+            legacy = JsonStorage(STATE_DIR, STORAGE_FILE, JOURNAL_FILE, SNAPSHOT_CODEC)
+            if not legacy.is_empty():
+                legacy.load()
+                STORAGE.write([{'key': key, 'op': 'set', 'value': value}
+                               for key, value in _collect_state().items()])
+                logger.info(f"✅ Migrated JSON state into {STORAGE.name} storage")
+            else:
+                logger.info("No saved data")
+        else:
+            STORAGE.load()
 
-        await context.bot.send_message(
-            ADMIN_ID,
-            f"🚨 *Unauthorized Access Attempt*\n\n"
-            f"User: {first_name}\n"
-            f"ID: `{user_id}`\n"
-            f"Username: @{username or 'None'}\n"
-            f"Command: `{command}`",
-            parse_mode='Markdown')
+        load_activity()
+        load_cache()
+        load_account_ages()
+        load_blocklist()
+        load_pending_expiry()
+
+        logger.info(
+            f"✅ Loaded: {len(MANAGED_CHANNELS)} channels, {len(UPLOADED_IMAGES)} images"
+        )
     except Exception as e:
-        logger.error(f"Alert failed: {e}")
+        logger.error(f"Load failed: {e}")
 
 
-async def owner_only_check(update: Update,
-                           context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """Check if user is the owner"""
+# ========== SNAPSHOT CODEC ==========
+# Section files are stored as MAGIC + version byte + pickle body. The C pickler
+# keeps int keys, sets and datetimes as they are, so a load is one decode pass
+# with no convert_keys walk. Like json.dumps it runs without calling back into
+# Python code, so the live dicts can't change mid-encode.
+SNAPSHOT_MAGIC = b'XRSNAP'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_PROTOCOL = 5
+
+# The only classes a snapshot may reference - anything else is refused on load
+SNAPSHOT_CLASSES = {
+    ('datetime', 'datetime'), ('datetime', 'date'),
+    ('datetime', 'timedelta'), ('datetime', 'timezone')
+}
+
+
+class _SnapshotUnpickler(pickle.Unpickler):
+    """Unpickler restricted to plain containers and datetime types"""
+
+    def find_class(self, module, name):
+        if (module, name) in SNAPSHOT_CLASSES:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f"Snapshot may not reference {module}.{name}")
+
+
+def encode_snapshot(obj) -> bytes:
+    """Encode a snapshot dict into the versioned binary format"""
+    return SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]) + pickle.dumps(obj, protocol=SNAPSHOT_PROTOCOL)
+
+
+def decode_snapshot(payload: bytes):
+    """Decode a binary snapshot; raises ValueError for foreign or newer files"""
+    header = len(SNAPSHOT_MAGIC)
+    if payload[:header] != SNAPSHOT_MAGIC:
+        raise ValueError("Not a snapshot file")
+    version = payload[header]
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version {version}")
+    # Decoding allocates millions of containers; cyclic GC passes over them
+    # would roughly double the load time and can't find anything to free
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
     try:
-        if not update.effective_user or update.effective_user.id != ADMIN_ID:
-            if update.effective_user:
-                await alert_owner_unauthorized_access(context, update.effective_user.id,
-                                                      update.effective_user.username or "None",
-                                                      update.effective_user.first_name or "Unknown",
-                                                      update.message.text if update.message else "callback")
-            if update.message:
-                await update.message.reply_text("❌ Unauthorized")
-            return False
-        logger.info(f"✅ Owner check passed for user {update.effective_user.id}")
-        return True
+        return _SnapshotUnpickler(BytesIO(payload[header + 1:])).load()
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+# ========== LAZY USER STORE ==========
+# The users section is saved as an index file: a sorted uid array plus record
+# offsets, followed by one pickled record per user. Startup maps the file and
+# reads only the header; a record is decoded the first time it is looked up.
+#
+#   header  MAGIC, version, count, meta length      (USER_INDEX_HEADER)
+#   meta    pickled section info (format, version, journal_seq), padded to 8
+#   uids    int64[count], sorted
+#   offsets uint64[count + 1], record i is blob[offsets[i]:offsets[i + 1]]
+#   blob    records
+USER_INDEX_MAGIC = b'XRUIDX'
+USER_INDEX_VERSION = 1
+USER_INDEX_HEADER = struct.Struct('=6sBxQQ')
+
+
+def _pad8(size: int) -> int:
+    return (size + 7) & ~7
+
+
+def _load_record(raw) -> dict:
+    return _SnapshotUnpickler(BytesIO(raw)).load()
+
+
+class UserIndexFile:
+    """Read-only, memory-mapped users index (see LAZY USER STORE)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, meta_len = USER_INDEX_HEADER.unpack_from(self.map, 0)
+        if magic != USER_INDEX_MAGIC:
+            raise ValueError(f"{path} is not a users index")
+        if version != USER_INDEX_VERSION:
+            raise ValueError(f"Unsupported users index version {version}")
+
+        start = USER_INDEX_HEADER.size
+        self.meta = _load_record(self.map[start:start + meta_len])
+        start += _pad8(meta_len)
+        view = memoryview(self.map)
+        self.uids = view[start:start + 8 * count].cast('q')
+        start += 8 * count
+        self.offsets = view[start:start + 8 * (count + 1)].cast('Q')
+        self.blob_start = start + 8 * (count + 1)
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self):
+        return iter(self.uids)
+
+    def _find(self, user_id) -> int:
+        """Position of user_id in the uid array, or -1"""
+        if not isinstance(user_id, int):
+            return -1
+        position = bisect.bisect_left(self.uids, user_id)
+        if position < self.count and self.uids[position] == user_id:
+            return position
+        return -1
+
+    def __contains__(self, user_id) -> bool:
+        return self._find(user_id) >= 0
+
+    def raw(self, user_id) -> bytes:
+        """Encoded record bytes - compaction copies untouched users without decoding"""
+        position = self._find(user_id)
+        return self.map[self.blob_start + self.offsets[position]:
+                        self.blob_start + self.offsets[position + 1]]
+
+    def get(self, user_id):
+        position = self._find(user_id)
+        if position < 0:
+            return None
+        return _load_record(self.map[self.blob_start + self.offsets[position]:
+                                     self.blob_start + self.offsets[position + 1]])
+
+
+class UserStore(MutableMapping):
+    """
+    USER_DATABASE backed by a UserIndexFile.
+
+    A record is decoded on first lookup and stays in `loaded` from then on,
+    because callers mutate it in place. Iterating (exports, stats) decodes
+    records on the fly without keeping them, so they are read-only there.
+    """
+
+    def __init__(self, source: UserIndexFile = None, records: dict = None):
+        self.source = source
+        self.loaded = records if records is not None else {}
+        self.added = {uid for uid in self.loaded if source is None or uid not in source}
+        self.deleted = set()  # uids removed from the source
+        # Guards materialize/add/delete against the compaction swap (worker thread)
+        self.lock = threading.Lock()
+
+    def __getitem__(self, user_id):
+        user = self.loaded.get(user_id)
+        if user is not None:
+            return user
+        with self.lock:
+            user = self.loaded.get(user_id)
+            if user is None and self.source is not None and user_id not in self.deleted:
+                user = self.source.get(user_id)
+                if user is not None:
+                    self.loaded[user_id] = user
+        if user is None:
+            raise KeyError(user_id)
+        return user
+
+    def __contains__(self, user_id) -> bool:
+        if user_id in self.loaded:
+            return True
+        return (self.source is not None and user_id not in self.deleted
+                and user_id in self.source)
+
+    def __setitem__(self, user_id, user: dict):
+        with self.lock:
+            self.loaded[user_id] = user
+            if self.source is not None and user_id in self.source:
+                self.deleted.discard(user_id)
+            else:
+                self.added.add(user_id)
+
+    def __delitem__(self, user_id):
+        with self.lock:
+            if user_id not in self:
+                raise KeyError(user_id)
+            self.loaded.pop(user_id, None)
+            if user_id in self.added:
+                self.added.discard(user_id)
+            else:
+                self.deleted.add(user_id)
+
+    def __len__(self) -> int:
+        source_count = len(self.source) if self.source is not None else 0
+        return source_count - len(self.deleted) + len(self.added)
+
+    def __iter__(self):
+        if self.source is not None:
+            for user_id in self.source:
+                if user_id not in self.deleted:
+                    yield user_id
+        yield from list(self.added)
+
+    def items(self):
+        for user_id in self:
+            user = self.loaded.get(user_id)
+            if user is None:
+                user = self.source.get(user_id)
+            if user is not None:
+                yield user_id, user
+
+    def values(self):
+        for _, user in self.items():
+            yield user
+
+    def clear(self):
+        with self.lock:
+            self.source = None
+            self.loaded = {}
+            self.added = set()
+            self.deleted = set()
+
+    def write_index(self, path: str, meta: dict):
+        """
+        Worker thread: write the full users index to path (temp file + rename)
+        and switch the store over to it. Untouched users are copied as raw
+        bytes, so the cost grows with the users touched since the last write.
+        """
+        with self.lock:
+            source = self.source
+            loaded = dict(self.loaded)
+            added = set(self.added)
+            deleted = set(self.deleted)
+
+        uids = set(loaded)
+        if source is not None:
+            uids.update(source)
+        uids.difference_update(deleted)
+        uids = sorted(uids)
+
+        offsets = array('Q', [0])
+        chunks = []
+        position = 0
+        for user_id in uids:
+            user = loaded.get(user_id)
+            if user is not None:
+                # Single C call per record - the live dict can't change mid-encode
+                raw = pickle.dumps(user, protocol=SNAPSHOT_PROTOCOL)
+            else:
+                raw = source.raw(user_id)
+            chunks.append(raw)
+            position += len(raw)
+            offsets.append(position)
+
+        meta_raw = pickle.dumps(meta, protocol=SNAPSHOT_PROTOCOL)
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(USER_INDEX_HEADER.pack(USER_INDEX_MAGIC, USER_INDEX_VERSION, len(uids), len(meta_raw)))
+            f.write(meta_raw.ljust(_pad8(len(meta_raw)), b'\0'))
+            f.write(array('q', uids).tobytes())
+            f.write(offsets.tobytes())
+            f.writelines(chunks)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+
+        # The old mapping stays valid until the last reader drops it
+        new_source = UserIndexFile(path)
+        with self.lock:
+            self.source = new_source
+            self.deleted -= deleted
+            # Changes made while the file was written: added users deleted since
+            # are in the new file, deleted users added back are not
+            self.deleted.update(uid for uid in added if uid not in self.loaded)
+            self.added.update(uid for uid in deleted if uid in self.loaded)
+            self.added = {uid for uid in self.added if uid not in new_source}
+
+
+# ========== BLOCKLIST INDEX ==========
+# Imported ban lists (hundreds of thousands to millions of IDs) live in one
+# memory-mapped file instead of BLOCKED_USERS, which stays for /block_user:
+#
+#   header  MAGIC, version, count, bloom bits, bloom hashes   (BLOCKLIST_HEADER)
+#   ids     int64[count], sorted, unique
+#   bloom   bloom bits, rounded up to whole bytes (absent when bits is 0)
+#
+# 8 bytes per ID (+ ~1.2 with the bloom filter) versus ~60 for a set of ints.
+# Lookups check the bloom filter first, so most non-blocked users never touch
+# the ID pages; the rest bisect the mapped array.
+BLOCKLIST_MAGIC = b'XRBLCK'
+BLOCKLIST_VERSION = 1
+BLOCKLIST_HEADER = struct.Struct('=6sBxQQI4x')
+BLOCKLIST_ID_PATTERN = re.compile(rb'-?\d+')  # Signed, so negative (chat) IDs are skipped
+BLOCKLIST_CHUNK = 1_000_000  # IDs sorted in memory at a time during an import
+MASK64 = (1 << 64) - 1
+
+
+def _mix64(value: int) -> int:
+    """splitmix64 finalizer - spreads sequential IDs over the bloom filter"""
+    value = (value + 0x9E3779B97F4A7C15) & MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
+
+
+def _bloom_positions(user_id: int, bits: int, hashes: int):
+    mixed = _mix64(user_id)
+    step = (mixed >> 32) | 1
+    for index in range(hashes):
+        yield (mixed + index * step) % bits
+
+
+class BlocklistFile:
+    """Read-only, memory-mapped blocklist (see BLOCKLIST INDEX)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, bloom_bits, bloom_hashes = BLOCKLIST_HEADER.unpack_from(self.map, 0)
+        if magic != BLOCKLIST_MAGIC:
+            raise ValueError(f"{path} is not a blocklist")
+        if version != BLOCKLIST_VERSION:
+            raise ValueError(f"Unsupported blocklist version {version}")
+
+        start = BLOCKLIST_HEADER.size
+        view = memoryview(self.map)
+        self.ids = view[start:start + 8 * count].cast('q')
+        self.bloom = view[start + 8 * count:start + 8 * count + (bloom_bits + 7) // 8]
+        self.bloom_bits = bloom_bits
+        self.bloom_hashes = bloom_hashes
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, user_id) -> bool:
+        if self.bloom_bits:
+            for bit in _bloom_positions(user_id, self.bloom_bits, self.bloom_hashes):
+                if not self.bloom[bit >> 3] & (1 << (bit & 7)):
+                    return False
+        position = bisect.bisect_left(self.ids, user_id)
+        return position < self.count and self.ids[position] == user_id
+
+
+BLOCKLIST = None  # BlocklistFile once a list has been imported
+BLOCKLIST_IMPORT_LOCK = asyncio.Lock()  # One import (or clear) at a time
+
+
+def is_blocked(user_id: int) -> bool:
+    """Blocked by /block_user or by an imported blocklist"""
+    return user_id in BLOCKED_USERS or (BLOCKLIST is not None and user_id in BLOCKLIST)
+
+
+def load_blocklist():
+    global BLOCKLIST
+
+    if not os.path.exists(BLOCKLIST_FILE):
+        BLOCKLIST = None
+        return
+    try:
+        BLOCKLIST = BlocklistFile(BLOCKLIST_FILE)
     except Exception as e:
-        logger.error(f"❌ Owner check error: {e}")
-        return False
+        logger.error(f"Blocklist load failed: {e}")
 
 
-async def is_admin(update: Update) -> bool:
-    """Quick check if user is admin - for complete lockdown"""
-    if not update.effective_user:
-        return False
-    return update.effective_user.id == ADMIN_ID
+def _read_sorted_run(path: str):
+    """Yield the IDs of a sorted run file written by _import_blocklist"""
+    with open(path, 'rb') as f:
+        while True:
+            chunk = array('q')
+            chunk.frombytes(f.read(8 * 65536))
+            if not chunk:
+                return
+            yield from chunk
 
 
-async def ignore_non_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+def _import_blocklist(source_path: str) -> dict:
     """
-    Complete lockdown - ignore ALL non-admin interactions silently.
-    Returns True if should ignore (non-admin), False if admin.
+    Worker thread: merge the IDs in a TXT/CSV file (first number on each line)
+    into BLOCKLIST_FILE. Memory stays bounded: IDs are sorted in chunks of
+    BLOCKLIST_CHUNK into run files, then all runs and the current list are
+    merged in one streaming pass. Returns counts for the admin.
     """
-    if not update.effective_user:
-        return True  # Ignore
-
-    if update.effective_user.id != ADMIN_ID:
-        # Complete silence - no response, no logging for regular attempts
-        # Only log if they try commands (potential probe)
-        if update.message and update.message.text and update.message.text.startswith('/'):
-            logger.warning(f"🚫 Blocked command attempt from {update.effective_user.id}")
-        return True  # Ignore
+    # Merge with the stored list whenever the file exists, loaded or not - one
+    # that can't be read stops the import instead of being replaced
+    existing = None
+    if os.path.exists(BLOCKLIST_FILE):
+        try:
+            existing = BlocklistFile(BLOCKLIST_FILE)
+        except Exception as e:
+            raise ValueError(f"stored blocklist is unreadable ({e}) - "
+                             f"restore it or drop it with /clear_blocklist first") from e
 
-    return False  # Admin - proceed
+    work_dir = tempfile.mkdtemp(dir=STORAGE_DIR)
+    runs = []
+    lines = parsed = 0
 
+    def spill(chunk):
+        run_path = os.path.join(work_dir, f"run{len(runs)}")
+        with open(run_path, 'wb') as f:
+            array('q', sorted(set(chunk))).tofile(f)
+        runs.append(run_path)
 
-# ========== SMART JOIN REQUEST HANDLER ==========
-async def handle_join_request(update: Update,
-                              context: ContextTypes.DEFAULT_TYPE):
+    try:
+        chunk = []
+        with open(source_path, 'rb') as f:
+            for line in f:
+                lines += 1
+                match = BLOCKLIST_ID_PATTERN.search(line)
+                if match is None or len(match.group()) > 18:
+                    continue  # Header, blank or not an ID
+                user_id = int(match.group())
+                if user_id > 0:
+                    chunk.append(user_id)
+                    parsed += 1
+                    if len(chunk) >= BLOCKLIST_CHUNK:
+                        spill(chunk)
+                        chunk = []
+        if chunk:
+            spill(chunk)
+
+        sources = [_read_sorted_run(path) for path in runs]
+        previous = len(existing) if existing is not None else 0
+        if previous:
+            sources.append(iter(existing))
+
+        tmp_file = BLOCKLIST_FILE + '.tmp'
+        count = 0
+        with open(tmp_file, 'w+b') as out:
+            out.write(bytes(BLOCKLIST_HEADER.size))
+            buffer = array('q')
+            last = None
+            for user_id in heapq.merge(*sources):
+                if user_id != last:
+                    buffer.append(user_id)
+                    last = user_id
+                    if len(buffer) >= 65536:
+                        buffer.tofile(out)
+                        count += len(buffer)
+                        buffer = array('q')
+            buffer.tofile(out)
+            count += len(buffer)
+
+            # Bloom filter sized from the final count (second pass over the IDs)
+            bloom_bits = count * BLOCKLIST_BLOOM_BITS_PER_ID
+            bloom_hashes = max(1, round(BLOCKLIST_BLOOM_BITS_PER_ID * 0.693)) if bloom_bits else 0
+            if bloom_bits:
+                bloom = bytearray((bloom_bits + 7) // 8)
+                out.seek(BLOCKLIST_HEADER.size)
+                remaining = count
+                while remaining:
+                    ids = array('q')
+                    ids.frombytes(out.read(8 * min(remaining, 65536)))
+                    remaining -= len(ids)
+                    for user_id in ids:
+                        for bit in _bloom_positions(user_id, bloom_bits, bloom_hashes):
+                            bloom[bit >> 3] |= 1 << (bit & 7)
+                out.seek(0, os.SEEK_END)
+                out.write(bloom)
+
+            out.seek(0)
+            out.write(BLOCKLIST_HEADER.pack(BLOCKLIST_MAGIC, BLOCKLIST_VERSION,
+                                            count, bloom_bits, bloom_hashes))
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_file, BLOCKLIST_FILE)
+    finally:
+        for path in runs:
+            os.remove(path)
+        os.rmdir(work_dir)
+
+    return {'lines': lines, 'parsed': parsed, 'added': count - previous, 'total': count}
+
+
+# ========== ACTIVITY LOGS ==========
+class ActivityLog:
     """
-    Smart join request handler with 3-tier verification:
-    1. Auto-approve legitimate users
-    2. Auto-reject obvious bots/spammers + send fallback channel
-    3. Math captcha for borderline cases
+    Bounded history with one fixed-size ring (deque with maxlen) per entry type:
+    appends are O(1), the oldest entry of a type is dropped once its ring is
+    full, and "last N approved" reads only that type's ring.
     """
-    request = update.chat_join_request
-    user = request.from_user
-    chat_id = request.chat.id
 
-    # Only handle managed channels
-    if chat_id not in MANAGED_CHANNELS:
+    def __init__(self, capacity: int, type_field: str = None):
+        self.capacity = capacity
+        self.type_field = type_field  # None: a single ring for everything
+        self.buffers = {}  # {type: deque}
+        self.version = 0  # Bumped on every change, lets the spill job skip idle logs
+
+    def _buffer(self, kind) -> deque:
+        buffer = self.buffers.get(kind)
+        if buffer is None:
+            buffer = self.buffers[kind] = deque(maxlen=self.capacity)
+        return buffer
+
+    def append(self, entry: dict):
+        kind = entry.get(self.type_field) if self.type_field else None
+        self._buffer(kind).append(entry)
+        self.version += 1
+
+    def count(self, kind=None) -> int:
+        """Entries held for one type (or in total when the log has no types)"""
+        buffer = self.buffers.get(kind)
+        return len(buffer) if buffer is not None else 0
+
+    def last(self, n: int, kind=None) -> list:
+        """Newest n entries of a type, oldest first"""
+        buffer = self.buffers.get(kind)
+        if not buffer:
+            return []
+        newest = list(islice(reversed(buffer), n))
+        newest.reverse()
+        return newest
+
+    def __len__(self) -> int:
+        return sum(len(buffer) for buffer in self.buffers.values())
+
+    def __iter__(self):
+        """All entries, oldest first"""
+        return heapq.merge(*self.buffers.values(), key=lambda entry: entry['timestamp'])
+
+    def clear(self):
+        self.buffers = {}
+        self.version += 1
+
+    def drop_older(self, cutoff: datetime) -> list:
+        """Remove and return entries older than cutoff (each ring is in time order)"""
+        dropped = []
+        for buffer in self.buffers.values():
+            while buffer and buffer[0]['timestamp'] < cutoff:
+                dropped.append(buffer.popleft())
+        if dropped:
+            self.version += 1
+        return dropped
+
+    def dump(self) -> dict:
+        # list() of a deque / dict is a single C call - safe from the worker thread
+        return {kind: list(buffer) for kind, buffer in list(self.buffers.items())}
+
+    def restore(self, data: dict):
+        self.buffers = {}
+        for kind, entries in data.items():
+            self._buffer(kind).extend(entries)
+
+
+RECENT_ACTIVITY = ActivityLog(RECENT_ACTIVITY_CAPACITY, 'type')  # Approvals/rejections for batch viewing
+UNAUTHORIZED_ATTEMPTS = ActivityLog(UNAUTHORIZED_CAPACITY)
+ACTIVITY_SPILLED = None  # (recent, unauthorized) versions in the last spill
+
+
+def spill_activity():
+    """Worker thread: save both activity logs so they survive a restart"""
+    global ACTIVITY_SPILLED
+
+    versions = (RECENT_ACTIVITY.version, UNAUTHORIZED_ATTEMPTS.version)
+    if versions == ACTIVITY_SPILLED:
         return
+    payload = encode_snapshot({
+        'recent_activity': RECENT_ACTIVITY.dump(),
+        'unauthorized_attempts': UNAUTHORIZED_ATTEMPTS.dump()
+    })
+    tmp_file = ACTIVITY_FILE + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, ACTIVITY_FILE)
+    ACTIVITY_SPILLED = versions
+
+
+async def spill_activity_job():
+    """Periodic job: spill the activity logs from the worker thread"""
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(PERSIST_EXECUTOR, spill_activity)
+    except Exception as e:
+        logger.error(f"Activity spill failed: {e}")
 
-    # Always approve admin
-    if user.id == ADMIN_ID:
-        await request.approve()
-        logger.info(f"✅ Admin auto-approved: {user.id}")
-        return
 
-    # Block already blocked users
-    if user.id in BLOCKED_USERS:
-        await request.decline()
-        logger.info(f"❌ Blocked user {user.id} tried to join")
-        return
+def load_activity():
+    """Restore the activity logs spilled before the last shutdown"""
+    global ACTIVITY_SPILLED
 
-    # Check if bulk approval is enabled for this channel
-    if BULK_APPROVAL_MODE.get(chat_id, False):
-        await request.approve()
-        track_user_activity(user.id, chat_id, 'approved', {
-            'first_name': user.first_name,
-            'last_name': user.last_name or '',
-            'username': user.username or ''
-        })
-        logger.info(f"✅ Bulk-approved user: {user.id}")
+    if not os.path.exists(ACTIVITY_FILE):
         return
+    try:
+        with open(ACTIVITY_FILE, 'rb') as f:
+            data = decode_snapshot(f.read())
+        RECENT_ACTIVITY.restore(data.get('recent_activity', {}))
+        UNAUTHORIZED_ATTEMPTS.restore(data.get('unauthorized_attempts', {}))
+        ACTIVITY_SPILLED = (RECENT_ACTIVITY.version, UNAUTHORIZED_ATTEMPTS.version)
+    except Exception as e:
+        logger.error(f"Activity load failed: {e}")
 
-    # Smart verification - check legitimacy
-    legitimacy = await check_user_legitimacy(context, user.id)
 
-    # === TIER 1: AUTO-APPROVE LEGITIMATE USERS ===
-    if legitimacy['legitimate'] and legitimacy['score'] >= 100:
-        try:
-            await request.approve()
-            track_user_activity(user.id, chat_id, 'approved', {
-                'first_name': user.first_name,
-                'last_name': user.last_name or '',
-                'username': user.username or ''
-            })
+# ========== STORAGE BACKENDS ==========
+class StorageBackend:
+    """
+    Interface every storage backend implements. write(), compact() and close()
+    always run on PERSIST_EXECUTOR, one call at a time.
+    """
+    name = 'base'
 
-            # Log to recent activity instead of sending notification
-            RECENT_ACTIVITY.append({
-                'type': 'auto_approved',
-                'user_id': user.id,
-                'user_name': user.first_name,
-                'username': user.username or 'None',
-                'channel': MANAGED_CHANNELS[chat_id]['name'],
-                'channel_id': chat_id,
-                'timestamp': datetime.now()
-            })
+    def is_empty(self) -> bool:
+        raise NotImplementedError
 
-            logger.info(f"✅ Auto-approved legitimate user: {user.id}")
-            return
-        except Exception as e:
-            logger.error(f"Auto-approval failed: {e}")
+    def load(self):
+        """Install the stored state into the module-level globals"""
+        raise NotImplementedError
 
-    # === TIER 2: AUTO-REJECT + REDIRECT TO FALLBACK CHANNEL ===
-    if not legitimacy['legitimate'] and legitimacy['score'] == 0:
-        try:
-            await request.decline()
-
-            # NEW: Send fallback channel link to rejected user
-            if GLOBAL_FALLBACK_CHANNEL:
-                try:
-                    await context.bot.send_message(
-                        user.id,
-                        f"Your request to join was not approved.\n\n"
-                        f"You can join our public channel instead:\n"
-                        f"{GLOBAL_FALLBACK_CHANNEL}",
-                        disable_web_page_preview=True
-                    )
-                    logger.info(f"📤 Sent fallback channel to rejected user {user.id}")
-                except Exception as dm_error:
-                    # User might have blocked bot or never started it
-                    logger.warning(f"Could not DM user {user.id}: {dm_error}")
+    def write(self, records: list):
+        """Persist a batch of journal records (see persist_change)"""
+        raise NotImplementedError
 
-            # Log to recent activity
-            RECENT_ACTIVITY.append({
-                'type': 'auto_rejected',
+    def compact(self):
+        """Fold incremental writes into the base copy - optional"""
+
+    def close(self):
+        """Release files/connections - optional"""
+
+
+class JsonStorage(StorageBackend):
+    """
+    Sectioned JSON state files + append-only journal of records.
+
+    Each section (see STATE_SECTIONS) lives in STATE_DIR/<section>.snap (binary
+    codec) or <section>.json (SNAPSHOT_CODEC=json) with its own version and
+    journal_seq. With the binary codec the users section is a users.idx index
+    that is loaded lazily (see LAZY USER STORE). Compaction rewrites only the
+    sections that got journal records since the last compaction, so a join no
+    longer costs a rewrite of the media queues and links.
+    """
+    name = 'json'
+
+    def __init__(self, state_dir: str, legacy_file: str, journal_file: str,
+                 codec: str = 'binary'):
+        self.state_dir = state_dir
+        self.binary = codec == 'binary'
+        self.legacy_file = legacy_file  # Single bot_data.json from older versions
+        self.journal_file = journal_file
+        self.section_seq = {}  # {section: journal_seq its file covers}
+        self.section_version = {}  # {section: times the file was rewritten}
+        self.dirty = set()  # Sections changed since the last compaction
+        self.migrate_legacy = False
+
+    def _section_files(self, section: str) -> list:
+        """[(path, kind)] a section may be stored in - the first one is written"""
+        kinds = ['snap', 'json'] if self.binary else ['json', 'snap']
+        if section == 'users':
+            kinds.insert(0 if self.binary else 1, 'idx')
+        return [(os.path.join(self.state_dir, f"{section}.{kind}"), kind) for kind in kinds]
+
+    def _has_sections(self) -> bool:
+        return any(os.path.exists(path)
+                   for section in STATE_SECTIONS for path, _ in self._section_files(section))
+
+    def _read_section(self, section: str):
+        """Return the stored section (typed), preferring the configured codec's file"""
+        for position, (path, kind) in enumerate(self._section_files(section)):
+            if not os.path.exists(path):
+                continue
+            if position:
+                self.dirty.add(section)  # Rewrite it with the configured codec
+            if kind == 'idx':
+                index = UserIndexFile(path)
+                return dict(index.meta, data={'user_database': UserStore(index)})
+            if kind == 'snap':
+                with open(path, 'rb') as f:
+                    return decode_snapshot(f.read())
+            with open(path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+            stored['data'] = _decode_json_state(stored['data'])
+            return stored
+        return None
+
+    def is_empty(self) -> bool:
+        return not (self._has_sections() or os.path.exists(self.legacy_file)
+                    or os.path.exists(self.journal_file))
+
+    def load(self):
+        """Load the section files, then replay the journal tail on top of them"""
+        global JOURNAL_SEQ, JOURNAL_RECORDS
+
+        if self._has_sections():
+            data = {}
+            for section in STATE_SECTIONS:
+                stored = self._read_section(section)
+                if stored is None:
+                    continue
+                data.update(stored['data'])
+                self.section_seq[section] = stored.get('journal_seq', 0)
+                self.section_version[section] = stored.get('version', 0)
+            _apply_state(data, typed=True)
+        elif os.path.exists(self.legacy_file):
+            # Older single-file snapshot - split it into sections at the next compaction
+            with open(self.legacy_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            _apply_state(data)
+            legacy_seq = data.get('journal_seq', 0)
+            self.section_seq = {section: legacy_seq for section in STATE_SECTIONS}
+            self.dirty = set(STATE_SECTIONS)
+            self.migrate_legacy = True
+            logger.info(f"Loaded legacy {self.legacy_file}, will split it into {self.state_dir}")
+        else:
+            logger.info("No saved data")
+
+        JOURNAL_SEQ = max(self.section_seq.values(), default=0)
+        if os.path.exists(self.journal_file):
+            replayed = 0
+            with open(self.journal_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn write from a crash - everything after it is lost anyway
+                        logger.warning("⚠️ Journal tail is corrupt, stopping replay")
+                        break
+                    JOURNAL_SEQ = max(JOURNAL_SEQ, record['seq'])
+                    section = SECTION_OF_KEY.get(record['key'])
+                    # Sections are saved at different times, so each has its own cutoff
+                    if record['seq'] <= self.section_seq.get(section, 0):
+                        continue
+                    _replay_record(record)
+                    self.dirty.add(section)
+                    replayed += 1
+            JOURNAL_RECORDS = replayed
+            if replayed:
+                logger.info(f"✅ Replayed {replayed} journal records")
+
+    def write(self, records: list):
+        lines = ''.join(json.dumps(record, default=str) + '\n' for record in records)
+        with open(self.journal_file, 'a', encoding='utf-8') as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self.dirty.update(SECTION_OF_KEY.get(record['key']) for record in records)
+
+    def _write_section(self, section: str, journal_seq: int):
+        """Atomically replace one section file (temp file + rename)"""
+        version = self.section_version.get(section, 0) + 1
+        stored = {
+            'format': SECTION_FORMAT,
+            'section': section,
+            'version': version,
+            'journal_seq': journal_seq
+        }
+        (path, kind), *others = self._section_files(section)
+
+        if kind == 'idx':
+            store = USER_DATABASE
+            if not isinstance(store, UserStore):
+                # Replaced by a whole-key set - index it from now on
+                store = UserStore(records=USER_DATABASE)
+                globals()['USER_DATABASE'] = store
+            store.write_index(path, stored)
+        else:
+            stored['data'] = _collect_state(STATE_SECTIONS[section])
+            # One-shot C encoder: no Python code runs mid-encode, so the live dicts
+            # can't change under it
+            if kind == 'snap':
+                payload = encode_snapshot(stored)
+            else:
+                payload = json.dumps(stored, default=str).encode('utf-8')
+
+            tmp_file = path + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, path)
+
+        # Drop copies written by another codec so they can't shadow this one
+        for other_file, _ in others:
+            if os.path.exists(other_file):
+                os.remove(other_file)
+
+        self.section_seq[section] = journal_seq
+        self.section_version[section] = version
+
+    def compact(self):
+        # Every record written so far has seq <= journal_seq. Changes made while
+        # encoding may land in a section too; replaying them later is harmless.
+        journal_seq = JOURNAL_SEQ
+        dirty = self.dirty & set(STATE_SECTIONS)
+        self.dirty = set()
+        if not dirty and not self.migrate_legacy:
+            return
+
+        os.makedirs(self.state_dir, exist_ok=True)
+        for section in STATE_SECTIONS:
+            if section in dirty:
+                self._write_section(section, journal_seq)
+
+        # Every journal record belongs to a section that was just rewritten.
+        # Records of clean sections not flushed yet land in the new journal and
+        # still pass their (older) section cutoff on replay.
+        with open(self.journal_file, 'w', encoding='utf-8'):
+            pass
+
+        if self.migrate_legacy:
+            os.replace(self.legacy_file, self.legacy_file + '.migrated')
+            self.migrate_legacy = False
+            logger.info(f"✅ Split {self.legacy_file} into section files")
+
+        logger.info(f"💾 Rewrote sections: {', '.join(sorted(dirty))}")
+
+
+def create_storage(kind: str) -> StorageBackend:
+    """Build the backend selected by STORAGE_BACKEND"""
+    if kind == 'sqlite':
+        return SQLiteStorage(SQLITE_FILE)
+    if kind == 'supabase':
+        if not SUPABASE_URL or not SUPABASE_KEY:
+            raise ValueError("❌ SUPABASE_URL / SUPABASE_KEY not set! Add them in Railway Variables tab")
+        return SupabaseStorage(SUPABASE_URL, SUPABASE_KEY)
+    if kind != 'json':
+        raise ValueError(f"❌ Unknown STORAGE_BACKEND '{kind}' (use json, sqlite or supabase)")
+    if SNAPSHOT_CODEC not in ('binary', 'json'):
+        raise ValueError(f"❌ Unknown SNAPSHOT_CODEC '{SNAPSHOT_CODEC}' (use binary or json)")
+    return JsonStorage(STATE_DIR, STORAGE_FILE, JOURNAL_FILE, SNAPSHOT_CODEC)
+
+
+# ========== SQLITE STORAGE BACKEND ==========
+# Normalized tables instead of one JSON document: each journal record becomes a
+# handful of row upserts/deletes, so a join touches only that user's rows.
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    first_name TEXT,
+    last_name TEXT,
+    username TEXT
+);
+CREATE TABLE IF NOT EXISTS memberships (
+    user_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    channel_name TEXT,
+    status TEXT,
+    request_date TEXT,
+    approval_date TEXT,
+    PRIMARY KEY (user_id, channel_id)
+);
+CREATE INDEX IF NOT EXISTS idx_memberships_user ON memberships (user_id);
+CREATE INDEX IF NOT EXISTS idx_memberships_channel ON memberships (channel_id);
+CREATE INDEX IF NOT EXISTS idx_memberships_status ON memberships (status);
+CREATE TABLE IF NOT EXISTS channels (
+    channel_id INTEGER PRIMARY KEY,
+    name TEXT,
+    content_type TEXT,
+    bulk_mode INTEGER,
+    auto_post INTEGER,
+    caption TEXT,
+    interval_min INTEGER,
+    interval_max INTEGER
+);
+CREATE TABLE IF NOT EXISTS media (
+    kind TEXT NOT NULL,
+    channel_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    type TEXT,
+    file_id TEXT,
+    caption TEXT,
+    PRIMARY KEY (kind, channel_id, position)
+);
+CREATE INDEX IF NOT EXISTS idx_media_channel ON media (channel_id);
+CREATE TABLE IF NOT EXISTS links (
+    channel_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    url TEXT,
+    PRIMARY KEY (channel_id, position)
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT NOT NULL,
+    channel_id INTEGER NOT NULL,
+    value INTEGER,
+    PRIMARY KEY (name, channel_id)
+);
+CREATE TABLE IF NOT EXISTS blocked_users (
+    user_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT NOT NULL,
+    item TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (key, item)
+);
+"""
+
+# Primary key columns per table (used for upserts)
+TABLE_KEYS = {
+    'users': ('user_id',),
+    'memberships': ('user_id', 'channel_id'),
+    'channels': ('channel_id',),
+    'media': ('kind', 'channel_id', 'position'),
+    'links': ('channel_id', 'position'),
+    'counters': ('name', 'channel_id'),
+    'blocked_users': ('user_id',),
+    'kv': ('key', 'item')
+}
+
+# Per-channel settings stored as columns of the channels table
+CHANNEL_COLUMNS = {
+    'managed_channels': 'name',
+    'bulk_approval_mode': 'bulk_mode',
+    'auto_post_enabled': 'auto_post',
+    'channel_content_type': 'content_type',
+    'channel_default_captions': 'caption',
+    'channel_intervals': 'interval'  # interval_min + interval_max
+}
+COUNTER_KEYS = ['current_image_index', 'channel_link_index', 'post_counter']
+# Media lists -> media.kind (global images use channel_id 0, promos use position 1/2)
+MEDIA_KINDS = {
+    'channel_media_queue': 'queue',
+    'channel_specific_images': 'legacy',
+    'uploaded_images': 'global',
+    'promo_images': 'promo'
+}
+
+
+def _channel_columns(key: str, value) -> dict:
+    """Columns of the channels table that hold key's value (None clears them)"""
+    column = CHANNEL_COLUMNS[key]
+    if column == 'interval':
+        return {
+            'interval_min': value['min'] if value else None,
+            'interval_max': value['max'] if value else None
+        }
+    if column == 'name' and isinstance(value, dict):
+        value = value.get('name')
+    if column in ('bulk_mode', 'auto_post') and value is not None:
+        value = int(bool(value))  # INTEGER column on both SQLite and Postgres
+    return {column: value}
+
+
+def _media_row(kind: str, channel_id: int, position: int, media) -> dict:
+    """One media table row (legacy images may be bare file_id strings)"""
+    if not isinstance(media, dict):
+        media = {'type': 'photo', 'file_id': media, 'caption': ''}
+    return {
+        'kind': kind,
+        'channel_id': channel_id,
+        'position': position,
+        'type': media.get('type', 'photo'),
+        'file_id': media.get('file_id'),
+        'caption': media.get('caption', '')
+    }
+
+
+def _list_rows(key: str, channel_id: int, start: int, values: list) -> list:
+    """Upsert ops for list entries of a media or links key"""
+    if key == 'channel_links':
+        return [('upsert', 'links', {
+            'channel_id': channel_id,
+            'position': start + offset,
+            'url': url
+        }) for offset, url in enumerate(values)]
+    return [('upsert', 'media', _media_row(MEDIA_KINDS[key], channel_id, start + offset, media))
+            for offset, media in enumerate(values)]
+
+
+def _list_scope(key: str, channel_id=None) -> tuple:
+    """Table + match selecting all rows of one channel's list (or of the whole key)"""
+    if key == 'channel_links':
+        return 'links', ({} if channel_id is None else {'channel_id': channel_id})
+    match = {'kind': MEDIA_KINDS[key]}
+    if channel_id is not None:
+        match['channel_id'] = channel_id
+    return 'media', match
+
+
+def _user_rows(user_id: int, user: dict) -> list:
+    """Upsert ops for a user record and its channel memberships"""
+    ops = [('upsert', 'users', {
+        'user_id': user_id,
+        'first_name': user.get('first_name'),
+        'last_name': user.get('last_name'),
+        'username': user.get('username')
+    })]
+    for channel_id, membership in user.get('channels', {}).items():
+        ops.append(('upsert', 'memberships', {
+            'user_id': user_id,
+            'channel_id': channel_id,
+            'channel_name': membership.get('channel_name'),
+            'status': membership.get('status'),
+            'request_date': _date_text(membership.get('request_date')),
+            'approval_date': _date_text(membership.get('approval_date'))
+        }))
+    return ops
+
+
+def _date_text(value):
+    return None if value is None else str(value)
+
+
+def _parse_date(value):
+    """Dates are stored as text; hand them back as datetimes"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _expand_record(record: dict) -> list:
+    """Split a whole-key 'set' into clear + per-entry records so rows stay granular"""
+    key = record['key']
+    if record['op'] != 'set' or 'item' in record:
+        return [record]
+    value = record.get('value')
+    if key == 'blocked_users':
+        return [{'key': key, 'op': 'clear'}] + [
+            {'key': key, 'op': 'add', 'value': user_id} for user_id in value]
+    if key == 'uploaded_images':
+        return [{'key': key, 'op': 'clear'},
+                {'key': key, 'op': 'extend', 'value': list(value), 'index': 0}]
+    if isinstance(value, dict):
+        return [{'key': key, 'op': 'clear'}] + [
+            {'key': key, 'op': 'set', 'item': item, 'value': entry} for item, entry in value.items()]
+    return [record]
+
+
+def _record_row_ops(record: dict) -> list:
+    """
+    Translate one journal record into row operations:
+    ('upsert', table, row) / ('delete', table, match) / ('update', table, match, values)
+    """
+    key = record['key']
+    op = record['op']
+    item = record.get('item')
+    value = record.get('value')
+
+    if key == 'user_database':
+        if op == 'set':
+            return _user_rows(item, value)
+        if op == 'del':
+            return [('delete', 'memberships', {'user_id': item}),
+                    ('delete', 'users', {'user_id': item})]
+        if op == 'clear':
+            return [('delete', 'memberships', {}), ('delete', 'users', {})]
+
+    elif key in CHANNEL_COLUMNS:
+        if op == 'set':
+            return [('upsert', 'channels', {'channel_id': item, **_channel_columns(key, value)})]
+        if op == 'del':
+            return [('upsert', 'channels', {'channel_id': item, **_channel_columns(key, None)})]
+        if op == 'clear':
+            return [('update', 'channels', {}, _channel_columns(key, None))]
+
+    elif key in COUNTER_KEYS:
+        if op == 'set':
+            return [('upsert', 'counters', {'name': key, 'channel_id': item, 'value': value})]
+        if op == 'del':
+            return [('delete', 'counters', {'name': key, 'channel_id': item})]
+        if op == 'clear':
+            return [('delete', 'counters', {'name': key})]
+
+    elif key == 'blocked_users':
+        if op == 'add':
+            return [('upsert', 'blocked_users', {'user_id': value})]
+        if op == 'discard':
+            return [('delete', 'blocked_users', {'user_id': value})]
+        if op == 'clear':
+            return [('delete', 'blocked_users', {})]
+
+    elif key in MEDIA_KINDS or key == 'channel_links':
+        channel_id = 0 if key == 'uploaded_images' else item
+        if op == 'append':
+            return _list_rows(key, channel_id, record['index'], [value])
+        if op == 'extend':
+            return _list_rows(key, channel_id, record['index'], value)
+        if op == 'clear':
+            table, match = _list_scope(key)
+            return [('delete', table, match)]
+        table, match = _list_scope(key, channel_id)
+        ops = [('delete', table, match)]
+        if op == 'set' and key == 'promo_images':
+            for slot, media in value.items():
+                ops.append(('upsert', 'media', _media_row('promo', channel_id, int(slot[-1]), media)))
+        elif op == 'set':
+            ops.extend(_list_rows(key, channel_id, 0, value))
+        return ops
+
+    # Anything else (scalars, newer state) is kept as JSON in the kv table
+    if op == 'clear':
+        return [('delete', 'kv', {'key': key})]
+    if op == 'del':
+        return [('delete', 'kv', {'key': key, 'item': json.dumps(item)})]
+    if op != 'set':
+        # List/set ops on generic keys: store the container as it is now
+        value = _state_container(key, item)
+        if isinstance(value, set):
+            value = list(value)
+    return [('upsert', 'kv', {
+        'key': key,
+        'item': json.dumps(item),
+        'value': json.dumps(value, default=str)
+    })]
+
+
+def _state_from_rows(fetch) -> dict:
+    """Rebuild the snapshot dict from table rows; fetch(table) yields row dicts"""
+    data = {key: {} for key in STATE_GLOBALS}
+    data['uploaded_images'] = []
+    data['blocked_users'] = []
+
+    users = data['user_database']
+    for row in fetch('users'):
+        users[row['user_id']] = {
+            'first_name': row['first_name'],
+            'last_name': row['last_name'] or '',
+            'username': row['username'] or '',
+            'channels': {}
+        }
+    for row in fetch('memberships'):
+        user = users.get(row['user_id'])
+        if user is not None:
+            user['channels'][row['channel_id']] = {
+                'channel_name': row['channel_name'],
+                'status': row['status'],
+                'request_date': _parse_date(row['request_date']),
+                'approval_date': _parse_date(row['approval_date'])
+            }
+
+    for row in fetch('channels'):
+        channel_id = row['channel_id']
+        if row['name'] is not None:
+            data['managed_channels'][channel_id] = {'name': row['name']}
+        if row['bulk_mode'] is not None:
+            data['bulk_approval_mode'][channel_id] = bool(row['bulk_mode'])
+        if row['auto_post'] is not None:
+            data['auto_post_enabled'][channel_id] = bool(row['auto_post'])
+        if row['content_type'] is not None:
+            data['channel_content_type'][channel_id] = row['content_type']
+        if row['caption'] is not None:
+            data['channel_default_captions'][channel_id] = row['caption']
+        if row['interval_min'] is not None:
+            data['channel_intervals'][channel_id] = {
+                'min': row['interval_min'],
+                'max': row['interval_max']
+            }
+
+    for row in fetch('counters'):
+        data[row['name']][row['channel_id']] = row['value']
+
+    media_keys = {kind: key for key, kind in MEDIA_KINDS.items()}
+    for row in sorted(fetch('media'), key=lambda r: (r['kind'], r['channel_id'], r['position'])):
+        media = {'type': row['type'], 'file_id': row['file_id'], 'caption': row['caption'] or ''}
+        key = media_keys[row['kind']]
+        if key == 'uploaded_images':
+            data[key].append(media)
+        elif key == 'promo_images':
+            data[key].setdefault(row['channel_id'], {})[f"promo{row['position']}"] = media
+        else:
+            data[key].setdefault(row['channel_id'], []).append(media)
+
+    for row in sorted(fetch('links'), key=lambda r: (r['channel_id'], r['position'])):
+        data['channel_links'].setdefault(row['channel_id'], []).append(row['url'])
+
+    data['blocked_users'] = [row['user_id'] for row in fetch('blocked_users')]
+
+    for row in fetch('kv'):
+        item = json.loads(row['item'])
+        value = json.loads(row['value'])
+        if item is None:
+            data[row['key']] = value
+        else:
+            data.setdefault(row['key'], {})[item] = value
+
+    # Scalars that were never set keep their defaults
+    for key in ('default_caption', 'global_fallback_channel'):
+        if data[key] == {}:
+            data[key] = ""
+    return data
+
+
+class SQLiteStorage(StorageBackend):
+    """SQLite (WAL mode) store for the bot state - one transaction per flush"""
+    name = 'sqlite'
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SQLITE_SCHEMA)
+
+    def is_empty(self) -> bool:
+        for table in TABLE_KEYS:
+            if self.conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+                return False
+        return True
+
+    def _fetch(self, table: str):
+        return [dict(row) for row in self.conn.execute(f"SELECT * FROM {table}")]
+
+    def load(self):
+        _apply_state(_state_from_rows(self._fetch))
+
+    def _execute(self, row_op: tuple):
+        kind, table = row_op[0], row_op[1]
+        if kind == 'upsert':
+            row = row_op[2]
+            columns = list(row)
+            keys = TABLE_KEYS[table]
+            updates = [c for c in columns if c not in keys]
+            sql = (f"INSERT INTO {table} ({', '.join(columns)}) "
+                   f"VALUES ({', '.join('?' for _ in columns)}) "
+                   f"ON CONFLICT ({', '.join(keys)}) DO ")
+            sql += ("UPDATE SET " + ', '.join(f"{c} = excluded.{c}" for c in updates)
+                    if updates else "NOTHING")
+            self.conn.execute(sql, [row[c] for c in columns])
+        elif kind == 'delete':
+            match = row_op[2]
+            where = ' AND '.join(f"{c} = ?" for c in match) or '1'
+            self.conn.execute(f"DELETE FROM {table} WHERE {where}", list(match.values()))
+        elif kind == 'update':
+            match, values = row_op[2], row_op[3]
+            where = ' AND '.join(f"{c} = ?" for c in match) or '1'
+            sets = ', '.join(f"{c} = ?" for c in values)
+            self.conn.execute(f"UPDATE {table} SET {sets} WHERE {where}",
+                              list(values.values()) + list(match.values()))
+
+    def write(self, records: list):
+        """Apply a batch of journal records in a single transaction"""
+        with self.conn:
+            for record in records:
+                for expanded in _expand_record(record):
+                    for row_op in _record_row_ops(expanded):
+                        self._execute(row_op)
+
+    def compact(self):
+        # Rows are already current - just fold the WAL back into the database
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        self.conn.close()
+
+
+# ========== SUPABASE / POSTGREST STORAGE BACKEND ==========
+class SupabaseStorage(StorageBackend):
+    """
+    Supabase (or any PostgREST server) using the same tables as SQLiteStorage.
+    Row ops are grouped into batched upserts sent over one pooled HTTP client.
+    """
+    name = 'supabase'
+
+    def __init__(self, url: str, key: str, batch_size: int = SUPABASE_BATCH_SIZE):
+        if httpx is None:
+            raise ValueError("❌ httpx is not installed (pip install -r requirements.txt)")
+        self.batch_size = batch_size
+        self.client = httpx.Client(
+            base_url=url.rstrip('/') + '/rest/v1/',
+            headers={
+                'apikey': key,
+                'Authorization': f'Bearer {key}',
+                'Content-Type': 'application/json'
+            },
+            timeout=SUPABASE_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=SUPABASE_POOL_SIZE,
+                                max_keepalive_connections=SUPABASE_POOL_SIZE))
+        self.backlog = []  # Row ops of a failed write, re-sent before the next batch
+
+    def _request(self, method: str, table: str, **kwargs):
+        """One PostgREST call, retried with backoff on network and 5xx errors"""
+        for attempt in range(SUPABASE_RETRIES):
+            try:
+                response = self.client.request(method, table, **kwargs)
+                if response.status_code < 500 or attempt == SUPABASE_RETRIES - 1:
+                    break
+            except httpx.TransportError:
+                if attempt == SUPABASE_RETRIES - 1:
+                    raise
+            time.sleep(0.5 * 2 ** attempt)
+        response.raise_for_status()
+        return response
+
+    @staticmethod
+    def _filters(table: str, match: dict) -> dict:
+        if not match:
+            # PostgREST may refuse unfiltered DELETE/PATCH - match every row explicitly
+            return {TABLE_KEYS[table][0]: 'not.is.null'}
+        return {column: f"eq.{value}" for column, value in match.items()}
+
+    def _upsert(self, table: str, rows: list):
+        for start in range(0, len(rows), self.batch_size):
+            self._request(
+                'POST', table,
+                params={'on_conflict': ','.join(TABLE_KEYS[table])},
+                headers={'Prefer': 'resolution=merge-duplicates,return=minimal'},
+                json=rows[start:start + self.batch_size])
+
+    def _send(self, row_ops: list):
+        # Tables have no foreign keys, so ops on different tables commute: upserts
+        # are grouped per table + column set and only sent early when a delete or
+        # update on the same table needs them to land first
+        pending = {}  # {(table, columns): {primary_key: row}}
+
+        def send_table(table):
+            for group in [g for g in pending if g[0] == table]:
+                self._upsert(table, list(pending.pop(group).values()))
+
+        for row_op in row_ops:
+            kind, table = row_op[0], row_op[1]
+            if kind == 'upsert':
+                row = row_op[2]
+                primary_key = tuple(row[c] for c in TABLE_KEYS[table])
+                pending.setdefault((table, tuple(sorted(row))), {})[primary_key] = row
+                continue
+            send_table(table)
+            if kind == 'delete':
+                self._request('DELETE', table, params=self._filters(table, row_op[2]))
+            elif kind == 'update':
+                self._request('PATCH', table, params=self._filters(table, row_op[2]),
+                              json=row_op[3])
+
+        for table in {group[0] for group in pending}:
+            send_table(table)
+
+    def is_empty(self) -> bool:
+        for table in TABLE_KEYS:
+            if self._request('GET', table, params={'select': '*', 'limit': 1}).json():
+                return False
+        return True
+
+    def _fetch(self, table: str) -> list:
+        rows = []
+        order = ','.join(TABLE_KEYS[table])
+        while True:
+            page = self._request('GET', table, params={
+                'select': '*',
+                'order': order,
+                'limit': SUPABASE_PAGE_SIZE,
+                'offset': len(rows)
+            }).json()
+            rows.extend(page)
+            if len(page) < SUPABASE_PAGE_SIZE:
+                return rows
+
+    def load(self):
+        _apply_state(_state_from_rows(self._fetch))
+
+    def write(self, records: list):
+        row_ops = self.backlog + [
+            row_op
+            for record in records
+            for expanded in _expand_record(record)
+            for row_op in _record_row_ops(expanded)
+        ]
+        self.backlog = []
+        try:
+            self._send(row_ops)
+        except Exception:
+            # Replaying the whole sequence in order is safe - upserts/deletes are idempotent
+            self.backlog = row_ops
+            raise
+
+    def close(self):
+        self.client.close()
+
+
+def is_verified(user_id: int) -> bool:
+    return user_id in VERIFIED_USERS or user_id == ADMIN_ID
+
+
+async def is_bot_admin(context: ContextTypes.DEFAULT_TYPE,
+                       chat_id: int) -> bool:
+    try:
+        bot_member = await context.bot.get_chat_member(chat_id, context.bot.id)
+        return bot_member.status in [
+            ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER
+        ]
+    except:
+        return False
+
+
+def generate_verification_code() -> str:
+    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+
+
+# ========== NAME SCORING ==========
+USER_NUMBER_PATTERN = re.compile(r'^User\d+$', re.IGNORECASE)  # Typical bot pattern
+ASCII_ALNUM = frozenset(string.ascii_letters + string.digits)
+NAME_MAX_DIGIT_SHARE = 0.6  # More than 60% digits is suspicious
+
+
+def is_name_suspicious(name: str) -> bool:
+    """Check if name looks suspicious (bot-like)"""
+    if not name or len(name) < 2:
+        return True
+
+    if USER_NUMBER_PATTERN.match(name):
+        return True
+
+    # One pass: ASCII letters/digits (needs 2+) and digits of any script
+    alnum = digits = 0
+    for char in name:
+        if char in ASCII_ALNUM:
+            alnum += 1
+        if char.isdecimal():
+            digits += 1
+    return alnum < 2 or digits > len(name) * NAME_MAX_DIGIT_SHARE
+
+
+def score_names(names: list) -> list:
+    """
+    is_name_suspicious() for a whole list of names in one call. With NumPy
+    installed all names are classified as one code-point array; without it
+    this falls back to the per-name check. Same results either way.
+    """
+    if np is None or not names:
+        return [is_name_suspicious(name) for name in names]
+
+    names = [name or '' for name in names]
+    lengths = np.fromiter((len(name) for name in names), dtype=np.int64, count=len(names))
+    codes = np.frombuffer(''.join(names).encode('utf-32-le'), dtype=np.uint32)
+    owner = np.repeat(np.arange(len(names)), lengths)
+
+    ascii_digit = (codes >= 48) & (codes <= 57)
+    lower = codes | 32  # ASCII upper -> lower case
+    alnum = ascii_digit | ((lower >= 97) & (lower <= 122))
+    digit = ascii_digit
+    other = np.unique(codes[codes > 127])
+    if other.size:
+        # Digits of other scripts: classify each distinct code point once
+        decimal = np.fromiter((chr(code).isdecimal() for code in other.tolist()), dtype=bool, count=other.size)
+        if decimal.any():
+            digit = digit | np.isin(codes, other[decimal])
+
+    alnum_counts = np.bincount(owner, weights=alnum, minlength=len(names))
+    digit_counts = np.bincount(owner, weights=digit, minlength=len(names))
+    suspicious = (lengths < 2) | (alnum_counts < 2) | (digit_counts > lengths * NAME_MAX_DIGIT_SHARE)
+    return [bool(flag) or USER_NUMBER_PATTERN.match(name) is not None
+            for flag, name in zip(suspicious.tolist(), names)]
+
+
+def _rescore_user_names(users, pending_ids: set) -> dict:
+    """Worker thread: run score_names() over (user_id, user) pairs and count the pending ones"""
+    started = time.monotonic()
+    user_ids, names = [], []
+    for user_id, user in users:
+        user_ids.append(user_id)
+        names.append(user.get('first_name'))
+    flags = score_names(names)
+    flagged = {user_id for user_id, flag in zip(user_ids, flags) if flag}
+    return {
+        'scanned': len(user_ids),
+        'flagged': len(flagged),
+        'pending_flagged': len(pending_ids & flagged),
+        'seconds': time.monotonic() - started
+    }
+
+
+# ========== LEGITIMACY CACHE ==========
+class TTLCache:
+    """LRU cache whose entries also expire after ttl seconds, with hit/miss counters"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # {key: (expires_at, value)}, least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is not None:
+            # Wall clock, so expiry still holds for entries restored after a restart
+            if entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.entries[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self.entries[key] = (time.time() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        self.entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def summary(self) -> str:
+        lookups = self.hits + self.misses
+        rate = f"{self.hits * 100 // lookups}%" if lookups else "n/a"
+        return f"{self.hits} hits / {self.misses} misses ({rate}), {len(self.entries)} cached"
+
+    def dump(self) -> list:
+        now = time.time()
+        # list() first: one C call, so the loop can't change the dict mid-walk
+        return [(key, expires_at, value)
+                for key, (expires_at, value) in list(self.entries.items()) if expires_at > now]
+
+    def restore(self, entries: list):
+        now = time.time()
+        for key, expires_at, value in entries:
+            if expires_at > now:
+                self.entries[key] = (expires_at, value)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+# Profile-photo facts per user and verdicts per (user, policy)
+PROFILE_CACHE = TTLCache(LEGITIMACY_CACHE_SIZE, LEGITIMACY_CACHE_TTL_MINUTES * 60)
+VERDICT_CACHE = TTLCache(LEGITIMACY_CACHE_SIZE, LEGITIMACY_CACHE_TTL_MINUTES * 60)
+
+
+def save_cache():
+    """Worker thread: keep the caches warm across a restart"""
+    if not CACHE_WARM_START:
+        return
+    payload = encode_snapshot({
+        'profiles': PROFILE_CACHE.dump(),
+        'verdicts': VERDICT_CACHE.dump()
+    })
+    tmp_file = CACHE_FILE + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(payload)
+    os.replace(tmp_file, CACHE_FILE)
+
+
+def load_cache():
+    """Restore cache entries saved at the last shutdown that haven't expired yet"""
+    if not CACHE_WARM_START or not os.path.exists(CACHE_FILE):
+        return
+    try:
+        with open(CACHE_FILE, 'rb') as f:
+            data = decode_snapshot(f.read())
+        PROFILE_CACHE.restore(data.get('profiles', []))
+        VERDICT_CACHE.restore(data.get('verdicts', []))
+    except Exception as e:
+        logger.warning(f"⚠️ Cache warm start skipped: {e}")
+
+
+# ========== ACCOUNT AGE ESTIMATE ==========
+# Telegram does not expose account creation dates, but user IDs are handed out
+# in increasing order, so a sorted table of (user ID, registration date) anchor
+# points dates any ID by bisect + linear interpolation - no API call.
+
+# Built-in anchors (coarse public observations); /refresh_ages adds our own
+ACCOUNT_ID_ANCHORS = [
+    (0, datetime(2013, 8, 14)),
+    (100_000_000, datetime(2015, 6, 1)),
+    (300_000_000, datetime(2016, 12, 1)),
+    (500_000_000, datetime(2018, 1, 1)),
+    (1_000_000_000, datetime(2019, 11, 1)),
+    (1_500_000_000, datetime(2020, 12, 1)),
+    (2_000_000_000, datetime(2021, 7, 1)),
+    (5_000_000_000, datetime(2021, 12, 1)),
+    (5_500_000_000, datetime(2022, 6, 1)),
+    (6_000_000_000, datetime(2023, 1, 1)),
+    (6_500_000_000, datetime(2023, 10, 1)),
+    (7_000_000_000, datetime(2024, 5, 1)),
+    (7_500_000_000, datetime(2024, 12, 1)),
+    (8_000_000_000, datetime(2025, 6, 1))
+]
+
+
+class AccountAgeTable:
+    """
+    Anchor table as two parallel arrays (8-byte IDs, 4-byte day ordinals) - a
+    few KB even with hundreds of anchors. Dates never decrease with the ID.
+
+    Optional bounds (same layout) are first-seen dates of IDs we observed: an
+    ID can't have registered after the first join request of any ID at or
+    above it. They only cap the interpolated estimate and are never
+    interpolated or extrapolated themselves.
+    """
+
+    def __init__(self, ids: array, days: array, bound_ids: array = None, bound_days: array = None):
+        self.ids = ids
+        self.days = days
+        self.bound_ids = bound_ids if bound_ids is not None else array('q')
+        self.bound_days = bound_days if bound_days is not None else array('i')
+
+    @staticmethod
+    def _rising(pairs) -> tuple:
+        """(ids, days) arrays of (user_id, datetime) pairs, forcing dates to rise with the ID"""
+        pairs = sorted(pairs)
+        ids, days = array('q'), array('i')
+        # A later ID cannot be older: clamp each date to the earliest one after it
+        latest = None
+        for user_id, registered in reversed(pairs):
+            day = registered.toordinal()
+            latest = day if latest is None else min(latest, day)
+            ids.append(user_id)
+            days.append(latest)
+        ids.reverse()
+        days.reverse()
+        return ids, days
+
+    @classmethod
+    def from_anchors(cls, anchors, observed=()) -> 'AccountAgeTable':
+        """Build from (user_id, datetime) anchors and (user_id, first seen) observations"""
+        return cls(*cls._rising(anchors), *cls._rising(observed))
+
+    def registered(self, user_id: int) -> float:
+        """Estimated registration day ordinal of user_id"""
+        last = len(self.ids) - 1
+        # Past the newest anchor: extend the last segment's growth rate
+        high = min(max(bisect.bisect_right(self.ids, user_id), 1), last)
+        low = high - 1
+        if self.ids[high] == self.ids[low]:
+            estimate = self.days[high]
+        else:
+            fraction = (user_id - self.ids[low]) / (self.ids[high] - self.ids[low])
+            estimate = self.days[low] + (self.days[high] - self.days[low]) * fraction
+        # Capped by the nearest observed ID at or above it
+        index = bisect.bisect_left(self.bound_ids, user_id)
+        if index < len(self.bound_ids):
+            return min(estimate, self.bound_days[index])
+        return estimate
+
+    def age_days(self, user_id: int) -> float:
+        return max(0.0, datetime.now().toordinal() - self.registered(user_id))
+
+    def anchors(self) -> list:
+        return [(user_id, datetime.fromordinal(day)) for user_id, day in zip(self.ids, self.days)]
+
+    def bounds(self) -> list:
+        return [(user_id, datetime.fromordinal(day)) for user_id, day in zip(self.bound_ids, self.bound_days)]
+
+    def dump(self) -> dict:
+        return {'ids': self.ids.tobytes(), 'days': self.days.tobytes(),
+                'bound_ids': self.bound_ids.tobytes(), 'bound_days': self.bound_days.tobytes()}
+
+    @classmethod
+    def restore(cls, data: dict) -> 'AccountAgeTable':
+        arrays = []
+        for key, typecode in (('ids', 'q'), ('days', 'i'), ('bound_ids', 'q'), ('bound_days', 'i')):
+            values = array(typecode)
+            values.frombytes(data[key])
+            arrays.append(values)
+        ids, days, bound_ids, bound_days = arrays
+        if len(ids) != len(days) or len(ids) < 2 or len(bound_ids) != len(bound_days):
+            raise ValueError("Corrupt account age table")
+        return cls(ids, days, bound_ids, bound_days)
+
+
+ACCOUNT_AGES = AccountAgeTable.from_anchors(ACCOUNT_ID_ANCHORS)
+
+
+def estimate_account_age_days(user_id: int) -> float:
+    """Estimated account age in days (no API call)"""
+    return ACCOUNT_AGES.age_days(user_id)
+
+
+def _observed_anchors(first_requests) -> list:
+    """
+    (user_id, latest possible registration) from (user_id, request dates)
+    pairs: an account exists before its first join request here, and so does
+    every lower ID. Thinned to ACCOUNT_AGE_MAX_ANCHORS points spread evenly
+    over the IDs seen (every point is still a valid bound, just a looser one).
+    """
+    first_seen = sorted((user_id, min(dates)) for user_id, dates in first_requests if dates)
+
+    bounds = []
+    latest = None
+    for user_id, seen in reversed(first_seen):
+        latest = seen if latest is None else min(latest, seen)
+        bounds.append((user_id, latest))
+    bounds.reverse()
+
+    if len(bounds) <= ACCOUNT_AGE_MAX_ANCHORS:
+        return bounds
+    step = (len(bounds) - 1) / (ACCOUNT_AGE_MAX_ANCHORS - 1)
+    return [bounds[round(index * step)] for index in range(ACCOUNT_AGE_MAX_ANCHORS)]
+
+
+def refresh_account_ages(first_requests) -> dict:
+    """
+    Worker thread: turn our first-seen observations into upper bounds on the
+    built-in estimates and save the table. A bound only applies to IDs at or
+    below an observed one, which provably existed by then; newer IDs keep the
+    built-in estimate (extrapolated with the built-in slope), so our own data
+    can never make a brand-new account look old.
+    """
+    global ACCOUNT_AGES
+
+    observed = _observed_anchors(first_requests)
+    table = AccountAgeTable.from_anchors(ACCOUNT_ID_ANCHORS, observed)
+
+    tmp_file = ACCOUNT_AGE_FILE + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(encode_snapshot(table.dump()))
+    os.replace(tmp_file, ACCOUNT_AGE_FILE)
+    ACCOUNT_AGES = table
+    return {'observed': len(observed), 'anchors': len(table.ids)}
+
+
+def load_account_ages():
+    """Use the table saved by the last /refresh_ages, if any"""
+    global ACCOUNT_AGES
+
+    if not os.path.exists(ACCOUNT_AGE_FILE):
+        return
+    try:
+        with open(ACCOUNT_AGE_FILE, 'rb') as f:
+            ACCOUNT_AGES = AccountAgeTable.restore(decode_snapshot(f.read()))
+    except Exception as e:
+        logger.warning(f"⚠️ Account age table skipped, using built-in anchors: {e}")
+
+
+# ========== VERIFICATION POLICY ==========
+# A policy scores a join request from weighted rules:
+# {'rules': {rule: weight}, 'base': points, 'approve': threshold, 'reject': threshold,
+#  'languages': [codes for the language rule], 'min_age_days': for the age rule}
+# Score >= approve: auto-approve; >= reject: captcha; below: auto-reject.
+# Channels without an entry in VERIFICATION_POLICIES use default_policy().
+
+def _rule_name(profile: dict, policy: dict):
+    return bool(profile['first_name']) and not is_name_suspicious(profile['first_name'])
+
+
+def _rule_username(profile: dict, policy: dict):
+    return bool(profile['username'])
+
+
+def _rule_premium(profile: dict, policy: dict):
+    return bool(profile.get('is_premium'))
+
+
+def _rule_language(profile: dict, policy: dict):
+    language = (profile.get('language_code') or '').split('-')[0].lower()
+    return language in policy.get('languages', ())
+
+
+def _rule_age(profile: dict, policy: dict):
+    return estimate_account_age_days(profile['user_id']) >= policy.get('min_age_days', MIN_ACCOUNT_AGE_DAYS)
+
+
+def _rule_photo(profile: dict, policy: dict):
+    return profile['has_photo']  # None: could not be checked
+
+
+# Rule -> (check(profile, policy), reason if not met, reason if met, needs a Bot API call)
+# The reason shown is the one that cost points (positive weight unmet / negative weight met)
+POLICY_RULES = {
+    'name': (_rule_name, "Suspicious name", "Real name", False),
+    'username': (_rule_username, "No username", "Has username", False),
+    'premium': (_rule_premium, "Not premium", "Premium", False),
+    'language': (_rule_language, "Other language", "Listed language", False),
+    'age': (_rule_age, "New account", "Old account", False),
+    'photo': (_rule_photo, "No profile photo", "Has profile photo", True)
+}
+POLICY_SETTINGS = ('base', 'approve', 'reject', 'min_age_days')
+
+
+def default_policy() -> dict:
+    """The built-in 40/30/30 policy (photo points are free unless REQUIRE_PROFILE_PHOTO)"""
+    return {
+        'rules': {'name': 40, 'username': 30, 'photo': 30 if REQUIRE_PROFILE_PHOTO else 0},
+        'base': 0 if REQUIRE_PROFILE_PHOTO else 30,
+        'approve': 70,
+        'reject': 30
+    }
+
+
+class CompiledPolicy:
+    """
+    A policy flattened into an ordered step list: cheap rules first (largest
+    weight first), Bot API rules last. Evaluation stops as soon as the rules
+    left cannot move the score into another band, so expensive rules only run
+    when the cheap ones leave the outcome open.
+    """
+
+    def __init__(self, policy: dict):
+        self.policy = policy
+        self.base = policy.get('base', 0)
+        self.approve = policy['approve']
+        self.reject = policy['reject']
+
+        rules = [(name, weight) for name, weight in policy['rules'].items() if weight]
+        rules.sort(key=lambda rule: (POLICY_RULES[rule[0]][3], -abs(rule[1])))
+
+        # Each step carries the most the remaining steps (itself included) can add/remove
+        self.steps = []
+        gain = loss = 0
+        for name, weight in reversed(rules):
+            check, unmet, met, expensive = POLICY_RULES[name]
+            gain += max(weight, 0)
+            loss += min(weight, 0)
+            self.steps.append((check, weight, unmet if weight > 0 else met, expensive, gain, loss))
+        self.steps.reverse()
+
+    def _band(self, score: int) -> int:
+        return 2 if score >= self.approve else 1 if score >= self.reject else 0
+
+    async def evaluate(self, profile: dict, bot=None) -> tuple:
+        """
+        Score profile; returns (verdict, complete). Expensive facts are fetched
+        with bot (skipped when bot is None). complete is False when a needed
+        fact could not be checked, so the verdict should not be cached.
+        """
+        if profile['type'] == 'bot':
+            return {"legitimate": False, "reason": "Bot account", "score": 0}, True
+
+        score = self.base
+        reasons = []
+        complete = True
+        for check, weight, reason, expensive, gain, loss in self.steps:
+            if self._band(score + loss) == self._band(score + gain):
+                break  # Decided - nothing left can change the outcome
+            if expensive and profile['has_photo'] is None and bot is not None:
+                profile['has_photo'] = await fetch_profile_photo(bot, profile['user_id'])
+            met = check(profile, self.policy)
+            if met is None:
+                complete = False
+                reasons.append("Cannot check photo")
+            elif met:
+                score += weight
+                if weight < 0:
+                    reasons.append(reason)
+            elif weight > 0:
+                reasons.append(reason)
+
+        band = self._band(score)
+        if band == 2:
+            return {"legitimate": True, "score": 100}, complete
+        return {"legitimate": False, "score": 50 if band else 0, "reason": ", ".join(reasons)}, complete
+
+
+COMPILED_POLICIES = {}  # {channel_id or None (default): CompiledPolicy}
+POLICY_GENERATIONS = {}  # {channel_id: edits so far} - lookups from before an edit don't cache
+
+
+def compiled_policy(policy_key) -> CompiledPolicy:
+    """The compiled policy for a channel ID, or the default one for None"""
+    compiled = COMPILED_POLICIES.get(policy_key)
+    if compiled is None:
+        policy = VERIFICATION_POLICIES[policy_key] if policy_key is not None else default_policy()
+        compiled = COMPILED_POLICIES[policy_key] = CompiledPolicy(policy)
+    return compiled
+
+
+def invalidate_policy(channel_id: int):
+    """After a channel's policy changes: drop its compiled form, cached verdicts and shared lookups"""
+    COMPILED_POLICIES.pop(channel_id, None)
+    POLICY_GENERATIONS[channel_id] = POLICY_GENERATIONS.get(channel_id, 0) + 1
+    for key in [key for key in VERDICT_CACHE.entries if key[1] == channel_id]:
+        del VERDICT_CACHE.entries[key]
+    for key in [key for key in LEGITIMACY_IN_FLIGHT if key[1] == channel_id]:
+        del LEGITIMACY_IN_FLIGHT[key]  # Still finishes for its callers, but new checks start fresh
+
+
+def describe_policy(policy: dict) -> str:
+    rules = ', '.join(f"{name} {weight:+d}" for name, weight in policy['rules'].items() if weight)
+    text = (f"Rules: {rules or 'none'}\n"
+            f"Base: {policy.get('base', 0)} | Approve ≥{policy['approve']} | Reject <{policy['reject']}")
+    if policy['rules'].get('language'):
+        text += f"\nLanguages: {', '.join(policy.get('languages', [])) or 'none'}"
+    if policy['rules'].get('age'):
+        text += f"\nMin age: {policy.get('min_age_days', MIN_ACCOUNT_AGE_DAYS)} days"
+    return text
+
+
+def local_profile(user) -> dict:
+    """The facts policies score, taken from the join request's from_user (no API call)"""
+    return {
+        'user_id': user.id,
+        'type': 'bot' if user.is_bot else 'private',
+        'first_name': user.first_name,
+        'username': user.username,
+        'is_premium': bool(getattr(user, 'is_premium', False)),
+        'language_code': getattr(user, 'language_code', None),
+        'has_photo': None
+    }
+
+
+async def fetch_profile_photo(bot, user_id: int):
+    """Whether the user has a profile photo, from PROFILE_CACHE or the Bot API (None on error)"""
+    profile = PROFILE_CACHE.get(user_id)
+    if profile is not None and profile.get('has_photo') is not None:
+        return profile['has_photo']
+    try:
+        photos = await bot.get_user_profile_photos(user_id, limit=1)
+    except Exception as e:
+        logger.warning(f"Profile photo check failed for {user_id}: {e}")
+        return None
+    PROFILE_CACHE.put(user_id, {'has_photo': photos.total_count > 0})
+    return photos.total_count > 0
+
+
+LEGITIMACY_IN_FLIGHT = {}  # {(user_id, policy_key): Task} - lookups other checks can join
+
+
+async def check_user_legitimacy(context: ContextTypes.DEFAULT_TYPE,
+                                user, chat_id: int, offline: bool = False) -> dict:
+    """
+    Score a join request's user under the channel's verification policy.
+    Returns: {"legitimate": bool, "score": int, "reason": str}
+    Repeat checks inside LEGITIMACY_CACHE_TTL_MINUTES need no Bot API call, and
+    concurrent checks for the same user and policy share one lookup.
+    offline=True never calls the Bot API (rules needing it count as unmet).
+    """
+    policy_key = chat_id if chat_id in VERIFICATION_POLICIES else None
+    key = (user.id, policy_key)
+    verdict = VERDICT_CACHE.get(key)
+    if verdict is not None:
+        return verdict
+    if offline:
+        verdict, _ = await compiled_policy(policy_key).evaluate(local_profile(user))
+        return verdict
+
+    task = LEGITIMACY_IN_FLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_lookup_legitimacy(context.bot, user, policy_key))
+        LEGITIMACY_IN_FLIGHT[key] = task
+        task.add_done_callback(
+            lambda done: LEGITIMACY_IN_FLIGHT.pop(key) if LEGITIMACY_IN_FLIGHT.get(key) is done else None)
+    # Shielded: one cancelled join handler must not cancel the others' lookup
+    return await asyncio.shield(task)
+
+
+async def _lookup_legitimacy(bot, user, policy_key) -> dict:
+    """Evaluate one user; never raises (errors become a reject verdict)"""
+    generation = POLICY_GENERATIONS.get(policy_key)
+    try:
+        verdict, complete = await compiled_policy(policy_key).evaluate(local_profile(user), bot)
+    except Exception as e:
+        logger.error(f"Legitimacy check failed: {e}")
+        return {"legitimate": False, "reason": "Error checking user", "score": 0}
+
+    # Incomplete verdicts (photo check failed) aren't cached, so the next check retries.
+    # Neither are verdicts of a policy edited while this lookup ran.
+    if complete and POLICY_GENERATIONS.get(policy_key) == generation:
+        VERDICT_CACHE.put((user.id, policy_key), verdict)
+    return verdict
+
+
+def track_user_activity(user_id: int,
+                        channel_id: int,
+                        action: str,
+                        user_data: dict = None):
+    """Track user activity in database"""
+    user_data = user_data or {}
+    if user_id not in USER_DATABASE:
+        USER_DATABASE[user_id] = {
+            'first_name': user_data.get('first_name', 'Unknown'),
+            'last_name': user_data.get('last_name', ''),
+            'username': user_data.get('username', ''),
+            'channels': {}
+        }
+    if channel_id not in USER_DATABASE[user_id]['channels']:
+        USER_DATABASE[user_id]['channels'][channel_id] = {
+            'channel_name':
+            MANAGED_CHANNELS.get(channel_id, {}).get('name', 'Unknown'),
+            'status':
+            action,
+            'request_date':
+            datetime.now(),
+            'approval_date':
+            None
+        }
+    else:
+        USER_DATABASE[user_id]['channels'][channel_id]['status'] = action
+        if action == 'approved':
+            USER_DATABASE[user_id]['channels'][channel_id][
+                'approval_date'] = datetime.now()
+    persist_change('user_database', 'set', user_id, USER_DATABASE[user_id])
+
+
+async def alert_owner_unauthorized_access(context: ContextTypes.DEFAULT_TYPE,
+                                          user_id: int, username: str,
+                                          first_name: str, command: str):
+    """Alert owner of unauthorized access attempts"""
+    try:
+        UNAUTHORIZED_ATTEMPTS.append({
+            'user_id': user_id,
+            'username': username,
+            'first_name': first_name,
+            'command': command,
+            'timestamp': datetime.now()
+        })
+
+        await context.bot.send_message(
+            ADMIN_ID,
+            f"🚨 *Unauthorized Access Attempt*\n\n"
+            f"User: {first_name}\n"
+            f"ID: `{user_id}`\n"
+            f"Username: @{username or 'None'}\n"
+            f"Command: `{command}`",
+            parse_mode='Markdown')
+    except Exception as e:
+        logger.error(f"Alert failed: {e}")
+
+
+async def owner_only_check(update: Update,
+                           context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Check if user is the owner"""
+    try:
+        if not update.effective_user or update.effective_user.id != ADMIN_ID:
+            if update.effective_user:
+                await alert_owner_unauthorized_access(context, update.effective_user.id,
+                                                      update.effective_user.username or "None",
+                                                      update.effective_user.first_name or "Unknown",
+                                                      update.message.text if update.message else "callback")
+            if update.message:
+                await update.message.reply_text("❌ Unauthorized")
+            return False
+        logger.info(f"✅ Owner check passed for user {update.effective_user.id}")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Owner check error: {e}")
+        return False
+
+
+async def is_admin(update: Update) -> bool:
+    """Quick check if user is admin - for complete lockdown"""
+    if not update.effective_user:
+        return False
+    return update.effective_user.id == ADMIN_ID
+
+
+async def ignore_non_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """
+    Complete lockdown - ignore ALL non-admin interactions silently.
+    Returns True if should ignore (non-admin), False if admin.
+    """
+    if not update.effective_user:
+        return True  # Ignore
+
+    if update.effective_user.id != ADMIN_ID:
+        # Complete silence - no response, no logging for regular attempts
+        # Only log if they try commands (potential probe)
+        if update.message and update.message.text and update.message.text.startswith('/'):
+            logger.warning(f"🚫 Blocked command attempt from {update.effective_user.id}")
+        return True  # Ignore
+
+    return False  # Admin - proceed
+
+
+# ========== RETENTION / ARCHIVE ==========
+# Users and activity past their retention move to gzip JSON-lines cold files in
+# ARCHIVE_DIR, partitioned by date (users-YYYY-MM by last seen, activity-YYYY-MM-DD),
+# so the hot USER_DATABASE and its snapshot stop growing forever.
+def _last_seen(user: dict):
+    """Latest request/approval date across the user's channels (None if unknown)"""
+    dates = [membership.get(field)
+             for membership in user.get('channels', {}).values()
+             for field in ('request_date', 'approval_date')]
+    return max((date for date in dates if isinstance(date, datetime)), default=None)
+
+
+def retention_reason(user: dict, now: datetime):
+    """Name of the retention policy that archives this user, or None to keep it"""
+    last_seen = _last_seen(user)
+    if last_seen is None:
+        return None
+
+    age = now - last_seen
+    approved = any(membership.get('status') == 'approved'
+                   for membership in user.get('channels', {}).values())
+    if ARCHIVE_PENDING_DAYS and not approved and age > timedelta(days=ARCHIVE_PENDING_DAYS):
+        return 'stale_pending'
+    if ARCHIVE_INACTIVE_DAYS and age > timedelta(days=ARCHIVE_INACTIVE_DAYS):
+        return 'inactive'
+    return None
+
+
+def _append_archive(kind: str, partitions: dict):
+    """Append rows to the cold file of each partition (one new gzip member per call)"""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    for partition, rows in partitions.items():
+        payload = ''.join(json.dumps(row, default=str) + '\n' for row in rows)
+        path = os.path.join(ARCHIVE_DIR, f"{kind}-{partition}.jsonl.gz")
+        with open(path, 'ab') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='ab') as f:
+                f.write(payload.encode('utf-8'))
+            # Hot copies are dropped right after this returns
+            raw.flush()
+            os.fsync(raw.fileno())
+
+
+async def _retention_candidates(now: datetime) -> list:
+    """
+    Event loop: (user_id, reason, copy of the record) for every user past
+    retention. Runs in slices of ARCHIVE_SCAN_CHUNK users so joins keep being
+    handled, and copies the records so the worker never walks live dicts.
+    """
+    if isinstance(USER_DATABASE, UserStore):
+        users = USER_DATABASE.items()  # Decodes lazily
+    else:
+        users = iter(list(USER_DATABASE.items()))
+
+    candidates = []
+    while True:
+        chunk = list(islice(users, ARCHIVE_SCAN_CHUNK))
+        if not chunk:
+            return candidates
+        for user_id, user in chunk:
+            reason = retention_reason(user, now)
+            if reason is not None:
+                candidates.append((user_id, reason, dict(user, channels={
+                    chat_id: dict(membership) for chat_id, membership in user.get('channels', {}).items()})))
+        await asyncio.sleep(0)
+
+
+def _archive_users(candidates: list, now: datetime) -> list:
+    """Worker thread: write the users picked by _retention_candidates to the cold files, return their IDs"""
+    partitions = {}
+    for user_id, reason, user in candidates:
+        partitions.setdefault(_last_seen(user).strftime('%Y-%m'), []).append({
+            'user_id': user_id,
+            'reason': reason,
+            'archived_at': now,
+            'user': user
+        })
+    _append_archive('users', partitions)
+    return [user_id for user_id, _, _ in candidates]
+
+
+def archive_activity(now: datetime) -> int:
+    """Move RECENT_ACTIVITY entries older than ARCHIVE_ACTIVITY_DAYS to the cold files"""
+    if not ARCHIVE_ACTIVITY_DAYS:
+        return 0
+    old = RECENT_ACTIVITY.drop_older(now - timedelta(days=ARCHIVE_ACTIVITY_DAYS))
+    if not old:
+        return 0
+
+    partitions = {}
+    for activity in old:
+        partitions.setdefault(activity['timestamp'].strftime('%Y-%m-%d'), []).append(activity)
+    _append_archive('activity', partitions)
+    return len(old)
+
+
+async def retention_job():
+    """Periodic job: apply the retention policies to users and activity history"""
+    now = datetime.now()
+    candidates = await _retention_candidates(now)
+
+    loop = asyncio.get_running_loop()
+    try:
+        archived = await loop.run_in_executor(None, _archive_users, candidates, now)
+    except Exception as e:
+        logger.error(f"Retention run failed: {e}")
+        return
+
+    removed = 0
+    for user_id in archived:
+        user = USER_DATABASE.get(user_id)
+        if user is None or retention_reason(user, now) is None:
+            continue  # Came back while the scan ran - the cold copy is just history
+        del USER_DATABASE[user_id]
+        persist_change('user_database', 'del', user_id)
+        removed += 1
+
+    try:
+        activity = archive_activity(now)
+    except Exception as e:
+        logger.error(f"Activity archive failed: {e}")
+        activity = 0
+
+    if removed or activity:
+        logger.info(f"🗄️ Archived {removed} users and {activity} activity records")
+
+
+def iter_archived_users():
+    """Yield (user_id, user, archived_at) from the cold files, oldest partition first"""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return
+    for name in sorted(os.listdir(ARCHIVE_DIR)):
+        if not (name.startswith('users-') and name.endswith('.jsonl.gz')):
+            continue
+        try:
+            with gzip.open(os.path.join(ARCHIVE_DIR, name), 'rt', encoding='utf-8') as f:
+                for line in f:
+                    row = json.loads(line)
+                    yield row['user_id'], _restore_user(row['user']), row['archived_at']
+        except (EOFError, OSError, ValueError) as e:
+            # Torn append from a crash - earlier rows of the partition were still read
+            logger.warning(f"⚠️ Archive {name} is truncated: {e}")
+
+
+# ========== RAID MODE ==========
+class SlidingWindowCounter:
+    """
+    Events in the last window seconds, kept in fixed time buckets: add() and
+    count() are O(1) (at most one pass over the bucket ring to expire old ones).
+    """
+
+    def __init__(self, window: float, bucket: float):
+        self.bucket = bucket
+        self.counts = [0] * max(1, int(window // bucket))
+        self.current = None  # Absolute index of the newest bucket
+        self.total = 0
+
+    def _advance(self, now: float):
+        index = int(now // self.bucket)
+        if self.current is not None and index <= self.current:
+            return
+        if self.current is None or index - self.current >= len(self.counts):
+            self.counts = [0] * len(self.counts)
+            self.total = 0
+        else:
+            for stale in range(self.current + 1, index + 1):
+                slot = stale % len(self.counts)
+                self.total -= self.counts[slot]
+                self.counts[slot] = 0
+        self.current = index
+
+    def add(self, now: float = None) -> int:
+        now = time.monotonic() if now is None else now
+        self._advance(now)
+        self.counts[self.current % len(self.counts)] += 1
+        self.total += 1
+        return self.total
+
+    def count(self, now: float = None) -> int:
+        self._advance(time.monotonic() if now is None else now)
+        return self.total
+
+
+class RaidDetector:
+    """
+    Per-channel join-rate tracking. A channel enters raid mode once it sees
+    RAID_JOINS_PER_MINUTE requests within a minute, and leaves it once the rate
+    falls below half of that. Outcomes during a raid are tallied for the
+    summaries raid_check_job() sends the admin instead of per-user notices.
+    """
+
+    def __init__(self, threshold: int):
+        self.threshold = threshold
+        self.windows = {}  # {chat_id: SlidingWindowCounter}
+        self.raids = {}  # {chat_id: {'started', 'peak', 'announced', 'reported_at', 'since_report', 'total'}}
+
+    def _window(self, chat_id: int) -> SlidingWindowCounter:
+        window = self.windows.get(chat_id)
+        if window is None:
+            window = self.windows[chat_id] = SlidingWindowCounter(60, RAID_BUCKET_SECONDS)
+        return window
+
+    def record(self, chat_id: int) -> bool:
+        """Count one join request; returns True while the channel is in raid mode"""
+        if self.threshold <= 0:
+            return False
+        rate = self._window(chat_id).add()
+        raid = self.raids.get(chat_id)
+        if raid is None:
+            if rate < self.threshold:
+                return False
+            raid = self.raids[chat_id] = {
+                'started': datetime.now(),
+                'peak': rate,
+                'announced': False,
+                'reported_at': datetime.now(),
+                'since_report': dict.fromkeys(RAID_OUTCOMES, 0),
+                'total': dict.fromkeys(RAID_OUTCOMES, 0)
+            }
+            logger.warning(f"🚨 Raid mode ON for channel {chat_id} ({rate} joins/min)")
+        raid['peak'] = max(raid['peak'], rate)
+        return True
+
+    def note(self, chat_id: int, outcome: str):
+        """Tally a decision made in raid mode ('approved', 'declined' or 'pending')"""
+        raid = self.raids.get(chat_id)
+        if raid is not None:
+            raid['since_report'][outcome] += 1
+            raid['total'][outcome] += 1
+
+    def rate(self, chat_id: int) -> int:
+        window = self.windows.get(chat_id)
+        return window.count() if window is not None else 0
+
+    def active(self, chat_id: int) -> bool:
+        return chat_id in self.raids
+
+    def summary(self) -> str:
+        if not self.raids:
+            return "off"
+        return ', '.join(
+            f"{MANAGED_CHANNELS.get(chat_id, {}).get('name', chat_id)} ({self.rate(chat_id)}/min)"
+            for chat_id in self.raids)
+
+
+RAID_OUTCOMES = ('approved', 'declined', 'pending')
+RAID_DETECTOR = RaidDetector(RAID_JOINS_PER_MINUTE)
+
+
+def _raid_counts(counts: dict) -> str:
+    return ', '.join(f"{counts[outcome]} {outcome}" for outcome in RAID_OUTCOMES)
+
+
+async def raid_check_job(bot):
+    """
+    Periodic job: announce new raids, send a summary per raid every
+    RAID_SUMMARY_MINUTES, and end raids whose join rate has dropped.
+    """
+    now = datetime.now()
+    for chat_id, raid in list(RAID_DETECTOR.raids.items()):
+        name = MANAGED_CHANNELS.get(chat_id, {}).get('name', chat_id)
+        rate = RAID_DETECTOR.rate(chat_id)
+        text = None
+
+        if rate < RAID_DETECTOR.threshold / 2:
+            del RAID_DETECTOR.raids[chat_id]
+            minutes = int((now - raid['started']).total_seconds() // 60)
+            logger.info(f"✅ Raid mode OFF for channel {chat_id} after {minutes} min")
+            text = (f"✅ *Raid mode OFF* - {name}\n\n"
+                    f"Lasted {minutes} min, peak {raid['peak']} joins/min\n"
+                    f"Total: {_raid_counts(raid['total'])}")
+            if raid['total']['pending']:
+                text += "\n\nPending users: /pending_users"
+        elif not raid['announced']:
+            raid['announced'] = True
+            text = (f"🚨 *Raid mode ON* - {name}\n\n"
+                    f"{rate} join requests in the last minute.\n"
+                    f"Deciding from profile fields only; verification notices are "
+                    f"held and summarized every {RAID_SUMMARY_MINUTES} min.")
+        elif now - raid['reported_at'] >= timedelta(minutes=RAID_SUMMARY_MINUTES):
+            text = (f"🛡️ *Raid ongoing* - {name}\n\n"
+                    f"Now {rate} joins/min (peak {raid['peak']})\n"
+                    f"Last {RAID_SUMMARY_MINUTES} min: {_raid_counts(raid['since_report'])}")
+        else:
+            continue
+
+        raid['reported_at'] = now
+        raid['since_report'] = dict.fromkeys(RAID_OUTCOMES, 0)
+        try:
+            await call_with_retry(bot, 'send_message', chat_id=ADMIN_ID, text=text, parse_mode='Markdown')
+        except Exception as e:
+            logger.error(f"Raid notice failed: {e}")
+
+
+# ========== SMART JOIN REQUEST HANDLER ==========
+async def handle_join_request(update: Update,
+                              context: ContextTypes.DEFAULT_TYPE):
+    """
+    Smart join request handler with 3-tier verification:
+    1. Auto-approve legitimate users
+    2. Auto-reject obvious bots/spammers + send fallback channel
+    3. Math captcha for borderline cases
+    In raid mode users are scored from the request alone (no profile fetch) and
+    borderline users wait silently; the admin gets raid summaries instead.
+    """
+    request = update.chat_join_request
+    user = request.from_user
+    chat_id = request.chat.id
+
+    # Only handle managed channels
+    if chat_id not in MANAGED_CHANNELS:
+        return
+
+    raid = RAID_DETECTOR.record(chat_id)
+
+    # Always approve admin
+    if user.id == ADMIN_ID:
+        await call_with_retry(context.bot, 'approve_join', chat_id=chat_id, user_id=user.id)
+        logger.info(f"✅ Admin auto-approved: {user.id}")
+        return
+
+    # Block already blocked users
+    if is_blocked(user.id):
+        await call_with_retry(context.bot, 'decline_join', chat_id=chat_id, user_id=user.id)
+        logger.info(f"❌ Blocked user {user.id} tried to join")
+        return
+
+    # Check if bulk approval is enabled for this channel
+    if BULK_APPROVAL_MODE.get(chat_id, False):
+        await call_with_retry(context.bot, 'approve_join', chat_id=chat_id, user_id=user.id, user_data={
+            'first_name': user.first_name,
+            'last_name': user.last_name or '',
+            'username': user.username or ''
+        })
+        logger.info(f"✅ Bulk-approved user: {user.id}")
+        return
+
+    # Smart verification - check legitimacy
+    legitimacy = await check_user_legitimacy(context, user, chat_id, offline=raid)
+
+    # === TIER 1: AUTO-APPROVE LEGITIMATE USERS ===
+    if legitimacy['legitimate'] and legitimacy['score'] >= 100:
+        try:
+            # A deferred approval still counts - it is retried until it goes through
+            await call_with_retry(context.bot, 'approve_join', chat_id=chat_id, user_id=user.id, user_data={
+                'first_name': user.first_name,
+                'last_name': user.last_name or '',
+                'username': user.username or ''
+            })
+
+            # Log to recent activity instead of sending notification
+            RECENT_ACTIVITY.append({
+                'type': 'auto_approved',
+                'user_id': user.id,
+                'user_name': user.first_name,
+                'username': user.username or 'None',
+                'channel': MANAGED_CHANNELS[chat_id]['name'],
+                'channel_id': chat_id,
+                'timestamp': datetime.now()
+            })
+            RAID_DETECTOR.note(chat_id, 'approved')
+
+            logger.info(f"✅ Auto-approved legitimate user: {user.id}")
+            return
+        except Exception as e:
+            logger.error(f"Auto-approval failed: {e}")
+
+    # === TIER 2: AUTO-REJECT + REDIRECT TO FALLBACK CHANNEL ===
+    if not legitimacy['legitimate'] and legitimacy['score'] == 0:
+        try:
+            await call_with_retry(context.bot, 'decline_join', chat_id=chat_id, user_id=user.id)
+
+            # Fallback channel link for the rejected user - sent by outbox_job()
+            fallback_queued = bool(GLOBAL_FALLBACK_CHANNEL) and queue_dm(
+                user.id,
+                f"Your request to join was not approved.\n\n"
+                f"You can join our public channel instead:\n"
+                f"{GLOBAL_FALLBACK_CHANNEL}")
+
+            # Log to recent activity
+            RECENT_ACTIVITY.append({
+                'type': 'auto_rejected',
                 'user_id': user.id,
                 'user_name': user.first_name or 'No Name',
                 'username': user.username or 'None',
                 'channel': MANAGED_CHANNELS[chat_id]['name'],
                 'channel_id': chat_id,
                 'reason': legitimacy.get('reason', 'Suspicious'),
-                'fallback_sent': bool(GLOBAL_FALLBACK_CHANNEL),
+                'fallback_sent': fallback_queued,
                 'timestamp': datetime.now()
             })
+            RAID_DETECTOR.note(chat_id, 'declined')
+
+            logger.info(f"❌ Auto-rejected suspicious user: {user.id}")
+            return
+        except Exception as e:
+            logger.error(f"Auto-rejection failed: {e}")
+
+    # === TIER 3: MATH CAPTCHA FOR BORDERLINE CASES ===
+    verification = PENDING_VERIFICATIONS.get(user.id)
+    if verification is not None:
+        # Already waiting on another channel - one admin decision covers both
+        if chat_id not in verification['chat_ids']:
+            verification['chat_ids'].append(chat_id)
+            persist_change('pending_verifications', 'set', user.id, verification)
+        RAID_DETECTOR.note(chat_id, 'pending')
+        track_user_activity(user.id, chat_id, 'pending', {
+            'first_name': user.first_name,
+            'last_name': user.last_name or '',
+            'username': user.username or ''
+        })
+        logger.info(f"⚠️ Added channel {chat_id} to pending verification of user: {user.id}")
+        return
+
+    # Generate simple math problem
+    num1 = random.randint(1, 10)
+    num2 = random.randint(1, 10)
+    answer = num1 + num2
+
+    # Store verification data - approval goes through the Bot API by chat/user ID,
+    # so the record survives a restart
+    PENDING_VERIFICATIONS[user.id] = {
+        'code': str(answer),
+        'chat_ids': [chat_id],
+        'timestamp': datetime.now(),
+        'captcha_question': f"{num1} + {num2}",
+        'reason': legitimacy.get('reason', 'Unknown')
+    }
+    persist_change('pending_verifications', 'set', user.id, PENDING_VERIFICATIONS[user.id])
+    schedule_pending_expiry(user.id, PENDING_VERIFICATIONS[user.id])
+
+    track_user_activity(user.id, chat_id, 'pending', {
+        'first_name': user.first_name,
+        'last_name': user.last_name or '',
+        'username': user.username or ''
+    })
+
+    if raid:
+        # Counted in the raid summary; approve from /pending_users afterwards
+        RAID_DETECTOR.note(chat_id, 'pending')
+        logger.info(f"⚠️ Raid mode: holding verification for user: {user.id}")
+        return
+
+    # Send captcha to admin with quick approve button (batched into a digest)
+    if DIGEST_WINDOW_SECONDS > 0:
+        DIGEST.add(context.bot, user.id)
+        logger.info(f"⚠️ Queued verification request for digest: {user.id}")
+        return
+    await send_verification_notice(context.bot, user.id)
+
+    logger.info(f"⚠️ Sent verification request for user: {user.id}")
+
+
+# ========== VERIFICATION NOTICES ==========
+async def send_verification_notice(bot, user_id: int):
+    """One admin message with approve/decline buttons for one pending verification"""
+    verification = PENDING_VERIFICATIONS[user_id]
+    user = USER_DATABASE.get(user_id, {})
+    keyboard = [[
+        InlineKeyboardButton("✅ Approve",
+                            callback_data=f"enter_code_{user_id}"),
+        InlineKeyboardButton("❌ Decline",
+                            callback_data=f"decline_code_{user_id}")
+    ]]
+
+    await call_with_retry(
+        bot, 'send_message',
+        chat_id=ADMIN_ID,
+        text=f"⚠️ *Verification Needed*\n\n"
+        f"Channel: {_channel_names(verification['chat_ids'])}\n"
+        f"User: [{user.get('first_name', 'Unknown')}](tg://user?id={user_id})\n"
+        f"ID: `{user_id}`\n"
+        f"Username: @{user.get('username') or 'None'}\n"
+        f"Status: Borderline - needs verification\n\n"
+        f"Est. account age: ~{estimate_account_age_days(user_id):.0f} days\n\n"
+        f"Math Captcha: {verification['captcha_question']} = ?\n"
+        f"Answer: {verification['code']}\n\n"
+        f"Reason: {verification.get('reason', 'Unknown')}",
+        parse_mode='Markdown',
+        reply_markup=InlineKeyboardMarkup(keyboard).to_dict())
+
+
+class NoticeDigest:
+    """
+    Buffers borderline users for DIGEST_WINDOW_SECONDS after the first one,
+    then sends the admin one paged message for all of them. A window with a
+    single user gets the regular notice. Recent digests are kept (in memory)
+    so their buttons keep working.
+    """
+
+    def __init__(self):
+        self.buffer = []  # User IDs waiting for the next digest
+        self.flusher = None
+        self.digests = OrderedDict()  # {digest_id: {'users': [user_id], 'done': {user_id: outcome}}}
+        self.next_id = 1
+        self.sent = 0  # Admin messages sent
+        self.users = 0  # Users covered by them
+
+    def add(self, bot, user_id: int):
+        self.buffer.append(user_id)
+        if self.flusher is None:
+            self.flusher = asyncio.create_task(self._flush_later(bot))
+
+    async def _flush_later(self, bot):
+        await asyncio.sleep(DIGEST_WINDOW_SECONDS)
+        self.flusher = None
+        try:
+            await self.flush(bot)
+        except Exception as e:
+            logger.error(f"Digest send failed: {e}")
+
+    async def flush(self, bot):
+        users = [user_id for user_id in dict.fromkeys(self.buffer) if user_id in PENDING_VERIFICATIONS]
+        self.buffer = []
+        if not users:
+            return
+        self.sent += 1
+        self.users += len(users)
+        if len(users) == 1:
+            await send_verification_notice(bot, users[0])
+            return
+
+        digest_id = self.next_id
+        self.next_id += 1
+        self.digests[digest_id] = {'users': users, 'done': {}}
+        while len(self.digests) > DIGEST_KEEP:
+            self.digests.popitem(last=False)
+
+        text, markup = self.render(digest_id, 0)
+        await call_with_retry(bot, 'send_message', chat_id=ADMIN_ID, text=text,
+                              reply_markup=markup.to_dict())
+        logger.info(f"⚠️ Sent verification digest #{digest_id} ({len(users)} users)")
+
+    def waiting(self, digest_id: int) -> list:
+        """Digest users still pending and not handled from this digest"""
+        digest = self.digests[digest_id]
+        return [user_id for user_id in digest['users']
+                if user_id not in digest['done'] and user_id in PENDING_VERIFICATIONS]
+
+    def render(self, digest_id: int, page: int) -> tuple:
+        """(text, InlineKeyboardMarkup) of one page of a digest"""
+        digest = self.digests[digest_id]
+        users = digest['users']
+        pages = (len(users) + DIGEST_PAGE_SIZE - 1) // DIGEST_PAGE_SIZE
+        page = max(0, min(page, pages - 1))
+        waiting = self.waiting(digest_id)
+
+        lines = [f"⚠️ Verification Digest #{digest_id} - {len(waiting)} of {len(users)} waiting\n"]
+        keyboard = []
+        first = page * DIGEST_PAGE_SIZE
+        for number, user_id in enumerate(users[first:first + DIGEST_PAGE_SIZE], start=first + 1):
+            user = USER_DATABASE.get(user_id, {})
+            name = f"{user.get('first_name', 'Unknown')} (@{user.get('username') or 'None'})"
+            verification = PENDING_VERIFICATIONS.get(user_id)
+            if user_id in digest['done'] or verification is None:
+                lines.append(f"{number}. {name} - {digest['done'].get(user_id, 'handled elsewhere')}")
+                continue
+            lines.append(
+                f"{number}. {name} - ID {user_id}\n"
+                f"    {_channel_names(verification['chat_ids'])} | "
+                f"{verification['captcha_question']} = {verification['code']} | "
+                f"~{estimate_account_age_days(user_id):.0f}d | {verification.get('reason') or 'Unknown'}")
+            keyboard.append([
+                InlineKeyboardButton(f"✅ {number}", callback_data=f"digest_ok_{digest_id}_{page}_{user_id}"),
+                InlineKeyboardButton(f"❌ {number}", callback_data=f"digest_no_{digest_id}_{page}_{user_id}")
+            ])
+
+        if pages > 1:
+            keyboard.append([
+                InlineKeyboardButton("◀️", callback_data=f"digest_page_{digest_id}_{(page - 1) % pages}"),
+                InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"digest_page_{digest_id}_{page}"),
+                InlineKeyboardButton("▶️", callback_data=f"digest_page_{digest_id}_{(page + 1) % pages}")
+            ])
+        if waiting:
+            keyboard.append([
+                InlineKeyboardButton(f"✅ Approve all ({len(waiting)})", callback_data=f"digest_all_{digest_id}_{page}_ok"),
+                InlineKeyboardButton(f"❌ Decline all ({len(waiting)})", callback_data=f"digest_all_{digest_id}_{page}_no")
+            ])
+        return '\n'.join(lines), InlineKeyboardMarkup(keyboard)
+
+    def summary(self) -> str:
+        return f"{self.sent} sent for {self.users} users, {len(self.buffer)} buffered"
+
+
+DIGEST = NoticeDigest()
+
+
+async def _resolve_digest_user(bot, digest_id: int, user_id: int, approve: bool) -> str:
+    """Approve/decline one digest user; returns the outcome shown in the digest"""
+    if user_id not in PENDING_VERIFICATIONS:
+        return 'handled elsewhere'
+    try:
+        if approve:
+            resolved = await approve_pending(bot, user_id, {
+                'first_name': USER_DATABASE.get(user_id, {}).get('first_name', 'Unknown')
+            })
+        else:
+            resolved = await decline_pending(bot, user_id)
+    except Exception as e:
+        logger.error(f"Digest {'approval' if approve else 'decline'} of {user_id} failed: {e}")
+        return f"⚠️ failed ({e})"
+    outcome = ('✅ approved' if approve else '❌ declined') if resolved else 'request withdrawn'
+    DIGEST.digests[digest_id]['done'][user_id] = outcome
+    return outcome
+
+
+async def digest_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Digest buttons: digest_page_ID_PAGE, digest_ok/no_ID_PAGE_USER, digest_all_ID_PAGE_ok/no"""
+    query = update.callback_query
+
+    if query.from_user.id != ADMIN_ID:
+        await query.answer("Unauthorized", show_alert=True)
+        return
+
+    _, action, digest_id, page, *rest = query.data.split('_')
+    digest_id, page = int(digest_id), int(page)
+    if digest_id not in DIGEST.digests:
+        await query.answer("Digest expired - use /pending_users", show_alert=True)
+        return
+
+    if action in ('ok', 'no'):
+        outcome = await _resolve_digest_user(context.bot, digest_id, int(rest[0]), action == 'ok')
+        await query.answer(outcome)
+    elif action == 'all':
+        approve = rest[0] == 'ok'
+        await query.answer("Working...")
+        semaphore = asyncio.Semaphore(EXPIRY_CONCURRENCY)
+
+        async def resolve(user_id):
+            async with semaphore:
+                return await _resolve_digest_user(context.bot, digest_id, user_id, approve)
+
+        outcomes = await asyncio.gather(*(resolve(user_id) for user_id in DIGEST.waiting(digest_id)))
+        logger.info(f"✅ Digest #{digest_id}: {'approved' if approve else 'declined'} {len(outcomes)} users")
+    else:
+        await query.answer()
+
+    text, markup = DIGEST.render(digest_id, page)
+    try:
+        await query.edit_message_text(text, reply_markup=markup)
+    except BadRequest as e:
+        if 'not modified' not in str(e).lower():
+            raise
+
+
+# ========== JOIN REQUEST PIPELINE ==========
+class FairJoinQueue:
+    """
+    Join requests queued per channel and handed to a worker pool round-robin,
+    so a flooded channel drains at its own pace while quiet channels still get
+    a turn every cycle. submit() waits once JOIN_QUEUE_LIMIT requests are queued,
+    which stalls update fetching instead of growing memory without bound.
+    """
+
+    def __init__(self, limit: int):
+        self.queues = {}  # {chat_id: deque of (enqueued_at, update, context)}
+        self.turns = deque()  # chat_ids with queued requests, in serving order
+        self.available = asyncio.Semaphore(0)
+        self.space = asyncio.Semaphore(limit)
+        self.workers = []
+        self.busy = 0
+
+        # Backpressure metrics
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.peak_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def submit(self, chat_id: int, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await self.space.acquire()
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = deque()
+            self.turns.append(chat_id)
+        queue.append((time.monotonic(), update, context))
+        self.submitted += 1
+        self.peak_depth = max(self.peak_depth, len(self))
+        self.available.release()
+
+    async def _next(self):
+        """Oldest request of the channel whose turn it is"""
+        await self.available.acquire()
+        chat_id = self.turns.popleft()
+        queue = self.queues[chat_id]
+        item = queue.popleft()
+        if queue:
+            self.turns.append(chat_id)  # Back of the line until the others had a go
+        else:
+            del self.queues[chat_id]
+        self.space.release()
+        return item
+
+    async def _worker(self):
+        while True:
+            enqueued_at, update, context = await self._next()
+            wait = time.monotonic() - enqueued_at
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.busy += 1
+            try:
+                await handle_join_request(update, context)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Join request worker failed: {e}")
+            finally:
+                self.busy -= 1
+                self.processed += 1
+
+    def start(self, workers: int):
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(workers)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def summary(self) -> str:
+        started = self.processed + self.busy
+        avg_wait = self.total_wait / started if started else 0.0
+        busiest = max(self.queues.items(), key=lambda entry: len(entry[1]), default=None)
+        text = (f"{len(self)} queued (peak {self.peak_depth}), "
+                f"{self.busy}/{len(self.workers)} workers busy, "
+                f"wait avg {avg_wait:.1f}s / max {self.max_wait:.1f}s, "
+                f"{self.processed} done, {self.failed} failed")
+        if busiest is not None:
+            text += f", busiest: {MANAGED_CHANNELS.get(busiest[0], {}).get('name', busiest[0])} ({len(busiest[1])})"
+        return text
+
+
+JOIN_QUEUE = FairJoinQueue(JOIN_QUEUE_LIMIT)
+
+
+async def enqueue_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ChatJoinRequestHandler callback: hand the request to the worker pool"""
+    await JOIN_QUEUE.submit(update.chat_join_request.chat.id, update, context)
+
+
+# ========== RATE LIMITER ==========
+# Every Bot API call (except getUpdates) passes through RATE_LIMITER: a per-chat
+# token bucket first, then one global bucket whose free tokens go to the
+# waiting request with the best priority class.
+PRIORITY_JOIN = 0  # Join approvals/declines and the lookups deciding them
+PRIORITY_PROMO = 1  # Channel posts, user DMs
+PRIORITY_ADMIN = 2  # Notices and replies to the admin
+PRIORITY_NAMES = {PRIORITY_JOIN: 'join', PRIORITY_PROMO: 'promo', PRIORITY_ADMIN: 'admin'}
+
+JOIN_ENDPOINTS = {
+    'approveChatJoinRequest', 'declineChatJoinRequest', 'getChat',
+    'getUserProfilePhotos', 'answerCallbackQuery'
+}
+# Endpoints that post into a chat and count against its per-chat limit
+CHAT_MESSAGE_ENDPOINTS = {'copyMessage', 'forwardMessage'}
+
+
+class TokenBucket:
+    """Classic token bucket; reservations may go into debt so waiters stay FIFO"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Seconds until a token is available (0 if one is available now)"""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def reserve(self) -> float:
+        """Take a token now; returns how long to wait before using it"""
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """
+    PTB rate limiter: per-chat buckets (private chats and groups/channels have
+    different limits) plus a global bucket served in priority order. RetryAfter
+    from Telegram pauses the whole dispatcher for the requested time.
+    Priority comes from the endpoint/target chat, or rate_limit_args=PRIORITY_*.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(RATE_LIMIT_GLOBAL_PER_SECOND, RATE_LIMIT_GLOBAL_PER_SECOND)
+        self.chat_buckets = OrderedDict()  # {chat_id: TokenBucket}, least recently used first
+        self.waiting = []  # heap of [priority, seq, future]
+        self.seq = 0
+        self.paused_until = 0.0
+        self.wakeup = None
+        self.dispatcher = None
+
+        # Metrics per priority class
+        self.queued = {priority: 0 for priority in PRIORITY_NAMES}
+        self.sent = {priority: 0 for priority in PRIORITY_NAMES}
+        self.total_wait = {priority: 0.0 for priority in PRIORITY_NAMES}
+        self.max_wait = {priority: 0.0 for priority in PRIORITY_NAMES}
+        self.flood_waits = 0
+
+    async def initialize(self):
+        self.wakeup = asyncio.Event()
+        self.dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+            await asyncio.gather(self.dispatcher, return_exceptions=True)
+            self.dispatcher = None
+
+    def _priority(self, endpoint: str, data: dict, rate_limit_args) -> int:
+        if rate_limit_args in PRIORITY_NAMES:
+            return rate_limit_args
+        if endpoint in JOIN_ENDPOINTS:
+            return PRIORITY_JOIN
+        chat_id = data.get('chat_id')
+        if chat_id == ADMIN_ID or str(chat_id) == str(ADMIN_ID):
+            return PRIORITY_ADMIN
+        return PRIORITY_PROMO
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            private = isinstance(chat_id, int) and chat_id > 0
+            if private:
+                bucket = TokenBucket(RATE_LIMIT_PRIVATE_PER_SECOND, 1)
+            else:
+                bucket = TokenBucket(RATE_LIMIT_GROUP_PER_MINUTE / 60, 3)
+            self.chat_buckets[chat_id] = bucket
+            # Evicted buckets are the idle ones - they would be full again anyway
+            while len(self.chat_buckets) > RATE_LIMIT_CHAT_BUCKETS:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _dispatch(self):
+        """Hand out global tokens to the best-priority waiter, one at a time"""
+        while True:
+            if not self.waiting:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            delay = max(self.paused_until - time.monotonic(), self.global_bucket.delay())
+            if delay > 0:
+                # Re-check afterwards: a better-priority request may have arrived
+                await asyncio.sleep(delay)
+                continue
+            priority, _, future = heapq.heappop(self.waiting)
+            self.queued[priority] -= 1
+            if future.cancelled():
+                continue
+            self.global_bucket.reserve()
+            future.set_result(None)
+
+    async def _acquire(self, priority: int, chat_id):
+        if chat_id is not None and chat_id != '':
+            await asyncio.sleep(self._chat_bucket(chat_id).reserve())
+
+        future = asyncio.get_running_loop().create_future()
+        self.seq += 1
+        heapq.heappush(self.waiting, [priority, self.seq, future])
+        self.queued[priority] += 1
+        self.wakeup.set()
+        await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = self._priority(endpoint, data, rate_limit_args)
+        per_chat = endpoint.startswith('send') or endpoint in CHAT_MESSAGE_ENDPOINTS
+
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            started = time.monotonic()
+            await self._acquire(priority, data.get('chat_id') if per_chat else None)
+            wait = time.monotonic() - started
+            self.sent[priority] += 1
+            self.total_wait[priority] += wait
+            self.max_wait[priority] = max(self.max_wait[priority], wait)
+
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.flood_waits += 1
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                logger.warning(f"⏳ Flood limit on {endpoint}: pausing sends for {retry_after}s")
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+
+    def summary(self) -> str:
+        lines = []
+        for priority, name in PRIORITY_NAMES.items():
+            sent = self.sent[priority]
+            avg_wait = self.total_wait[priority] / sent if sent else 0.0
+            lines.append(f"{name}: {self.queued[priority]} queued, {sent} sent, "
+                         f"wait avg {avg_wait:.2f}s / max {self.max_wait[priority]:.1f}s")
+        lines.append(f"flood waits: {self.flood_waits}")
+        return '\n'.join(lines)
+
+
+RATE_LIMITER = PriorityRateLimiter()
+
+
+# ========== RETRY / DEFERRED OPERATIONS ==========
+# Bot API calls that must eventually happen (join decisions, DMs, admin notices)
+# go through call_with_retry(). A transient failure - flood wait or network
+# error - parks the call in DEFERRED_OPS, which is persisted like any other
+# state, and deferred_ops_job() retries it once it is due.
+RETRY_OUTCOMES = ('ok', 'deferred', 'retried', 'gave_up', 'failed')
+RETRY_STATS = {}  # {op: {outcome: count}}
+
+
+def _count_retry(op: str, outcome: str):
+    RETRY_STATS.setdefault(op, dict.fromkeys(RETRY_OUTCOMES, 0))[outcome] += 1
+
+
+def retry_delay(error: Exception, attempt: int):
+    """
+    Seconds to wait before retrying after error, or None if retrying cannot help.
+    Flood waits use the server's retry_after; network errors back off
+    exponentially from RETRY_BASE_SECONDS with jitter so retries do not bunch up.
+    """
+    if isinstance(error, RetryAfter):
+        retry_after = error.retry_after
+        if isinstance(retry_after, timedelta):
+            retry_after = retry_after.total_seconds()
+        return retry_after + random.uniform(0, 1)
+    # BadRequest/Forbidden subclass NetworkError but will fail the same way again
+    if isinstance(error, (BadRequest, Forbidden)):
+        return None
+    if isinstance(error, (NetworkError, OSError, asyncio.TimeoutError)):
+        backoff = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt)
+        return backoff * random.uniform(0.5, 1.0)
+    return None
+
+
+async def _op_approve_join(bot, chat_id: int, user_id: int, user_data: dict = None):
+    await bot.approve_chat_join_request(chat_id, user_id)
+    if user_data is not None:
+        track_user_activity(user_id, chat_id, 'approved', user_data)
+
+
+async def _op_decline_join(bot, chat_id: int, user_id: int):
+    await bot.decline_chat_join_request(chat_id, user_id)
+
+
+async def _op_send_message(bot, chat_id: int, text: str, reply_markup: dict = None, **kwargs):
+    if reply_markup is not None:
+        # Stored as a plain dict so the deferred op can be persisted
+        reply_markup = InlineKeyboardMarkup.de_json(reply_markup, bot)
+    await bot.send_message(chat_id, text, reply_markup=reply_markup, **kwargs)
+
+
+# Operation type -> coroutine running it; arguments must be persistable (no PTB objects)
+DEFERRED_HANDLERS = {
+    'approve_join': _op_approve_join,
+    'decline_join': _op_decline_join,
+    'send_message': _op_send_message
+}
+
+
+def defer_op(op: str, args: dict, delay: float, error: Exception, attempts: int = 1):
+    """Persist op for deferred_ops_job() to run after delay seconds"""
+    op_id = max(DEFERRED_OPS, default=0) + 1
+    DEFERRED_OPS[op_id] = {
+        'op': op,
+        'args': args,
+        'attempts': attempts,
+        'due': time.time() + delay,
+        'error': str(error)
+    }
+    persist_change('deferred_ops', 'set', op_id, DEFERRED_OPS[op_id])
+    _count_retry(op, 'deferred')
+    logger.warning(f"⏳ {op} failed ({error}), retrying in {delay:.0f}s")
+
+
+async def call_with_retry(bot, op: str, **args) -> bool:
+    """
+    Run a DEFERRED_HANDLERS operation now. Returns True if it succeeded, False if
+    it failed transiently and was deferred. Permanent errors are raised.
+    """
+    try:
+        await DEFERRED_HANDLERS[op](bot, **args)
+    except Exception as e:
+        delay = retry_delay(e, 0)
+        if delay is None:
+            _count_retry(op, 'failed')
+            raise
+        defer_op(op, args, delay, e)
+        return False
+    _count_retry(op, 'ok')
+    return True
+
+
+async def deferred_ops_job(bot):
+    """Periodic job: retry deferred operations that are due, oldest first"""
+    now = time.time()
+    due = sorted((entry['due'], op_id) for op_id, entry in DEFERRED_OPS.items() if entry['due'] <= now)
+    for _, op_id in due:
+        entry = DEFERRED_OPS.get(op_id)
+        if entry is None:
+            continue
+        op = entry['op']
+        try:
+            await DEFERRED_HANDLERS[op](bot, **entry['args'])
+        except Exception as e:
+            delay = retry_delay(e, entry['attempts'])
+            if delay is not None and entry['attempts'] < DEFERRED_MAX_ATTEMPTS:
+                entry['attempts'] += 1
+                entry['due'] = time.time() + delay
+                entry['error'] = str(e)
+                persist_change('deferred_ops', 'set', op_id, entry)
+                logger.warning(f"⏳ {op} failed again ({e}), attempt {entry['attempts']} in {delay:.0f}s")
+                continue
+            _count_retry(op, 'gave_up')
+            logger.error(f"❌ Giving up on {op} {entry['args']} after {entry['attempts']} attempts: {e}")
+        else:
+            _count_retry(op, 'retried')
+            logger.info(f"✅ Deferred {op} succeeded on attempt {entry['attempts'] + 1}")
+        DEFERRED_OPS.pop(op_id, None)
+        persist_change('deferred_ops', 'del', op_id)
+
+
+def retry_summary() -> str:
+    if not RETRY_STATS:
+        return f"{len(DEFERRED_OPS)} deferred"
+    counts = '; '.join(
+        f"{op}: " + ', '.join(f"{count} {outcome}" for outcome, count in stats.items() if count)
+        for op, stats in sorted(RETRY_STATS.items()))
+    return f"{len(DEFERRED_OPS)} deferred - {counts}"
+
+
+# ========== DM OUTBOX ==========
+# Messages to users (the fallback channel link for rejected users) are not sent
+# inline: queue_dm() parks them in OUTBOX, which is persisted, and outbox_job()
+# sends them in the background within its own OUTBOX_PER_SECOND budget. Users
+# the bot can't message (blocked it / never started it) go into
+# UNREACHABLE_USERS for UNREACHABLE_DAYS so repeat attempts cost no API call.
+OUTBOX_BUCKET = TokenBucket(OUTBOX_PER_SECOND, OUTBOX_PER_SECOND)
+OUTBOX_STATS = {'queued': 0, 'sent': 0, 'unreachable': 0, 'skipped': 0, 'failed': 0}
+
+
+def is_unreachable(user_id: int) -> bool:
+    """User recently couldn't be messaged (expired entries are dropped here)"""
+    marked = UNREACHABLE_USERS.get(user_id)
+    if marked is None:
+        return False
+    if time.time() - marked < UNREACHABLE_DAYS * 86400:
+        return True
+    del UNREACHABLE_USERS[user_id]
+    persist_change('unreachable_users', 'del', user_id)
+    return False
+
+
+def queue_dm(user_id: int, text: str) -> bool:
+    """Queue a DM for outbox_job(); False if the user is known to be unreachable"""
+    if is_unreachable(user_id):
+        OUTBOX_STATS['skipped'] += 1
+        return False
+    message_id = max(OUTBOX, default=0) + 1
+    OUTBOX[message_id] = {'user_id': user_id, 'text': text, 'attempts': 0, 'due': time.time()}
+    persist_change('outbox', 'set', message_id, OUTBOX[message_id])
+    OUTBOX_STATS['queued'] += 1
+    return True
+
+
+async def outbox_job(bot):
+    """Periodic job: send due outbox messages, oldest first, within the outbox budget"""
+    now = time.time()
+    for message_id in sorted(message_id for message_id, entry in OUTBOX.items() if entry['due'] <= now):
+        if OUTBOX_BUCKET.delay() > 0:
+            break  # Budget spent - the rest waits for the next run
+        entry = OUTBOX[message_id]
+        user_id = entry['user_id']
+        if is_unreachable(user_id):
+            OUTBOX_STATS['skipped'] += 1
+        else:
+            OUTBOX_BUCKET.reserve()
+            try:
+                await bot.send_message(user_id, entry['text'], disable_web_page_preview=True,
+                                       rate_limit_args=PRIORITY_PROMO)
+            except Exception as e:
+                if isinstance(e, Forbidden) or (isinstance(e, BadRequest) and 'chat not found' in str(e).lower()):
+                    UNREACHABLE_USERS[user_id] = time.time()
+                    persist_change('unreachable_users', 'set', user_id, UNREACHABLE_USERS[user_id])
+                    OUTBOX_STATS['unreachable'] += 1
+                    logger.info(f"📪 User {user_id} can't be messaged ({e}) - skipping them for {UNREACHABLE_DAYS} days")
+                else:
+                    delay = retry_delay(e, entry['attempts'])
+                    if delay is not None and entry['attempts'] < DEFERRED_MAX_ATTEMPTS:
+                        entry['attempts'] += 1
+                        entry['due'] = time.time() + delay
+                        persist_change('outbox', 'set', message_id, entry)
+                        logger.warning(f"⏳ DM to {user_id} failed ({e}), retrying in {delay:.0f}s")
+                        continue
+                    OUTBOX_STATS['failed'] += 1
+                    logger.error(f"❌ Giving up on DM to {user_id}: {e}")
+            else:
+                OUTBOX_STATS['sent'] += 1
+                logger.info(f"📤 Sent queued DM to user {user_id}")
+        OUTBOX.pop(message_id, None)
+        persist_change('outbox', 'del', message_id)
+
+
+def outbox_summary() -> str:
+    counts = ', '.join(f"{count} {outcome}" for outcome, count in OUTBOX_STATS.items() if count)
+    return f"{len(OUTBOX)} queued, {len(UNREACHABLE_USERS)} unreachable" + (f" - {counts}" if counts else '')
+
+
+async def enter_code_callback(update: Update,
+                              context: ContextTypes.DEFAULT_TYPE):
+    """Handle admin's approval via button click"""
+    query = update.callback_query
+
+    if query.from_user.id != ADMIN_ID:
+        await query.answer("Unauthorized", show_alert=True)
+        return
+
+    await query.answer()
+
+    user_id = int(query.data.split('_')[-1])
+
+    if user_id not in PENDING_VERIFICATIONS:
+        await query.edit_message_text("❌ Verification expired or already processed")
+        return
+
+    try:
+        approved = await approve_pending(context.bot, user_id, {
+            'first_name': USER_DATABASE.get(user_id, {}).get('first_name', 'Unknown')
+        })
+        if not approved:
+            await query.edit_message_text("❌ Join request expired or was withdrawn")
+            return
+
+        await query.edit_message_text(
+            f"✅ *User Approved*\n\n"
+            f"User ID: `{user_id}`\n"
+            f"Channel: {_channel_names(approved)}",
+            parse_mode='Markdown')
+
+        logger.info(f"✅ Admin manually approved user: {user_id}")
+
+    except Exception as e:
+        logger.error(f"Manual approval failed: {e}")
+        await query.edit_message_text(
+            f"❌ Approval failed\n\nError: {str(e)}",
+            parse_mode='Markdown')
+
+
+def _channel_names(chat_ids) -> str:
+    return ', '.join(MANAGED_CHANNELS.get(chat_id, {}).get('name', 'Unknown') for chat_id in chat_ids)
+
+
+async def _resolve_pending(bot, user_id: int, approve: bool, user_data: dict = None,
+                           chat_ids: list = None) -> list:
+    """
+    Approve or decline every channel a pending verification waits on (or just
+    chat_ids), by chat/user ID (works after a restart - no ChatJoinRequest
+    object needed). Channels are claimed from the record before the first API
+    call, so concurrent resolutions never handle one twice; a permanent error
+    puts the unhandled ones back. The record is dropped once it is empty.
+    Returns the chat IDs that were resolved.
+    """
+    verification = PENDING_VERIFICATIONS.get(user_id)
+    if verification is None:
+        return []
+    pending = verification['chat_ids']
+    claimed = []
+    for chat_id in (chat_ids if chat_ids is not None else list(pending)):
+        if chat_id in pending:
+            pending.remove(chat_id)
+            claimed.append(chat_id)
+    if not claimed:
+        return []  # Already handled (or being handled) elsewhere
+
+    resolved = []
+    handled = 0
+    try:
+        for chat_id in claimed:
+            done = True
+            try:
+                if approve:
+                    await call_with_retry(bot, 'approve_join', chat_id=chat_id, user_id=user_id,
+                                          user_data=user_data or {})
+                else:
+                    await call_with_retry(bot, 'decline_join', chat_id=chat_id, user_id=user_id)
+            except BadRequest as e:
+                error = str(e).upper()
+                if 'HIDE_REQUESTER_MISSING' in error:
+                    done = False  # Withdrawn or handled elsewhere - just drop it
+                elif approve and 'USER_ALREADY_PARTICIPANT' in error:
+                    track_user_activity(user_id, chat_id, 'approved', user_data)
+                else:
+                    raise
+            handled += 1
+            if done:
+                resolved.append(chat_id)
+    finally:
+        if handled < len(claimed):
+            pending.extend(claimed[handled:])
+            if PENDING_VERIFICATIONS.get(user_id) is not verification:
+                # A concurrent resolution emptied and dropped the record meanwhile
+                PENDING_VERIFICATIONS[user_id] = verification
+                schedule_pending_expiry(user_id, verification)
+        if not pending:
+            PENDING_VERIFICATIONS.pop(user_id, None)
+            PENDING_EXPIRY.cancel(user_id)
+            persist_change('pending_verifications', 'del', user_id)
+        else:
+            persist_change('pending_verifications', 'set', user_id, verification)
+    return resolved
+
+
+async def approve_pending(bot, user_id: int, user_data: dict = None) -> list:
+    """Approve a pending verification on all its channels; returns the approved chat IDs"""
+    return await _resolve_pending(bot, user_id, True, user_data)
+
+
+async def decline_pending(bot, user_id: int) -> list:
+    """Decline a pending verification on all its channels; returns the declined chat IDs"""
+    return await _resolve_pending(bot, user_id, False)
+
+
+# ========== PENDING EXPIRY ==========
+EXPIRY_ACTIONS = ('decline', 'approve', 'escalate')
+
+
+class ExpiryHeap:
+    """
+    Deadlines in a binary heap: schedule() is O(log n), cancel() is O(1) - the
+    heap entry is left behind and skipped when it surfaces, because only the
+    deadline in `deadlines` counts. The heap is rebuilt once stale entries
+    outnumber live ones.
+    """
+
+    def __init__(self):
+        self.heap = []  # [(deadline, key)]
+        self.deadlines = {}  # {key: deadline}
+
+    def schedule(self, key, deadline: datetime):
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [(deadline, key) for key, deadline in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def pop_due(self, now: datetime) -> list:
+        """Remove and return the keys whose deadline has passed, earliest first"""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, key = heapq.heappop(self.heap)
+            if self.deadlines.get(key) == deadline:
+                del self.deadlines[key]
+                due.append(key)
+        return due
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+
+PENDING_EXPIRY = ExpiryHeap()  # user_id -> when the pending verification expires
+
+
+def schedule_pending_expiry(user_id: int, verification: dict):
+    """Track a pending verification's deadline (escalated ones wait for the admin)"""
+    if not verification.get('escalated'):
+        PENDING_EXPIRY.schedule(user_id, verification['timestamp'] + timedelta(minutes=CODE_EXPIRY_MINUTES))
+
+
+def load_pending_expiry():
+    """Rebuild the expiry heap from the pending verifications loaded at startup"""
+    for user_id, verification in PENDING_VERIFICATIONS.items():
+        schedule_pending_expiry(user_id, verification)
+
+
+def expiry_action(chat_id: int) -> str:
+    return CHANNEL_EXPIRY_ACTIONS.get(chat_id, PENDING_EXPIRY_ACTION)
+
+
+async def _expire_verification(bot, user_id: int, semaphore: asyncio.Semaphore) -> list:
+    """Apply each channel's expiry action; returns the channels left for the admin"""
+    verification = PENDING_VERIFICATIONS.get(user_id)
+    if verification is None:
+        return []
+
+    by_action = {action: [] for action in EXPIRY_ACTIONS}
+    for chat_id in verification['chat_ids']:
+        by_action[expiry_action(chat_id)].append(chat_id)
+
+    async with semaphore:
+        for action in ('approve', 'decline'):
+            if by_action[action]:
+                resolved = await _resolve_pending(bot, user_id, action == 'approve', {}, by_action[action])
+                logger.info(f"⌛ Verification of {user_id} expired: {action}d {resolved}")
+
+    if by_action['escalate'] and user_id in PENDING_VERIFICATIONS:
+        verification['escalated'] = True
+        persist_change('pending_verifications', 'set', user_id, verification)
+    return by_action['escalate']
+
 
-            logger.info(f"❌ Auto-rejected suspicious user: {user.id}")
-            return
+async def pending_expiry_job(bot):
+    """
+    Periodic job: expire pending verifications older than CODE_EXPIRY_MINUTES.
+    Expired users are handled in batches of EXPIRY_BATCH_SIZE with at most
+    EXPIRY_CONCURRENCY resolutions in flight; escalations go to the admin as one
+    message per sweep.
+    """
+    due = PENDING_EXPIRY.pop_due(datetime.now())
+    if not due:
+        return
+
+    semaphore = asyncio.Semaphore(EXPIRY_CONCURRENCY)
+    escalated = []
+    for start in range(0, len(due), EXPIRY_BATCH_SIZE):
+        batch = due[start:start + EXPIRY_BATCH_SIZE]
+        results = await asyncio.gather(
+            *(_expire_verification(bot, user_id, semaphore) for user_id in batch),
+            return_exceptions=True)
+        for user_id, result in zip(batch, results):
+            if isinstance(result, Exception):
+                logger.error(f"Expiring verification of {user_id} failed: {result}")
+                if user_id in PENDING_VERIFICATIONS:
+                    # Try again next sweep
+                    PENDING_EXPIRY.schedule(user_id, datetime.now() + timedelta(seconds=PENDING_SWEEP_SECONDS))
+            elif result:
+                escalated.append((user_id, result))
+
+    if escalated:
+        lines = [f"• `{user_id}` - {_channel_names(chat_ids)}" for user_id, chat_ids in escalated[:20]]
+        if len(escalated) > 20:
+            lines.append(f"...and {len(escalated) - 20} more")
+        try:
+            await call_with_retry(
+                bot, 'send_message',
+                chat_id=ADMIN_ID,
+                text=f"⏰ *{len(escalated)} verification(s) unanswered for {CODE_EXPIRY_MINUTES}+ min*\n\n"
+                + "\n".join(lines) + "\n\nDecide with /pending_users or /approve_all_pending",
+                parse_mode='Markdown')
         except Exception as e:
-            logger.error(f"Auto-rejection failed: {e}")
+            logger.error(f"Escalation notice failed: {e}")
 
-    # === TIER 3: MATH CAPTCHA FOR BORDERLINE CASES ===
-    # Generate simple math problem
-    num1 = random.randint(1, 10)
-    num2 = random.randint(1, 10)
-    answer = num1 + num2
 
-    # Store verification data
-    PENDING_VERIFICATIONS[user.id] = {
-        'code': str(answer),
-        'chat_id': chat_id,
-        'timestamp': datetime.now(),
-        'captcha_question': f"{num1} + {num2}",
-        'request': request  # Store request object for later approval
-    }
+async def set_expiry_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Set what happens to a channel's unanswered verifications"""
+    if await ignore_non_admin(update, context):
+        return
 
-    track_user_activity(user.id, chat_id, 'pending', {
-        'first_name': user.first_name,
-        'last_name': user.last_name or '',
-        'username': user.username or ''
-    })
+    if len(context.args) < 2 or context.args[1].lower() not in EXPIRY_ACTIONS + ('default',):
+        await update.message.reply_text(
+            "Usage: `/set_expiry CHANNEL_ID decline|approve|escalate|default`\n\n"
+            f"After {CODE_EXPIRY_MINUTES} min without an admin decision a pending user is:\n"
+            "• decline - declined\n"
+            "• approve - approved\n"
+            "• escalate - listed in a reminder and kept pending\n\n"
+            f"Default: {PENDING_EXPIRY_ACTION}",
+            parse_mode='Markdown')
+        return
 
-    # Send captcha to admin with quick approve button
-    user_link = f"tg://user?id={user.id}"
-    keyboard = [[
-        InlineKeyboardButton("✅ Approve",
-                            callback_data=f"enter_code_{user.id}")
-    ]]
+    try:
+        channel_id = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("❌ Invalid channel ID")
+        return
 
-    await context.bot.send_message(
-        ADMIN_ID,
-        f"⚠️ *Verification Needed*\n\n"
-        f"Channel: {MANAGED_CHANNELS[chat_id]['name']}\n"
-        f"User: [{user.first_name}]({user_link})\n"
-        f"ID: `{user.id}`\n"
-        f"Username: @{user.username or 'None'}\n"
-        f"Status: Borderline - needs verification\n\n"
-        f"Math Captcha: {num1} + {num2} = ?\n"
-        f"Answer: {answer}\n\n"
-        f"Reason: {legitimacy.get('reason', 'Unknown')}",
-        parse_mode='Markdown',
-        reply_markup=InlineKeyboardMarkup(keyboard))
+    if channel_id not in MANAGED_CHANNELS:
+        await update.message.reply_text("❌ Channel not managed")
+        return
 
-    logger.info(f"⚠️ Sent verification request for user: {user.id}")
+    action = context.args[1].lower()
+    if action == 'default':
+        CHANNEL_EXPIRY_ACTIONS.pop(channel_id, None)
+        persist_change('channel_expiry_actions', 'del', channel_id)
+    else:
+        CHANNEL_EXPIRY_ACTIONS[channel_id] = action
+        persist_change('channel_expiry_actions', 'set', channel_id, action)
+
+    await update.message.reply_text(
+        f"✅ Expiry action for {MANAGED_CHANNELS[channel_id]['name']}: {expiry_action(channel_id)}")
 
 
-async def enter_code_callback(update: Update,
-                              context: ContextTypes.DEFAULT_TYPE):
-    """Handle admin's approval via button click"""
+async def decline_code_callback(update: Update,
+                                context: ContextTypes.DEFAULT_TYPE):
+    """Handle admin's decline via button click"""
     query = update.callback_query
 
     if query.from_user.id != ADMIN_ID:
@@ -565,39 +4078,19 @@ async def enter_code_callback(update: Update,
         await query.edit_message_text("❌ Verification expired or already processed")
         return
 
-    verification = PENDING_VERIFICATIONS[user_id]
-    chat_id = verification['chat_id']
-
     try:
-        # Approve the join request
-        request = verification.get('request')
-        if request:
-            await request.approve()
-        else:
-            # Fallback: Try to approve via invite link
-            logger.warning(f"No request object found for user {user_id}")
-
-        # Track approval
-        track_user_activity(user_id, chat_id, 'approved', {
-            'first_name': USER_DATABASE.get(user_id, {}).get('first_name', 'Unknown')
-        })
-
-        # Remove from pending
-        del PENDING_VERIFICATIONS[user_id]
-
+        declined = await decline_pending(context.bot, user_id)
         await query.edit_message_text(
-            f"✅ *User Approved*\n\n"
+            f"❌ *User Declined*\n\n"
             f"User ID: `{user_id}`\n"
-            f"Channel: {MANAGED_CHANNELS[chat_id]['name']}",
+            f"Channel: {_channel_names(declined) or 'None (request expired)'}",
             parse_mode='Markdown')
 
-        logger.info(f"✅ Admin manually approved user: {user_id}")
+        logger.info(f"❌ Admin declined user: {user_id}")
 
     except Exception as e:
-        logger.error(f"Manual approval failed: {e}")
-        await query.edit_message_text(
-            f"❌ Approval failed\n\nError: {str(e)}",
-            parse_mode='Markdown')
+        logger.error(f"Manual decline failed: {e}")
+        await query.edit_message_text(f"❌ Decline failed\n\nError: {str(e)}")
 
 
 async def resend_code_callback(update: Update,
@@ -612,6 +4105,86 @@ async def resend_code_callback(update: Update,
     await query.answer("Feature not applicable for this verification system")
 
 
+# ========== BATCH EXECUTOR ==========
+async def run_batch(items, worker, message=None, title: str = 'Working', total: int = None) -> tuple:
+    """
+    Run worker(item) for every item with BATCH_CONCURRENCY workers pulling from
+    one iterator, so items can be a lazy stream. Bot API calls still go through
+    the rate limiter. Debounced flushes are held during the batch, which instead
+    writes its changes (and anything else changed meanwhile) every
+    BATCH_FLUSH_EVERY items and at least every BATCH_PROGRESS_SECONDS. If
+    message is given it is edited with the progress on the same timer.
+
+    worker returns True (done) or False (skipped); an exception makes the item
+    a failure. Returns (done, skipped, failures) with failures as [(item, reason)].
+    An error from items itself stops the batch and is raised.
+    """
+    iterator = iter(items)
+    counts = {'done': 0, 'skipped': 0}
+    failures = []
+    started = time.monotonic()
+
+    async def work():
+        for item in iterator:
+            try:
+                counts['done' if await worker(item) else 'skipped'] += 1
+            except Exception as e:
+                failures.append((item, str(e)))
+            if (counts['done'] + counts['skipped'] + len(failures)) % BATCH_FLUSH_EVERY == 0:
+                await flush_changes()
+
+    async def tick():
+        while True:
+            await asyncio.sleep(BATCH_PROGRESS_SECONDS)
+            await flush_changes()
+            if message is None:
+                continue
+            processed = counts['done'] + counts['skipped'] + len(failures)
+            rate = processed / (time.monotonic() - started)
+            try:
+                await message.edit_text(
+                    f"⏳ {title}: {processed}/{total if total is not None else '?'}\n\n"
+                    f"✅ Done: {counts['done']}\n"
+                    f"⏭️ Skipped: {counts['skipped']}\n"
+                    f"❌ Failed: {len(failures)}\n"
+                    f"⚡ {rate:.1f}/s")
+            except Exception as e:
+                logger.warning(f"Progress update failed: {e}")
+
+    hold_persistence()
+    tasks = [asyncio.create_task(work()) for _ in range(BATCH_CONCURRENCY)]
+    ticker = asyncio.create_task(tick())
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # Stop every worker before releasing - none may still be changing state
+        for task in tasks + [ticker]:
+            task.cancel()
+        await asyncio.gather(*tasks, ticker, return_exceptions=True)
+        await release_persistence()
+    return counts['done'], counts['skipped'], failures
+
+
+async def send_failure_report(message, failures: list, name: str):
+    """Reply with a CSV of a batch's failures: the item (tuple items as columns), then the reason"""
+    file = BytesIO()
+    file.write(b"user_id,channel_id,reason\n" if failures and isinstance(failures[0][0], tuple)
+               else b"user_id,reason\n")
+    for item, reason in failures:
+        if isinstance(item, tuple):
+            item = ','.join('' if value is None else str(value) for value in item)
+        reason = reason.replace('"', '""')
+        file.write(f'{item},"{reason}"\n'.encode())
+    file.seek(0)
+    try:
+        await message.reply_document(
+            document=file,
+            filename=f"{name}_failures_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
+            caption=f"❌ {len(failures)} failed")
+    finally:
+        file.close()
+
+
 # ========== COMMAND HANDLERS ==========
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start command with all commands listed"""
@@ -640,7 +4213,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "━━━ VERIFICATION ━━━\n"
             "/set_fallback - Fallback channel\n"
             "/clear_fallback - Clear fallback\n"
-            "/verification_settings - View\n\n"
+            "/verification_settings - View\n"
+            "/set_policy - Channel rules & thresholds\n"
+            "/clear_policy - Back to default\n"
+            "/view_policies - All policies\n\n"
 
             "━━━ ACTIVITY ━━━\n"
             "/recent_activity - Who joined\n"
@@ -652,6 +4228,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "/approve_all_pending - Approve all\n"
             "/block_user - Block user\n"
             "/unblock_user - Unblock\n"
+            "/import_blocklist - Import ban list file\n"
+            "/clear_blocklist - Drop imported list\n"
+            "/set_expiry - Unanswered captcha action\n"
             "/toggle_bulk - Change mode\n\n"
 
             "━━━ MEDIA UPLOAD ━━━\n"
@@ -700,7 +4279,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             "━━━ ANALYTICS ━━━\n"
             "/user_stats - Stats\n"
-            "/export_users - Export CSV"
+            "/rescore_names - Re-check all names\n"
+            "/refresh_ages - Update account age table\n"
+            "/export_users - Export CSV\n"
+            "/export_users all - Include archived users"
         )
         await update.message.reply_text(text)
 
@@ -735,7 +4317,7 @@ async def add_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         MANAGED_CHANNELS[channel_id] = {'name': channel_name}
-        save_data()
+        persist_change('managed_channels', 'set', channel_id, MANAGED_CHANNELS[channel_id])
 
         logger.info(f"✅ Channel added successfully: {channel_name} ({channel_id})")
         logger.info(f"📊 Total managed channels: {len(MANAGED_CHANNELS)}")
@@ -774,15 +4356,25 @@ async def remove_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
             channel_name = MANAGED_CHANNELS[channel_id]['name']
             del MANAGED_CHANNELS[channel_id]
 
+            persist_change('managed_channels', 'del', channel_id)
+
             # Clean up related data
             if channel_id in AUTO_POST_ENABLED:
                 del AUTO_POST_ENABLED[channel_id]
+                persist_change('auto_post_enabled', 'del', channel_id)
             if channel_id in CHANNEL_MEDIA_QUEUE:
                 del CHANNEL_MEDIA_QUEUE[channel_id]
+                persist_change('channel_media_queue', 'del', channel_id)
             if channel_id in CHANNEL_LINKS:
                 del CHANNEL_LINKS[channel_id]
+                persist_change('channel_links', 'del', channel_id)
             if channel_id in CHANNEL_CONTENT_TYPE:
                 del CHANNEL_CONTENT_TYPE[channel_id]
+                persist_change('channel_content_type', 'del', channel_id)
+            if channel_id in VERIFICATION_POLICIES:
+                del VERIFICATION_POLICIES[channel_id]
+                invalidate_policy(channel_id)
+                persist_change('verification_policies', 'del', channel_id)
 
             # Remove scheduler job
             try:
@@ -790,8 +4382,6 @@ async def remove_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except:
                 pass
 
-            save_data()
-
             await update.message.reply_text(
                 f"✅ Channel removed!\n\n"
                 f"Name: {channel_name}\n"
@@ -841,12 +4431,15 @@ async def pending_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("No pending verifications")
         return
 
+    # Oldest first (insertion order); a long backlog is summarized, not listed
     text = "⏳ *Pending Verifications:*\n\n"
-    for user_id, data in PENDING_VERIFICATIONS.items():
-        channel_name = MANAGED_CHANNELS.get(data['chat_id'], {}).get('name', 'Unknown')
+    for user_id, data in islice(PENDING_VERIFICATIONS.items(), PENDING_LIST_LIMIT):
         text += f"User ID: `{user_id}`\n"
-        text += f"Channel: {channel_name}\n"
-        text += f"Captcha: {data['captcha_question']} = {data['code']}\n\n"
+        text += f"Channel: {_channel_names(data['chat_ids'])}\n"
+        text += f"Captcha: {data['captcha_question']} = {data['code']}"
+        text += " (escalated)\n\n" if data.get('escalated') else "\n\n"
+    if len(PENDING_VERIFICATIONS) > PENDING_LIST_LIMIT:
+        text += f"...and {len(PENDING_VERIFICATIONS) - PENDING_LIST_LIMIT} more"
 
     await update.message.reply_text(text, parse_mode='Markdown')
 
@@ -870,24 +4463,18 @@ async def manual_approve_user(update: Update,
             await update.message.reply_text("❌ User not in pending list")
             return
 
-        verification = PENDING_VERIFICATIONS[user_id]
-        chat_id = verification['chat_id']
-        request = verification.get('request')
-
-        if request:
-            await request.approve()
-            track_user_activity(user_id, chat_id, 'approved')
-            del PENDING_VERIFICATIONS[user_id]
+        approved = await approve_pending(context.bot, user_id)
+        if not approved:
+            await update.message.reply_text("❌ Cannot approve - request expired")
+            return
 
-            await update.message.reply_text(
-                f"✅ User approved!\n\n"
-                f"User ID: `{user_id}`\n"
-                f"Channel: {MANAGED_CHANNELS[chat_id]['name']}",
-                parse_mode='Markdown')
+        await update.message.reply_text(
+            f"✅ User approved!\n\n"
+            f"User ID: `{user_id}`\n"
+            f"Channel: {_channel_names(approved)}",
+            parse_mode='Markdown')
 
-            logger.info(f"✅ Manual approval: {user_id}")
-        else:
-            await update.message.reply_text("❌ Cannot approve - request expired")
+        logger.info(f"✅ Manual approval: {user_id}")
 
     except ValueError:
         await update.message.reply_text("❌ Invalid user ID")
@@ -906,40 +4493,180 @@ async def approve_all_pending(update: Update,
         await update.message.reply_text("No pending verifications")
         return
 
-    approved = 0
-    failed = 0
-
-    for user_id, verification in list(PENDING_VERIFICATIONS.items()):
-        try:
-            request = verification.get('request')
-            if request:
-                await request.approve()
-                track_user_activity(user_id, verification['chat_id'], 'approved')
-                del PENDING_VERIFICATIONS[user_id]
-                approved += 1
-            else:
-                failed += 1
-        except Exception as e:
-            logger.error(f"Approval failed for {user_id}: {e}")
-            failed += 1
+    if BATCH_LOCK.locked():
+        await update.message.reply_text("⏳ Another bulk operation is running - try again when it finishes")
+        return
 
-    await update.message.reply_text(
+    async def approve(user_id):
+        if user_id not in PENDING_VERIFICATIONS:
+            return False  # Handled meanwhile
+        return bool(await approve_pending(context.bot, user_id, {
+            'first_name': USER_DATABASE.get(user_id, {}).get('first_name', 'Unknown')
+        }))
+
+    async with BATCH_LOCK:
+        user_ids = list(PENDING_VERIFICATIONS)
+        progress = await update.message.reply_text(f"⏳ Approving {len(user_ids)} pending users...")
+        started = time.monotonic()
+        approved, skipped, failures = await run_batch(
+            user_ids, approve, progress, 'Approving', len(user_ids))
+
+    for user_id, reason in failures:
+        logger.error(f"Approval failed for {user_id}: {reason}")
+    await progress.edit_text(
         f"✅ *Bulk Approval Complete*\n\n"
         f"Approved: {approved}\n"
-        f"Failed: {failed}",
+        f"Skipped (withdrawn): {skipped}\n"
+        f"Failed: {len(failures)}\n"
+        f"Time: {time.monotonic() - started:.1f}s",
         parse_mode='Markdown')
+    if failures:
+        await send_failure_report(update.message, failures, 'approve_all')
 
 
 async def bulk_approve_from_file(update: Update,
                                  context: ContextTypes.DEFAULT_TYPE):
-    """Placeholder for bulk approve from file"""
+    """Start bulk approve mode: the next TXT/CSV file of user IDs is approved"""
     if await ignore_non_admin(update, context):
         return
 
+    channel_id = None
+    if context.args:
+        try:
+            channel_id = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("❌ Invalid channel ID")
+            return
+        if channel_id not in MANAGED_CHANNELS:
+            await update.message.reply_text("❌ Channel not managed")
+            return
+
+    context.user_data['bulk_approve_mode'] = True
+    context.user_data['bulk_approve_channel'] = channel_id
     await update.message.reply_text(
-        "To bulk approve:\n"
-        "1. Send me a text file with user IDs (one per line)\n"
-        "2. I'll approve them all")
+        "📥 *Bulk Approve*\n\n"
+        "Send a TXT or CSV file with one user ID per line, optionally followed "
+        "by a channel ID (`user_id,channel_id`). Headers are skipped.\n\n"
+        f"Channel for lines without one: "
+        f"{MANAGED_CHANNELS[channel_id]['name'] if channel_id else 'the channels the user is pending on'}\n"
+        "Blocked users are skipped.\n\n"
+        "Usage: `/bulk_approve [CHANNEL_ID]`\n"
+        "/cancel to stop",
+        parse_mode='Markdown')
+
+
+def _count_lines(path: str) -> int:
+    """Worker thread: line count of a file, read in fixed-size blocks"""
+    count = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            count += block.count(b'\n')
+    return count
+
+
+def _iter_bulk_ids(path: str, counts: dict):
+    """
+    Yield (user_id, channel_id or None) from a bulk approve file, one line at a
+    time, skipping headers, invalid lines and repeats within the last
+    BULK_DEDUPE_WINDOW lines (counted in counts). Memory stays flat: a repeat
+    further apart finds no join request left and is skipped as such.
+    """
+    recent = OrderedDict()  # Last BULK_DEDUPE_WINDOW distinct (user_id, channel_id) pairs
+    with open(path, 'rb') as f:
+        for line in f:
+            match = BULK_LINE_PATTERN.match(line)
+            if match is None:
+                counts['invalid'] += 1
+                continue
+            user_id = int(match.group(1))
+            channel_id = int(match.group(2)) if match.group(2) else None
+            if (user_id, channel_id) in recent:
+                counts['duplicate'] += 1
+                continue
+            recent[user_id, channel_id] = None
+            if len(recent) > BULK_DEDUPE_WINDOW:
+                recent.popitem(last=False)
+            yield user_id, channel_id
+
+
+async def handle_bulk_approve_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Approve the join requests listed in an uploaded TXT/CSV file"""
+    document = update.message.document
+    if not document.file_name or not document.file_name.lower().endswith(('.txt', '.csv')):
+        await update.message.reply_text("❌ Send a .txt or .csv file")
+        return
+
+    if BATCH_LOCK.locked():
+        await update.message.reply_text("⏳ Another bulk operation is running - try again when it finishes")
+        return
+
+    default_channel = context.user_data.pop('bulk_approve_channel', None)
+    context.user_data.pop('bulk_approve_mode', None)
+    counts = {'invalid': 0, 'duplicate': 0, 'blocked': 0, 'no_channel': 0, 'withdrawn': 0}
+
+    async def approve(item):
+        user_id, channel_id = item
+        if is_blocked(user_id):
+            counts['blocked'] += 1
+            return False
+        channel_id = channel_id or default_channel
+        if channel_id is not None and channel_id not in MANAGED_CHANNELS:
+            raise ValueError(f"channel {channel_id} not managed")
+
+        user_data = {'first_name': USER_DATABASE.get(user_id, {}).get('first_name', 'Unknown')}
+        verification = PENDING_VERIFICATIONS.get(user_id)
+        if verification is not None and (channel_id is None or channel_id in verification['chat_ids']):
+            # Pending verification - resolve it so the record and its expiry go too
+            resolved = await _resolve_pending(context.bot, user_id, True, user_data,
+                                              [channel_id] if channel_id is not None else None)
+        elif channel_id is None:
+            counts['no_channel'] += 1
+            return False
+        else:
+            try:
+                await call_with_retry(context.bot, 'approve_join', chat_id=channel_id,
+                                      user_id=user_id, user_data=user_data)
+                resolved = True
+            except BadRequest as e:
+                if 'HIDE_REQUESTER_MISSING' not in str(e).upper():
+                    raise
+                resolved = False
+        if not resolved:
+            counts['withdrawn'] += 1
+        return bool(resolved)
+
+    status = await update.message.reply_text("⏳ Reading file...")
+    fd, download_path = tempfile.mkstemp(dir=STORAGE_DIR, suffix='.bulk')
+    os.close(fd)
+    try:
+        async with BATCH_LOCK:
+            file = await context.bot.get_file(document.file_id)
+            await file.download_to_drive(download_path)
+            loop = asyncio.get_running_loop()
+            lines = await loop.run_in_executor(None, _count_lines, download_path)
+            started = time.monotonic()
+            approved, _, failures = await run_batch(
+                _iter_bulk_ids(download_path, counts), approve, status, 'Approving', lines)
+    except Exception as e:
+        logger.error(f"Bulk approve failed: {e}")
+        await status.edit_text(f"❌ Bulk approve failed\n\nError: {str(e)}")
+        return
+    finally:
+        os.remove(download_path)
+
+    await status.edit_text(
+        f"✅ Bulk Approve Complete\n\n"
+        f"Approved: {approved}\n"
+        f"Skipped - blocked: {counts['blocked']}\n"
+        f"Skipped - no request: {counts['withdrawn']}\n"
+        f"Skipped - no channel: {counts['no_channel']}\n"
+        f"Repeated lines: {counts['duplicate']}\n"
+        f"Invalid lines: {counts['invalid']}\n"
+        f"Failed: {len(failures)}\n"
+        f"Time: {time.monotonic() - started:.1f}s")
+    logger.info(f"✅ Bulk approve: {approved} approved, {len(failures)} failed, {counts}")
+    if failures:
+        await send_failure_report(update.message, failures, 'bulk_approve')
 
 
 async def toggle_bulk_approval(update: Update,
@@ -966,7 +4693,7 @@ async def toggle_bulk_approval(update: Update,
 
         current_status = BULK_APPROVAL_MODE.get(channel_id, False)
         BULK_APPROVAL_MODE[channel_id] = not current_status
-        save_data()
+        persist_change('bulk_approval_mode', 'set', channel_id, BULK_APPROVAL_MODE[channel_id])
 
         new_mode = "🔄 Bulk Mode (approve everyone)" if BULK_APPROVAL_MODE[channel_id] else "🛡️ Smart Verification"
 
@@ -998,7 +4725,7 @@ async def block_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = int(context.args[0])
         BLOCKED_USERS.add(user_id)
-        save_data()
+        persist_change('blocked_users', 'add', value=user_id)
 
         await update.message.reply_text(
             f"✅ User blocked!\n\n"
@@ -1028,12 +4755,16 @@ async def unblock_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if user_id in BLOCKED_USERS:
             BLOCKED_USERS.remove(user_id)
-            save_data()
+            persist_change('blocked_users', 'discard', value=user_id)
             await update.message.reply_text(
                 f"✅ User unblocked!\n\n"
                 f"User ID: `{user_id}`",
                 parse_mode='Markdown')
             logger.info(f"✅ User unblocked: {user_id}")
+        elif BLOCKLIST is not None and user_id in BLOCKLIST:
+            await update.message.reply_text(
+                "❌ User is on the imported blocklist\n\n"
+                "Remove them from the file and re-import after /clear_blocklist")
         else:
             await update.message.reply_text("❌ User not in blocked list")
 
@@ -1041,6 +4772,76 @@ async def unblock_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Invalid user ID")
 
 
+async def import_blocklist_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Start blocklist import mode: the next TXT/CSV file is merged into the blocklist"""
+    if await ignore_non_admin(update, context):
+        return
+
+    context.user_data['blocklist_upload_mode'] = True
+    await update.message.reply_text(
+        "📥 *Blocklist Import*\n\n"
+        "Send a TXT or CSV file with one user ID per line "
+        "(the first number on each line is used, headers are skipped).\n\n"
+        f"Currently imported: {len(BLOCKLIST) if BLOCKLIST is not None else 0} IDs\n\n"
+        "/cancel to stop",
+        parse_mode='Markdown')
+
+
+async def handle_blocklist_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Stream an uploaded ban list into the blocklist index"""
+    document = update.message.document
+    if not document.file_name or not document.file_name.lower().endswith(('.txt', '.csv')):
+        await update.message.reply_text("❌ Send a .txt or .csv file")
+        return
+
+    context.user_data.pop('blocklist_upload_mode', None)
+    status = await update.message.reply_text("⏳ Importing blocklist...")
+    fd, download_path = tempfile.mkstemp(dir=STORAGE_DIR, suffix='.import')
+    os.close(fd)
+    try:
+        async with BLOCKLIST_IMPORT_LOCK:
+            file = await context.bot.get_file(document.file_id)
+            await file.download_to_drive(download_path)
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(None, _import_blocklist, download_path)
+            load_blocklist()
+    except Exception as e:
+        logger.error(f"Blocklist import failed: {e}")
+        await status.edit_text(f"❌ Import failed\n\nError: {str(e)}")
+        return
+    finally:
+        os.remove(download_path)
+
+    await status.edit_text(
+        f"✅ Blocklist imported!\n\n"
+        f"Lines read: {result['lines']}\n"
+        f"IDs found: {result['parsed']}\n"
+        f"New IDs: {result['added']}\n"
+        f"Total blocked (imported): {result['total']}")
+    logger.info(f"✅ Blocklist import: {result}")
+
+
+async def clear_blocklist_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Drop the imported blocklist (manual /block_user entries stay)"""
+    global BLOCKLIST
+
+    if await ignore_non_admin(update, context):
+        return
+
+    if not os.path.exists(BLOCKLIST_FILE):
+        await update.message.reply_text("❌ No imported blocklist")
+        return
+
+    # A stored list that failed to load can be dropped too
+    count = f"{len(BLOCKLIST)} IDs" if BLOCKLIST is not None else "unreadable"
+    async with BLOCKLIST_IMPORT_LOCK:
+        BLOCKLIST = None
+        os.remove(BLOCKLIST_FILE)
+    await update.message.reply_text(
+        f"✅ Imported blocklist cleared ({count})\n\n"
+        f"Users blocked with /block_user stay blocked")
+
+
 async def verification_settings(update: Update,
                                 context: ContextTypes.DEFAULT_TYPE):
     """Show verification settings"""
@@ -1049,17 +4850,12 @@ async def verification_settings(update: Update,
 
     text = (
         f"⚙️ *Smart Verification Settings*\n\n"
-        f"**Auto-Approve (Score ≥70):**\n"
-        f"• Has real name (40 pts)\n"
-        f"• Has username (30 pts)\n"
-        f"• Has profile photo (30 pts)\n\n"
-        f"**Math Captcha (Score 30-69):**\n"
-        f"• Borderline users\n"
-        f"• Admin decides\n\n"
-        f"**Auto-Reject (Score 0):**\n"
-        f"• Bot accounts\n"
-        f"• 'User123456' names\n"
-        f"• Suspicious profiles\n\n"
+        f"**Default Policy:**\n"
+        f"{describe_policy(default_policy())}\n\n"
+        f"**Auto-Approve:** score reaches the approve threshold\n"
+        f"**Math Captcha:** borderline users - admin decides\n"
+        f"**Auto-Reject:** bot accounts, score below the reject threshold\n\n"
+        f"Custom policies: {len(VERIFICATION_POLICIES)} (see /view_policies)\n\n"
         f"*Current Settings:*\n"
         f"Profile Photo Required: {REQUIRE_PROFILE_PHOTO}\n"
         f"Min Account Age: {MIN_ACCOUNT_AGE_DAYS} days\n"
@@ -1070,6 +4866,109 @@ async def verification_settings(update: Update,
     await update.message.reply_text(text, parse_mode='Markdown')
 
 
+# ========== VERIFICATION POLICY COMMANDS ==========
+async def set_policy_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Set (or adjust) the verification policy of a channel"""
+    if await ignore_non_admin(update, context):
+        return
+
+    if len(context.args) < 2:
+        await update.message.reply_text(
+            "Usage: `/set_policy CHANNEL_ID rule=weight ... [approve=N] [reject=N] [base=N]`\n\n"
+            f"Rules: {', '.join(POLICY_RULES)}\n"
+            "Extra: `languages=en,de` (language rule), `min_age_days=N` (age rule)\n\n"
+            "Example:\n"
+            "`/set_policy -100123 name=40 username=20 premium=20 age=20 photo=20 approve=70 reject=30`\n\n"
+            "Unlisted settings keep their current value; weight 0 turns a rule off.",
+            parse_mode='Markdown')
+        return
+
+    try:
+        channel_id = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("❌ Invalid channel ID")
+        return
+
+    if channel_id not in MANAGED_CHANNELS:
+        await update.message.reply_text("❌ Channel not managed")
+        return
+
+    current = VERIFICATION_POLICIES.get(channel_id) or default_policy()
+    policy = dict(current, rules=dict(current['rules']))
+    try:
+        for arg in context.args[1:]:
+            name, _, value = arg.partition('=')
+            name = name.lower()
+            if name in POLICY_RULES:
+                policy['rules'][name] = int(value)
+            elif name in POLICY_SETTINGS:
+                policy[name] = int(value)
+            elif name == 'languages':
+                policy['languages'] = [code.strip().lower() for code in value.split(',') if code.strip()]
+            else:
+                await update.message.reply_text(f"❌ Unknown setting: {name}")
+                return
+    except ValueError:
+        await update.message.reply_text("❌ Weights and thresholds must be whole numbers")
+        return
+
+    if policy['reject'] > policy['approve']:
+        await update.message.reply_text("❌ reject threshold must not exceed approve threshold")
+        return
+
+    VERIFICATION_POLICIES[channel_id] = policy
+    invalidate_policy(channel_id)
+    persist_change('verification_policies', 'set', channel_id, policy)
+
+    await update.message.reply_text(
+        f"✅ Policy set for {MANAGED_CHANNELS[channel_id]['name']}\n\n"
+        f"{describe_policy(policy)}")
+    logger.info(f"✅ Set verification policy for {channel_id}: {policy}")
+
+
+async def clear_policy_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Revert a channel to the default verification policy"""
+    if await ignore_non_admin(update, context):
+        return
+
+    if not context.args:
+        await update.message.reply_text("Usage: `/clear_policy CHANNEL_ID`", parse_mode='Markdown')
+        return
+
+    try:
+        channel_id = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("❌ Invalid channel ID")
+        return
+
+    if channel_id not in VERIFICATION_POLICIES:
+        await update.message.reply_text("❌ No custom policy set for this channel")
+        return
+
+    del VERIFICATION_POLICIES[channel_id]
+    invalidate_policy(channel_id)
+    persist_change('verification_policies', 'del', channel_id)
+    await update.message.reply_text(
+        f"✅ Policy cleared!\n\n"
+        f"Channel: {MANAGED_CHANNELS.get(channel_id, {}).get('name', 'Unknown')}\n"
+        f"Now using the default policy")
+
+
+async def view_policies_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the verification policy of every channel"""
+    if await ignore_non_admin(update, context):
+        return
+
+    text = f"🛂 Verification Policies\n\nDefault:\n{describe_policy(default_policy())}\n\n"
+    for channel_id, data in MANAGED_CHANNELS.items():
+        if channel_id in VERIFICATION_POLICIES:
+            text += f"⚙️ {data['name']} (custom)\n{describe_policy(VERIFICATION_POLICIES[channel_id])}\n\n"
+        else:
+            text += f"📌 {data['name']}: default\n\n"
+
+    await update.message.reply_text(text)
+
+
 # ========== FALLBACK CHANNEL COMMANDS ==========
 async def set_fallback_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Set global fallback channel for rejected users"""
@@ -1086,7 +4985,7 @@ async def set_fallback_command(update: Update, context: ContextTypes.DEFAULT_TYP
         return
 
     GLOBAL_FALLBACK_CHANNEL = context.args[0]
-    save_data()
+    persist_change('global_fallback_channel', 'set', value=GLOBAL_FALLBACK_CHANNEL)
 
     await update.message.reply_text(
         f"✅ Fallback channel set!\n\n"
@@ -1101,7 +5000,7 @@ async def clear_fallback_command(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     GLOBAL_FALLBACK_CHANNEL = ""
-    save_data()
+    persist_change('global_fallback_channel', 'set', value=GLOBAL_FALLBACK_CHANNEL)
 
     await update.message.reply_text("✅ Fallback channel cleared")
 
@@ -1140,7 +5039,7 @@ async def upload_media_command(update: Update, context: ContextTypes.DEFAULT_TYP
 
         # Set channel content type to media
         CHANNEL_CONTENT_TYPE[channel_id] = 'media'
-        save_data()
+        persist_change('channel_content_type', 'set', channel_id, 'media')
 
         await update.message.reply_text(
             f"📤 *Media Upload Mode: {MANAGED_CHANNELS[channel_id]['name']}*\n\n"
@@ -1231,7 +5130,8 @@ async def clear_media_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     if context.args[0].lower() == 'all':
         CHANNEL_MEDIA_QUEUE.clear()
         CURRENT_IMAGE_INDEX.clear()
-        save_data()
+        persist_change('channel_media_queue', 'clear')
+        persist_change('current_image_index', 'clear')
         await update.message.reply_text("✅ All media cleared")
         return
 
@@ -1241,9 +5141,10 @@ async def clear_media_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         if channel_id in CHANNEL_MEDIA_QUEUE:
             count = len(CHANNEL_MEDIA_QUEUE[channel_id])
             del CHANNEL_MEDIA_QUEUE[channel_id]
+            persist_change('channel_media_queue', 'del', channel_id)
             if channel_id in CURRENT_IMAGE_INDEX:
                 del CURRENT_IMAGE_INDEX[channel_id]
-            save_data()
+                persist_change('current_image_index', 'del', channel_id)
             await update.message.reply_text(f"✅ Cleared {count} media items")
         else:
             await update.message.reply_text("❌ No media for this channel")
@@ -1287,7 +5188,7 @@ async def upload_links_command(update: Update, context: ContextTypes.DEFAULT_TYP
 
         # Set channel content type to links
         CHANNEL_CONTENT_TYPE[channel_id] = 'links'
-        save_data()
+        persist_change('channel_content_type', 'set', channel_id, 'links')
 
         await update.message.reply_text(
             f"🔗 *Links Upload Mode: {MANAGED_CHANNELS[channel_id]['name']}*\n\n"
@@ -1362,9 +5263,10 @@ async def clear_links_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         if channel_id in CHANNEL_LINKS:
             count = len(CHANNEL_LINKS[channel_id])
             del CHANNEL_LINKS[channel_id]
+            persist_change('channel_links', 'del', channel_id)
             if channel_id in CHANNEL_LINK_INDEX:
                 del CHANNEL_LINK_INDEX[channel_id]
-            save_data()
+                persist_change('channel_link_index', 'del', channel_id)
             await update.message.reply_text(f"✅ Cleared {count} links")
         else:
             await update.message.reply_text("❌ No links for this channel")
@@ -1401,7 +5303,7 @@ async def set_channel_type_command(update: Update, context: ContextTypes.DEFAULT
             return
 
         CHANNEL_CONTENT_TYPE[channel_id] = content_type
-        save_data()
+        persist_change('channel_content_type', 'set', channel_id, content_type)
 
         await update.message.reply_text(
             f"✅ Channel type set!\n\n"
@@ -1503,7 +5405,7 @@ async def set_interval_command(update: Update, context: ContextTypes.DEFAULT_TYP
             'min': min_mins,
             'max': max_mins
         }
-        save_data()
+        persist_change('channel_intervals', 'set', channel_id, CHANNEL_INTERVALS[channel_id])
 
         # Convert to hours for display
         min_hours = min_mins / 60
@@ -1539,7 +5441,7 @@ async def clear_interval_command(update: Update, context: ContextTypes.DEFAULT_T
 
         if channel_id in CHANNEL_INTERVALS:
             del CHANNEL_INTERVALS[channel_id]
-            save_data()
+            persist_change('channel_intervals', 'del', channel_id)
             await update.message.reply_text(
                 f"✅ Interval cleared!\n\n"
                 f"Channel: {MANAGED_CHANNELS.get(channel_id, {}).get('name', 'Unknown')}\n"
@@ -1695,7 +5597,8 @@ async def clear_images(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     UPLOADED_IMAGES.clear()
     CHANNEL_SPECIFIC_IMAGES.clear()
-    save_data()
+    persist_change('uploaded_images', 'clear')
+    persist_change('channel_specific_images', 'clear')
 
     await update.message.reply_text("✅ All legacy images cleared")
 
@@ -1715,7 +5618,7 @@ async def set_default_caption(update: Update,
         return
 
     DEFAULT_CAPTION = ' '.join(context.args)
-    save_data()
+    persist_change('default_caption', 'set', value=DEFAULT_CAPTION)
 
     await update.message.reply_text(
         f"✅ Default caption set!\n\n"
@@ -1732,7 +5635,7 @@ async def clear_default_caption(update: Update,
         return
 
     DEFAULT_CAPTION = ""
-    save_data()
+    persist_change('default_caption', 'set', value=DEFAULT_CAPTION)
 
     await update.message.reply_text("✅ Default caption cleared")
 
@@ -1758,7 +5661,7 @@ async def set_channel_caption(update: Update,
             return
 
         CHANNEL_DEFAULT_CAPTIONS[channel_id] = caption
-        save_data()
+        persist_change('channel_default_captions', 'set', channel_id, caption)
 
         await update.message.reply_text(
             f"✅ Caption set for {MANAGED_CHANNELS[channel_id]['name']}!\n\n"
@@ -1786,7 +5689,7 @@ async def clear_channel_caption(update: Update,
 
         if channel_id in CHANNEL_DEFAULT_CAPTIONS:
             del CHANNEL_DEFAULT_CAPTIONS[channel_id]
-            save_data()
+            persist_change('channel_default_captions', 'del', channel_id)
             await update.message.reply_text("✅ Channel caption cleared")
         else:
             await update.message.reply_text("❌ No caption set for this channel")
@@ -1906,7 +5809,9 @@ async def clear_promo1_command(update: Update, context: ContextTypes.DEFAULT_TYP
             del PROMO_IMAGES[channel_id]['promo1']
             if not PROMO_IMAGES[channel_id]:
                 del PROMO_IMAGES[channel_id]
-            save_data()
+                persist_change('promo_images', 'del', channel_id)
+            else:
+                persist_change('promo_images', 'set', channel_id, PROMO_IMAGES[channel_id])
             await update.message.reply_text("✅ Promo 1 cleared")
         else:
             await update.message.reply_text("❌ No promo 1 set for this channel")
@@ -1933,7 +5838,9 @@ async def clear_promo2_command(update: Update, context: ContextTypes.DEFAULT_TYP
             del PROMO_IMAGES[channel_id]['promo2']
             if not PROMO_IMAGES[channel_id]:
                 del PROMO_IMAGES[channel_id]
-            save_data()
+                persist_change('promo_images', 'del', channel_id)
+            else:
+                persist_change('promo_images', 'set', channel_id, PROMO_IMAGES[channel_id])
             await update.message.reply_text("✅ Promo 2 cleared")
         else:
             await update.message.reply_text("❌ No promo 2 set for this channel")
@@ -1962,11 +5869,12 @@ async def enable_autopost(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         AUTO_POST_ENABLED[channel_id] = True
 
+        persist_change('auto_post_enabled', 'set', channel_id, True)
+
         # Initialize post counter if not exists
         if channel_id not in POST_COUNTER:
             POST_COUNTER[channel_id] = 0
-
-        save_data()
+            persist_change('post_counter', 'set', channel_id, 0)
 
         # Check content availability
         content_type = CHANNEL_CONTENT_TYPE.get(channel_id, 'media')
@@ -2030,7 +5938,7 @@ async def disable_autopost(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if channel_id in AUTO_POST_ENABLED:
             AUTO_POST_ENABLED[channel_id] = False
-            save_data()
+            persist_change('auto_post_enabled', 'set', channel_id, False)
 
             # Remove scheduler job
             try:
@@ -2106,6 +6014,10 @@ async def auto_post_job(bot, channel_id: int):
     4. Random intervals (12-28 minutes)
     5. Loop back when content is exhausted
     """
+    # Position before this post, restored if it fails transiently so the retry
+    # posts the same item instead of skipping it
+    position = (POST_COUNTER.get(channel_id), CURRENT_IMAGE_INDEX.get(channel_id),
+                CHANNEL_LINK_INDEX.get(channel_id))
     try:
         if not AUTO_POST_ENABLED.get(channel_id):
             return
@@ -2159,7 +6071,7 @@ async def auto_post_job(bot, channel_id: int):
             )
 
             logger.info(f"✅ Posted link #{current_position} to channel {channel_id}")
-            save_data()
+            persist_change('channel_link_index', 'set', channel_id, CHANNEL_LINK_INDEX[channel_id])
 
         # ========== MEDIA CHANNEL (Images + Videos) ==========
         else:
@@ -2284,7 +6196,12 @@ async def auto_post_job(bot, channel_id: int):
             promo_label = " (PROMO)" if is_promo else ""
             logger.info(f"✅ Posted {media_type} #{current_position}{promo_label} to channel {channel_id}")
 
-        save_data()
+            if channel_id in CURRENT_IMAGE_INDEX:
+                persist_change('current_image_index', 'set', channel_id, CURRENT_IMAGE_INDEX[channel_id])
+
+        persist_change('post_counter', 'set', channel_id, POST_COUNTER[channel_id])
+        AUTO_POST_FAILURES.pop(channel_id, None)
+        _count_retry('auto_post', 'ok')
 
         # Schedule next post with interval (custom or default)
         if channel_id in CHANNEL_INTERVALS:
@@ -2310,9 +6227,24 @@ async def auto_post_job(bot, channel_id: int):
     except Exception as e:
         logger.error(f"❌ Auto-post failed for channel {channel_id}: {e}")
 
-        # Retry in 20 minutes on error
+        # Flood waits/network errors: retry the same post after the server's
+        # retry_after or a growing backoff. Anything else: retry in 20 minutes
+        failures = AUTO_POST_FAILURES.get(channel_id, 0)
+        delay = retry_delay(e, failures)
+        if delay is not None:
+            AUTO_POST_FAILURES[channel_id] = failures + 1
+            for state, value in zip((POST_COUNTER, CURRENT_IMAGE_INDEX, CHANNEL_LINK_INDEX), position):
+                if value is None:
+                    state.pop(channel_id, None)
+                else:
+                    state[channel_id] = value
+            _count_retry('auto_post', 'deferred')
+        else:
+            delay = 20 * 60
+            _count_retry('auto_post', 'failed')
+
         try:
-            retry_time = datetime.now() + timedelta(minutes=20)
+            retry_time = datetime.now() + timedelta(seconds=delay)
             scheduler.add_job(
                 auto_post_job,
                 'date',
@@ -2324,30 +6256,66 @@ async def auto_post_job(bot, channel_id: int):
             pass
 
 
+def _user_csv_row(user_id: int, data: dict, archived_at='') -> bytes:
+    channels = ', '.join([ch['channel_name'] for ch in data['channels'].values()])
+    return (f"{user_id},{data['first_name']},{data['last_name']},{data['username']},"
+            f"{channels},{archived_at}\n").encode('utf-8')
+
+
+def _write_archived_csv(file) -> int:
+    """Worker thread: stream the cold user files into the export, return the row count"""
+    count = 0
+    for user_id, data, archived_at in iter_archived_users():
+        file.write(_user_csv_row(user_id, data, str(archived_at)[:10]))
+        count += 1
+    return count
+
+
 async def export_users_report(update: Update,
                               context: ContextTypes.DEFAULT_TYPE):
-    """Export user database"""
+    """Export user database (/export_users all|archived adds the cold files)"""
     if await ignore_non_admin(update, context):
         return
 
-    if not USER_DATABASE:
+    scope = context.args[0].lower() if context.args else 'hot'
+    include_hot = scope not in ('archive', 'archived')
+    include_archive = scope in ('all', 'archive', 'archived')
+
+    if include_hot and not include_archive and not USER_DATABASE:
         await update.message.reply_text("No user data to export")
         return
 
-    # Create CSV
-    csv_text = "User ID,First Name,Last Name,Username,Channels\n"
-    for user_id, data in USER_DATABASE.items():
-        channels = ', '.join([ch['channel_name'] for ch in data['channels'].values()])
-        csv_text += f"{user_id},{data['first_name']},{data['last_name']},{data['username']},{channels}\n"
+    # Rows go straight to a temp file, so the export never builds one big string
+    file = tempfile.TemporaryFile()
+    file.write("User ID,First Name,Last Name,Username,Channels,Archived\n".encode('utf-8'))
+    hot_count = archived_count = 0
+    if include_hot:
+        for user_id, data in USER_DATABASE.items():
+            file.write(_user_csv_row(user_id, data))
+            hot_count += 1
+    if include_archive:
+        loop = asyncio.get_running_loop()
+        archived_count = await loop.run_in_executor(None, _write_archived_csv, file)
+
+    if not hot_count and not archived_count:
+        file.close()
+        await update.message.reply_text("No user data to export")
+        return
 
     # Send as file
-    file = BytesIO(csv_text.encode('utf-8'))
-    file.name = f"users_{datetime.now().strftime('%Y%m%d')}.csv"
+    file.seek(0)
+    filename = f"users_{datetime.now().strftime('%Y%m%d')}.csv"
+    caption = f"📊 User Database Export\n\nTotal Users: {hot_count}"
+    if include_archive:
+        caption += f"\nArchived: {archived_count}"
 
-    await update.message.reply_document(
-        document=file,
-        filename=file.name,
-        caption=f"📊 User Database Export\n\nTotal Users: {len(USER_DATABASE)}")
+    try:
+        await update.message.reply_document(
+            document=file,
+            filename=filename,
+            caption=caption)
+    finally:
+        file.close()
 
 
 async def user_stats_command(update: Update,
@@ -2365,12 +6333,73 @@ async def user_stats_command(update: Update,
         f"Total Users: {total_users}\n"
         f"Approved: {approved_count}\n"
         f"Pending: {len(PENDING_VERIFICATIONS)}\n"
-        f"Blocked: {len(BLOCKED_USERS)}"
+        f"Blocked: {len(BLOCKED_USERS)}\n"
+        f"Imported blocklist: {len(BLOCKLIST) if BLOCKLIST is not None else 0}"
     )
 
     await update.message.reply_text(text, parse_mode='Markdown')
 
 
+async def rescore_names_command(update: Update,
+                                context: ContextTypes.DEFAULT_TYPE):
+    """Re-run the name check over all users after a rule change"""
+    if await ignore_non_admin(update, context):
+        return
+
+    # Snapshot on the event loop - joins keep changing the live dicts meanwhile
+    if isinstance(USER_DATABASE, UserStore):
+        users = USER_DATABASE.items()  # Decodes lazily, safe to walk from the worker
+    else:
+        users = list(USER_DATABASE.items())
+    pending_ids = set(PENDING_VERIFICATIONS)
+
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(None, _rescore_user_names, users, pending_ids)
+    # Cached verdicts were scored under the old rules
+    VERDICT_CACHE.entries.clear()
+
+    await update.message.reply_text(
+        f"🔎 *Name Rescore*\n\n"
+        f"Users scanned: {result['scanned']}\n"
+        f"Suspicious names: {result['flagged']}\n"
+        f"Of them pending: {result['pending_flagged']}\n"
+        f"Took: {result['seconds']:.2f}s\n\n"
+        f"Verdict cache cleared",
+        parse_mode='Markdown')
+
+
+async def refresh_ages_command(update: Update,
+                               context: ContextTypes.DEFAULT_TYPE):
+    """Rebuild the account age table from the users we have seen join"""
+    if await ignore_non_admin(update, context):
+        return
+
+    # Snapshot on the event loop - joins keep changing USER_DATABASE meanwhile
+    first_requests = [
+        (user_id, [membership['request_date'] for membership in user['channels'].values()
+                   if isinstance(membership.get('request_date'), datetime)])
+        for user_id, user in USER_DATABASE.items()
+    ]
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(None, refresh_account_ages, first_requests)
+    except Exception as e:
+        logger.error(f"Account age refresh failed: {e}")
+        await update.message.reply_text(f"❌ Refresh failed\n\nError: {str(e)}")
+        return
+    # Cached verdicts may have used the old estimates
+    VERDICT_CACHE.entries.clear()
+
+    newest = ACCOUNT_AGES.bounds()[-1:] or ACCOUNT_AGES.anchors()[-1:]
+    newest_id, newest_date = newest[0]
+    await update.message.reply_text(
+        f"📅 *Account Ages Refreshed*\n\n"
+        f"Observed bounds: {result['observed']}\n"
+        f"Built-in anchors: {result['anchors']}\n"
+        f"Newest: ID {newest_id} ≈ {newest_date.strftime('%Y-%m-%d')}",
+        parse_mode='Markdown')
+
+
 async def import_users_to_channel(update: Update,
                                   context: ContextTypes.DEFAULT_TYPE):
     """Import users (placeholder)"""
@@ -2391,7 +6420,7 @@ async def view_unauthorized_attempts(update: Update,
         return
 
     text = "🚨 *Unauthorized Attempts*\n\n"
-    for attempt in UNAUTHORIZED_ATTEMPTS[-10:]:  # Last 10
+    for attempt in UNAUTHORIZED_ATTEMPTS.last(10):
         text += (f"User: {attempt['first_name']}\n"
                 f"ID: `{attempt['user_id']}`\n"
                 f"Command: {attempt['command']}\n"
@@ -2516,22 +6545,22 @@ async def view_recent_activity(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("No recent activity")
         return
 
-    # Group by type
-    approved = [a for a in RECENT_ACTIVITY if a['type'] == 'auto_approved']
-    rejected = [a for a in RECENT_ACTIVITY if a['type'] == 'auto_rejected']
+    # Each type has its own ring - no scan over the whole log
+    approved = RECENT_ACTIVITY.last(10, 'auto_approved')
+    rejected = RECENT_ACTIVITY.last(5, 'auto_rejected')
 
     text = "📊 Recent Activity\n\n"
 
     # Show summary
-    text += f"✅ Auto-Approved: {len(approved)}\n"
-    text += f"❌ Auto-Rejected: {len(rejected)}\n"
+    text += f"✅ Auto-Approved: {RECENT_ACTIVITY.count('auto_approved')}\n"
+    text += f"❌ Auto-Rejected: {RECENT_ACTIVITY.count('auto_rejected')}\n"
     text += f"⚠️ Pending Captcha: {len(PENDING_VERIFICATIONS)}\n\n"
 
     # Show last 10 approved
     if approved:
         text += "━━━━━━━━━━━━━━━━━━\n"
         text += "✅ Recently Approved:\n\n"
-        for activity in approved[-10:]:
+        for activity in approved:
             text += f"• {activity['user_name']}\n"
             text += f"  @{activity['username']}\n"
             text += f"  Channel: {activity['channel']}\n"
@@ -2541,7 +6570,7 @@ async def view_recent_activity(update: Update, context: ContextTypes.DEFAULT_TYP
     if rejected:
         text += "━━━━━━━━━━━━━━━━━━\n"
         text += "❌ Recently Rejected:\n\n"
-        for activity in rejected[-5:]:
+        for activity in rejected:
             text += f"• {activity['user_name']}\n"
             text += f"  Reason: {activity['reason']}\n"
             text += f"  Fallback: {'✅' if activity.get('fallback_sent') else '❌'}\n"
@@ -2570,8 +6599,8 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     active_autoposts = sum(1 for v in AUTO_POST_ENABLED.values() if v)
 
     # Count recent activity
-    recent_approved = sum(1 for a in RECENT_ACTIVITY if a['type'] == 'auto_approved')
-    recent_rejected = sum(1 for a in RECENT_ACTIVITY if a['type'] == 'auto_rejected')
+    recent_approved = RECENT_ACTIVITY.count('auto_approved')
+    recent_rejected = RECENT_ACTIVITY.count('auto_rejected')
 
     # Count content
     total_media = sum(len(m) for m in CHANNEL_MEDIA_QUEUE.values())
@@ -2585,7 +6614,7 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"⏳ Pending: {len(PENDING_VERIFICATIONS)}\n"
             f"✅ Recent Approved: {recent_approved}\n"
             f"❌ Recent Rejected: {recent_rejected}\n"
-            f"🚫 Blocked: {len(BLOCKED_USERS)}\n\n"
+            f"🚫 Blocked: {len(BLOCKED_USERS)} (+{len(BLOCKLIST) if BLOCKLIST is not None else 0} imported)\n\n"
             f"📂 Media Queue: {total_media}\n"
             f"🔗 Links: {total_links}\n"
             f"📷 Old Images: {len(UPLOADED_IMAGES)}\n"
@@ -2595,6 +6624,14 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"🤖 Auto-Posts: {active_autoposts} active\n"
             f"👥 Total Users: {len(USER_DATABASE)}\n"
             f"🚨 Unauthorized: {len(UNAUTHORIZED_ATTEMPTS)}\n\n"
+            f"🧠 Verdict cache: {VERDICT_CACHE.summary()}\n"
+            f"👤 Profile cache: {PROFILE_CACHE.summary()}\n"
+            f"📥 Join queue: {JOIN_QUEUE.summary()}\n"
+            f"🚦 Rate limiter:\n{RATE_LIMITER.summary()}\n"
+            f"🔁 Retries: {retry_summary()}\n"
+            f"📬 Outbox: {outbox_summary()}\n"
+            f"🚨 Raid mode: {RAID_DETECTOR.summary()}\n"
+            f"📨 Digests: {DIGEST.summary()}\n\n"
             f"🌐 Fallback: {GLOBAL_FALLBACK_CHANNEL or 'Not set'}\n\n"
             f"Use /recent_activity for details\n\n"
             f"Status: Online 24/7 ✅")
@@ -2620,7 +6657,15 @@ async def handle_bulk_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await handle_links_file(update, context)
         return
 
-    await update.message.reply_text("Bulk file processing coming soon")
+    if context.user_data.get('blocklist_upload_mode'):
+        await handle_blocklist_file(update, context)
+        return
+
+    if context.user_data.get('bulk_approve_mode'):
+        await handle_bulk_approve_file(update, context)
+        return
+
+    await update.message.reply_text("Send /bulk_approve first to approve user IDs from a file")
 
 
 async def handle_links_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2651,14 +6696,15 @@ async def handle_links_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 if channel_id not in CHANNEL_LINKS:
                     CHANNEL_LINKS[channel_id] = []
 
-                links_added = 0
+                new_links = []
                 for line in lines:
                     link = line.strip()
                     if link and (link.startswith('http://') or link.startswith('https://')):
-                        CHANNEL_LINKS[channel_id].append(link)
-                        links_added += 1
+                        new_links.append(link)
 
-                save_data()
+                CHANNEL_LINKS[channel_id].extend(new_links)
+                links_added = len(new_links)
+                persist_change('channel_links', 'extend', channel_id, new_links)
 
                 await update.message.reply_text(
                     f"✅ Added {links_added} links from file!\n"
@@ -2718,7 +6764,7 @@ async def handle_media_upload(update: Update, context: ContextTypes.DEFAULT_TYPE
             'caption': caption
         }
 
-        save_data()
+        persist_change('promo_images', 'set', channel_id, PROMO_IMAGES[channel_id])
         context.user_data['setting_promo1'] = None
 
         await update.message.reply_text(
@@ -2738,7 +6784,7 @@ async def handle_media_upload(update: Update, context: ContextTypes.DEFAULT_TYPE
             'caption': caption
         }
 
-        save_data()
+        persist_change('promo_images', 'set', channel_id, PROMO_IMAGES[channel_id])
         context.user_data['setting_promo2'] = None
 
         await update.message.reply_text(
@@ -2761,7 +6807,8 @@ async def handle_media_upload(update: Update, context: ContextTypes.DEFAULT_TYPE
                 'caption': caption
             })
 
-            save_data()
+            persist_change('channel_media_queue', 'append', channel_id,
+                           CHANNEL_MEDIA_QUEUE[channel_id][-1])
 
             # Silent - only log
             count = len(CHANNEL_MEDIA_QUEUE[channel_id])
@@ -2781,12 +6828,12 @@ async def handle_media_upload(update: Update, context: ContextTypes.DEFAULT_TYPE
                 if channel_id not in CHANNEL_SPECIFIC_IMAGES:
                     CHANNEL_SPECIFIC_IMAGES[channel_id] = []
                 CHANNEL_SPECIFIC_IMAGES[channel_id].append(image_data)
+                persist_change('channel_specific_images', 'append', channel_id, image_data)
                 logger.info(f"✅ Image added to channel {channel_id}")
             else:
                 UPLOADED_IMAGES.append(image_data)
+                persist_change('uploaded_images', 'append', value=image_data)
                 logger.info(f"✅ Global image uploaded. Total: {len(UPLOADED_IMAGES)}")
-
-            save_data()
         return
 
     # Handle quick send mode
@@ -2824,7 +6871,7 @@ async def handle_text_content(update: Update, context: ContextTypes.DEFAULT_TYPE
                     CHANNEL_LINKS[channel_id] = []
 
                 CHANNEL_LINKS[channel_id].append(text)
-                save_data()
+                persist_change('channel_links', 'append', channel_id, text)
 
                 # Silent - only log
                 logger.info(f"✅ Link added to channel {channel_id}. Total: {len(CHANNEL_LINKS[channel_id])}")
@@ -2971,7 +7018,7 @@ def main():
     """Main function to start the bot"""
     logger.info("🚀 Starting SMART VERIFICATION BOT v2.0...")
     logger.info(f"✅ Admin ID: {ADMIN_ID}")
-    logger.info(f"✅ Storage: {STORAGE_FILE}")
+    logger.info(f"✅ Storage: {STATE_DIR} (+ journal)")
     logger.info(f"✅ Random Emojis: {len(CAPTION_EMOJIS)} emojis")
     logger.info(f"✅ Random Intervals: 12-28 minutes")
     logger.info(f"✅ Media Support: Images + Videos")
@@ -2981,7 +7028,8 @@ def main():
     # Load saved data
     load_data()
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = (Application.builder().token(BOT_TOKEN).rate_limiter(RATE_LIMITER)
+           .post_init(on_startup).post_shutdown(on_shutdown).build())
 
     # Command handlers - Basic
     app.add_handler(CommandHandler("start", start))
@@ -2999,7 +7047,13 @@ def main():
     app.add_handler(CommandHandler("toggle_bulk", toggle_bulk_approval))
     app.add_handler(CommandHandler("block_user", block_user))
     app.add_handler(CommandHandler("unblock_user", unblock_user))
+    app.add_handler(CommandHandler("import_blocklist", import_blocklist_command))
+    app.add_handler(CommandHandler("clear_blocklist", clear_blocklist_command))
+    app.add_handler(CommandHandler("set_expiry", set_expiry_command))
     app.add_handler(CommandHandler("verification_settings", verification_settings))
+    app.add_handler(CommandHandler("set_policy", set_policy_command))
+    app.add_handler(CommandHandler("clear_policy", clear_policy_command))
+    app.add_handler(CommandHandler("view_policies", view_policies_command))
 
     # Fallback channel commands
     app.add_handler(CommandHandler("set_fallback", set_fallback_command))
@@ -3059,6 +7113,8 @@ def main():
     # Analytics commands
     app.add_handler(CommandHandler("export_users", export_users_report))
     app.add_handler(CommandHandler("user_stats", user_stats_command))
+    app.add_handler(CommandHandler("rescore_names", rescore_names_command))
+    app.add_handler(CommandHandler("refresh_ages", refresh_ages_command))
     app.add_handler(CommandHandler("import_users", import_users_to_channel))
 
     # Activity commands
@@ -3069,6 +7125,8 @@ def main():
 
     # Callback handlers
     app.add_handler(CallbackQueryHandler(enter_code_callback, pattern="^enter_code_"))
+    app.add_handler(CallbackQueryHandler(decline_code_callback, pattern="^decline_code_"))
+    app.add_handler(CallbackQueryHandler(digest_callback, pattern="^digest_"))
     app.add_handler(CallbackQueryHandler(resend_code_callback, pattern="^resend_code_"))
     app.add_handler(CallbackQueryHandler(post_callback, pattern="^post_"))
 
@@ -3085,7 +7143,7 @@ def main():
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_content))
 
     # Join request handler - THE KEY COMPONENT
-    app.add_handler(ChatJoinRequestHandler(handle_join_request))
+    app.add_handler(ChatJoinRequestHandler(enqueue_join_request))
 
     # Error handler
     app.add_error_handler(error_handler)
@@ -3096,6 +7154,50 @@ def main():
                       trigger=CronTrigger(day_of_week='mon', hour=9),
                       args=[app.bot],
                       id='weekly_report')
+    scheduler.add_job(compact_journal_job,
+                      'interval',
+                      minutes=JOURNAL_COMPACT_CHECK_MINUTES,
+                      id='compact_journal')
+
+    # Retention: archive stale users and old activity
+    scheduler.add_job(retention_job,
+                      'interval',
+                      hours=ARCHIVE_CHECK_HOURS,
+                      id='retention')
+
+    # Deferred Bot API calls: retry the ones that are due
+    scheduler.add_job(deferred_ops_job,
+                      'interval',
+                      seconds=DEFERRED_CHECK_SECONDS,
+                      args=[app.bot],
+                      id='deferred_ops')
+
+    # DM outbox: fallback links to rejected users, within the outbox budget
+    scheduler.add_job(outbox_job,
+                      'interval',
+                      seconds=OUTBOX_SEND_SECONDS,
+                      args=[app.bot],
+                      id='outbox')
+
+    # Pending verifications: apply each channel's expiry action once unanswered
+    scheduler.add_job(pending_expiry_job,
+                      'interval',
+                      seconds=PENDING_SWEEP_SECONDS,
+                      args=[app.bot],
+                      id='pending_expiry')
+
+    # Raid mode: announcements, summaries, and ending raids once joins calm down
+    scheduler.add_job(raid_check_job,
+                      'interval',
+                      seconds=RAID_CHECK_SECONDS,
+                      args=[app.bot],
+                      id='raid_check')
+
+    # Activity logs: spill to disk so history survives restarts
+    scheduler.add_job(spill_activity_job,
+                      'interval',
+                      minutes=ACTIVITY_SPILL_MINUTES,
+                      id='spill_activity')
 
     # Re-enable auto-posting for saved channels
     for channel_id, enabled in AUTO_POST_ENABLED.items():
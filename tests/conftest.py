@@ -0,0 +1,38 @@
+"""
+Shared fixtures. bot.py keeps its state in module globals, so every test
+starts from the values the module had at import time.
+"""
+import copy
+import os
+import sys
+
+# bot.py refuses to import without these - the tests never talk to Telegram
+os.environ.setdefault('BOT_TOKEN', 'test')
+os.environ.setdefault('ADMIN_ID', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import bot
+
+INITIAL_STATE = {name: copy.deepcopy(getattr(bot, name)) for name in bot.STATE_GLOBALS.values()}
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    """Reset the persisted state and the journal bookkeeping around each test"""
+    for name, value in INITIAL_STATE.items():
+        monkeypatch.setattr(bot, name, copy.deepcopy(value))
+    monkeypatch.setattr(bot, 'PENDING_CHANGES', {})
+    monkeypatch.setattr(bot, 'PERSIST_FLUSH_HANDLE', None)
+    monkeypatch.setattr(bot, 'PERSIST_HOLDS', 0)
+    monkeypatch.setattr(bot, 'JOURNAL_SEQ', 0)
+    monkeypatch.setattr(bot, 'JOURNAL_RECORDS', 0)
+    monkeypatch.setattr(bot, 'STORAGE', None)
+
+
+def reset_state():
+    """Forget the in-memory state, as a restart would"""
+    for name, value in INITIAL_STATE.items():
+        setattr(bot, name, copy.deepcopy(value))
+    bot.JOURNAL_SEQ = 0
@@ -0,0 +1,124 @@
+"""
+A small local stand-in for a PostgREST server (what Supabase exposes), backed
+by an in-memory SQLite database with the bot's SQLITE_SCHEMA. It implements
+only what SupabaseStorage uses: GET with select/order/limit/offset, POST
+upserts with on_conflict + merge-duplicates, DELETE and PATCH with eq./is.
+filters. fail_next() makes the next requests answer with an error status.
+"""
+import json
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import bot
+
+
+class FakePostgREST:
+    def __init__(self):
+        self.db = sqlite3.connect(':memory:', check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(bot.SQLITE_SCHEMA)
+        self.lock = threading.Lock()
+        self.failures = []  # Status codes for the next requests
+        self.log = []  # (method, table, rows in the body)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+        self.db.close()
+
+    def fail_next(self, count: int, status: int = 503):
+        self.failures.extend([status] * count)
+
+    def rows(self, table: str) -> list:
+        with self.lock:
+            return [dict(row) for row in self.db.execute(f"SELECT * FROM {table}")]
+
+    # --- request handling ---
+
+    @staticmethod
+    def _where(params: dict) -> tuple:
+        clauses, values = [], []
+        for column, condition in params.items():
+            if condition == 'not.is.null':
+                clauses.append(f"{column} IS NOT NULL")
+            elif condition.startswith('eq.'):
+                clauses.append(f"{column} = ?")
+                values.append(condition[3:])
+            else:
+                raise ValueError(f"Unsupported filter {column}={condition}")
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', values
+
+    def handle(self, method: str, table: str, params: dict, body):
+        if self.failures:
+            return self.failures.pop(0), {'message': 'injected failure'}
+        self.log.append((method, table, len(body) if isinstance(body, list) else 0))
+
+        with self.lock, self.db:
+            if method == 'GET':
+                params.pop('select', None)
+                order = params.pop('order', None)
+                limit = int(params.pop('limit', -1))
+                offset = int(params.pop('offset', 0))
+                where, values = self._where(params)
+                sql = f"SELECT * FROM {table}{where}"
+                if order:
+                    sql += f" ORDER BY {order}"
+                sql += f" LIMIT {limit} OFFSET {offset}"
+                return 200, [dict(row) for row in self.db.execute(sql, values)]
+
+            if method == 'POST':
+                keys = params['on_conflict']
+                columns = sorted(body[0]) if body else []
+                if any(sorted(row) != columns for row in body):
+                    return 400, {'message': 'All object keys must match'}
+                updates = ', '.join(f"{c} = excluded.{c}" for c in columns if c not in keys.split(','))
+                sql = (f"INSERT INTO {table} ({', '.join(columns)}) "
+                       f"VALUES ({', '.join('?' for _ in columns)}) ON CONFLICT ({keys}) "
+                       + (f"DO UPDATE SET {updates}" if updates else "DO NOTHING"))
+                self.db.executemany(sql, [[row[c] for c in columns] for row in body])
+                return 201, None
+
+            where, values = self._where(params)
+            if method == 'DELETE':
+                self.db.execute(f"DELETE FROM {table}{where}", values)
+                return 204, None
+            if method == 'PATCH':
+                columns = list(body)
+                self.db.execute(f"UPDATE {table} SET {', '.join(f'{c} = ?' for c in columns)}{where}",
+                                [body[c] for c in columns] + values)
+                return 204, None
+        return 405, {'message': f'{method} not supported'}
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _serve(self):
+                url = urlsplit(self.path)
+                table = url.path.rsplit('/', 1)[-1]
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                status, payload = fake.handle(self.command, table, params, body)
+                data = json.dumps(payload).encode() if payload is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_DELETE = do_PATCH = _serve
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,97 @@
+from datetime import datetime
+
+import pytest
+
+import bot
+
+
+def day(user_id, table):
+    return datetime.fromordinal(int(table.registered(user_id))).date()
+
+
+@pytest.fixture
+def builtin():
+    return bot.AccountAgeTable.from_anchors(bot.ACCOUNT_ID_ANCHORS)
+
+
+def test_interpolates_between_anchors(builtin):
+    assert day(7_000_000_000, builtin) == datetime(2024, 5, 1).date()
+    middle = builtin.registered(7_250_000_000)
+    assert builtin.registered(7_000_000_000) < middle < builtin.registered(7_500_000_000)
+
+
+def test_extrapolates_past_the_newest_anchor(builtin):
+    assert builtin.registered(9_000_000_000) > builtin.registered(8_000_000_000)
+
+
+def test_anchor_dates_are_forced_to_rise():
+    table = bot.AccountAgeTable.from_anchors([
+        (0, datetime(2015, 1, 1)), (100, datetime(2020, 1, 1)), (200, datetime(2018, 1, 1))])
+    assert table.anchors() == [
+        (0, datetime(2015, 1, 1)), (100, datetime(2018, 1, 1)), (200, datetime(2018, 1, 1))]
+
+
+def test_observation_does_not_move_newer_ids(builtin):
+    table = bot.AccountAgeTable.from_anchors(
+        bot.ACCOUNT_ID_ANCHORS, [(7_900_000_000, datetime(2025, 1, 1))])
+    assert day(7_950_000_000, table) == day(7_950_000_000, builtin)
+    # IDs at or below the observation existed by then
+    assert day(7_900_000_000, table) == datetime(2025, 1, 1).date()
+    assert day(7_800_000_000, table) == datetime(2025, 1, 1).date()
+    assert day(7_000_000_000, table) == day(7_000_000_000, builtin)
+
+
+def test_flat_observations_do_not_freeze_extrapolation(builtin):
+    table = bot.AccountAgeTable.from_anchors(bot.ACCOUNT_ID_ANCHORS, [
+        (8_300_000_000, datetime(2025, 9, 1)), (8_310_000_000, datetime(2025, 9, 1))])
+    assert table.registered(9_500_000_000) == builtin.registered(9_500_000_000)
+
+
+def test_observations_never_make_an_account_younger(builtin):
+    table = bot.AccountAgeTable.from_anchors(
+        bot.ACCOUNT_ID_ANCHORS, [(5_000_000_000, datetime(2030, 1, 1))])
+    assert table.registered(4_000_000_000) == builtin.registered(4_000_000_000)
+
+
+def test_observed_anchors_take_suffix_minimum():
+    bounds = bot._observed_anchors([
+        (10, [datetime(2025, 3, 1), datetime(2025, 2, 1)]),
+        (20, [datetime(2025, 1, 1)]),
+        (30, [datetime(2025, 4, 1)]),
+        (40, [])
+    ])
+    assert bounds == [(10, datetime(2025, 1, 1)), (20, datetime(2025, 1, 1)), (30, datetime(2025, 4, 1))]
+
+
+def test_observed_anchors_are_thinned(monkeypatch):
+    monkeypatch.setattr(bot, 'ACCOUNT_AGE_MAX_ANCHORS', 5)
+    bounds = bot._observed_anchors([(user_id, [datetime(2025, 1, 1)]) for user_id in range(100)])
+    assert [user_id for user_id, _ in bounds] == [0, 25, 50, 74, 99]
+
+
+def test_dump_restore_round_trip():
+    table = bot.AccountAgeTable.from_anchors(
+        bot.ACCOUNT_ID_ANCHORS, [(7_900_000_000, datetime(2025, 1, 1))])
+    restored = bot.AccountAgeTable.restore(bot.decode_snapshot(bot.encode_snapshot(table.dump())))
+    assert restored.anchors() == table.anchors()
+    assert restored.bounds() == table.bounds()
+
+
+def test_restore_rejects_old_or_corrupt_tables(builtin):
+    with pytest.raises(KeyError):
+        bot.AccountAgeTable.restore({'ids': builtin.ids.tobytes(), 'days': builtin.days.tobytes()})
+    dumped = builtin.dump()
+    dumped['days'] = dumped['days'][:-4]
+    with pytest.raises(ValueError):
+        bot.AccountAgeTable.restore(dumped)
+
+
+def test_refresh_saves_the_table(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, 'ACCOUNT_AGE_FILE', str(tmp_path / 'account_ages.snap'))
+    monkeypatch.setattr(bot, 'ACCOUNT_AGES', bot.ACCOUNT_AGES)
+    result = bot.refresh_account_ages([(7_900_000_000, [datetime(2025, 1, 1)])])
+    assert result == {'observed': 1, 'anchors': len(bot.ACCOUNT_ID_ANCHORS)}
+
+    monkeypatch.setattr(bot, 'ACCOUNT_AGES', None)
+    bot.load_account_ages()
+    assert bot.ACCOUNT_AGES.bounds() == [(7_900_000_000, datetime(2025, 1, 1))]
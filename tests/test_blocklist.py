@@ -0,0 +1,69 @@
+import pytest
+
+import bot
+
+
+@pytest.fixture(autouse=True)
+def blocklist_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, 'STORAGE_DIR', str(tmp_path))
+    monkeypatch.setattr(bot, 'BLOCKLIST_FILE', str(tmp_path / 'blocklist.idx'))
+    monkeypatch.setattr(bot, 'BLOCKLIST', None)
+    return tmp_path
+
+
+def import_lines(tmp_path, name, lines):
+    source = tmp_path / name
+    source.write_text('\n'.join(lines) + '\n')
+    result = bot._import_blocklist(str(source))
+    bot.load_blocklist()
+    return result
+
+
+def test_import_parses_first_id_on_each_line(blocklist_dir):
+    result = import_lines(blocklist_dir, 'list.csv', [
+        'user_id,reason', '30,spam', '10', '"20";bot', '', '-5,chat', '10,again', 'n/a', '1234567890123456789'])
+    assert result == {'lines': 9, 'parsed': 4, 'added': 3, 'total': 3}
+    assert list(bot.BLOCKLIST) == [10, 20, 30]
+    assert len(bot.BLOCKLIST) == 3
+
+
+def test_lookup_uses_sorted_ids_and_bloom_filter(blocklist_dir):
+    import_lines(blocklist_dir, 'list.txt', [str(n) for n in range(1000, 3000, 2)])
+    assert bot.BLOCKLIST.bloom_bits == 1000 * bot.BLOCKLIST_BLOOM_BITS_PER_ID
+    assert all(n in bot.BLOCKLIST for n in range(1000, 3000, 2))
+    assert not any(n in bot.BLOCKLIST for n in range(1001, 3000, 2))
+    assert bot.is_blocked(1000) and not bot.is_blocked(999)
+
+
+def test_lookup_without_bloom_filter(blocklist_dir, monkeypatch):
+    monkeypatch.setattr(bot, 'BLOCKLIST_BLOOM_BITS_PER_ID', 0)
+    import_lines(blocklist_dir, 'list.txt', ['5', '7'])
+    assert bot.BLOCKLIST.bloom_bits == 0
+    assert 5 in bot.BLOCKLIST and 6 not in bot.BLOCKLIST and 8 not in bot.BLOCKLIST
+
+
+def test_import_merges_with_stored_list_across_chunks(blocklist_dir, monkeypatch):
+    monkeypatch.setattr(bot, 'BLOCKLIST_CHUNK', 3)
+    import_lines(blocklist_dir, 'first.txt', ['1', '5', '9'])
+    result = import_lines(blocklist_dir, 'second.txt', ['9', '2', '8', '5', '3', '7', '2'])
+    assert result == {'lines': 7, 'parsed': 7, 'added': 4, 'total': 7}
+    assert list(bot.BLOCKLIST) == [1, 2, 3, 5, 7, 8, 9]
+    assert sorted(p.name for p in blocklist_dir.iterdir()) == ['blocklist.idx', 'first.txt', 'second.txt']
+
+
+def test_import_merges_stored_file_that_was_not_loaded(blocklist_dir):
+    import_lines(blocklist_dir, 'first.txt', ['1', '2'])
+    bot.BLOCKLIST = None
+    result = import_lines(blocklist_dir, 'second.txt', ['3'])
+    assert result['total'] == 3
+    assert list(bot.BLOCKLIST) == [1, 2, 3]
+
+
+def test_import_refuses_to_replace_unreadable_list(blocklist_dir):
+    stored = blocklist_dir / 'blocklist.idx'
+    stored.write_bytes(b'not a blocklist' * 10)
+    source = blocklist_dir / 'list.txt'
+    source.write_text('1\n')
+    with pytest.raises(ValueError, match='unreadable'):
+        bot._import_blocklist(str(source))
+    assert stored.read_bytes() == b'not a blocklist' * 10
@@ -0,0 +1,41 @@
+import bot
+
+
+def parse(tmp_path, text: str):
+    source = tmp_path / 'bulk.csv'
+    source.write_bytes(text.encode())
+    counts = {'invalid': 0, 'duplicate': 0}
+    return list(bot._iter_bulk_ids(str(source), counts)), counts
+
+
+def test_reads_ids_and_optional_channel_column(tmp_path):
+    ids, counts = parse(tmp_path, 'user_id,channel_id\n'
+                                  '11\n'
+                                  '12,-1001\n'
+                                  '"13";"-1002"\n'
+                                  '  14\t-1003\r\n'
+                                  '15, 99\n'
+                                  '16,-1004,note\n'
+                                  '17 \n')
+    assert ids == [(11, None), (12, -1001), (13, -1002), (14, -1003), (15, None), (16, -1004), (17, None)]
+    assert counts == {'invalid': 1, 'duplicate': 0}
+
+
+def test_counts_invalid_lines(tmp_path):
+    ids, counts = parse(tmp_path, 'name\n\n-5\n1234567890123456789x\nabc,12\n7\n')
+    assert ids == [(7, None)]
+    assert counts['invalid'] == 5
+
+
+def test_skips_repeats_of_the_same_pair(tmp_path):
+    ids, counts = parse(tmp_path, '1\n1,-100\n1\n"1"\n1,-100\n2\n')
+    assert ids == [(1, None), (1, -100), (2, None)]
+    assert counts == {'invalid': 0, 'duplicate': 3}
+
+
+def test_dedupe_window_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, 'BULK_DEDUPE_WINDOW', 2)
+    ids, counts = parse(tmp_path, '1\n2\n1\n3\n2\n1\n')
+    # 1 is still in the window on its first repeat; by the last line 2 and 3 pushed it out
+    assert ids == [(1, None), (2, None), (3, None), (1, None)]
+    assert counts['duplicate'] == 2
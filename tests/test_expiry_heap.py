@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+
+import bot
+
+START = datetime(2025, 1, 1)
+
+
+def at(minutes: int) -> datetime:
+    return START + timedelta(minutes=minutes)
+
+
+def test_pop_due_returns_earliest_first():
+    heap = bot.ExpiryHeap()
+    for key, minutes in (('c', 30), ('a', 10), ('b', 20), ('d', 40)):
+        heap.schedule(key, at(minutes))
+    assert heap.pop_due(at(5)) == []
+    assert heap.pop_due(at(30)) == ['a', 'b', 'c']
+    assert len(heap) == 1
+    assert heap.pop_due(at(100)) == ['d']
+    assert heap.pop_due(at(100)) == []
+
+
+def test_cancel_skips_the_stale_entry():
+    heap = bot.ExpiryHeap()
+    heap.schedule('a', at(10))
+    heap.schedule('b', at(20))
+    heap.cancel('a')
+    heap.cancel('missing')
+    assert len(heap) == 1
+    assert heap.pop_due(at(30)) == ['b']
+
+
+def test_reschedule_uses_the_latest_deadline():
+    heap = bot.ExpiryHeap()
+    heap.schedule('a', at(10))
+    heap.schedule('a', at(50))
+    assert heap.pop_due(at(20)) == []
+    assert heap.pop_due(at(50)) == ['a']
+
+    heap.schedule('b', at(50))
+    heap.schedule('b', at(10))
+    assert heap.pop_due(at(10)) == ['b']
+    assert heap.pop_due(at(100)) == []
+
+
+def test_heap_is_rebuilt_when_stale_entries_pile_up():
+    heap = bot.ExpiryHeap()
+    for n in range(200):
+        heap.schedule(n, at(n))
+    for n in range(0, 200, 2):
+        heap.cancel(n)
+    assert len(heap) == 100
+    assert len(heap.heap) <= 2 * len(heap) + 64
+    assert heap.pop_due(at(1000)) == list(range(1, 200, 2))
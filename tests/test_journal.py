@@ -0,0 +1,163 @@
+from datetime import datetime
+
+import pytest
+
+import bot
+from conftest import reset_state
+
+
+@pytest.fixture(params=['binary', 'json'])
+def storage(request, tmp_path, monkeypatch):
+    """A JsonStorage in tmp_path, installed as bot.STORAGE (no event loop: writes go straight through)"""
+    def open_storage():
+        return bot.JsonStorage(str(tmp_path / 'state'), str(tmp_path / 'bot_data.json'),
+                               str(tmp_path / 'bot_data.journal'), request.param)
+
+    store = open_storage()
+    monkeypatch.setattr(bot, 'STORAGE', store)
+    store.reopen = open_storage
+    return store
+
+
+def restart(storage):
+    """Drop the in-memory state and load it back from disk"""
+    reset_state()
+    reloaded = storage.reopen()
+    reloaded.load()
+    bot.STORAGE = reloaded
+    return reloaded
+
+
+def make_changes():
+    bot.MANAGED_CHANNELS[-100] = {'name': 'Main'}
+    bot.persist_change('managed_channels', 'set', -100, bot.MANAGED_CHANNELS[-100])
+    bot.MANAGED_CHANNELS[-200] = {'name': 'Gone'}
+    bot.persist_change('managed_channels', 'set', -200, bot.MANAGED_CHANNELS[-200])
+    del bot.MANAGED_CHANNELS[-200]
+    bot.persist_change('managed_channels', 'del', -200)
+
+    bot.CHANNEL_LINKS[-100] = ['https://a']
+    bot.persist_change('channel_links', 'set', -100, bot.CHANNEL_LINKS[-100])
+    bot.CHANNEL_LINKS[-100].append('https://b')
+    bot.persist_change('channel_links', 'append', -100, 'https://b')
+    bot.CHANNEL_LINKS[-100].extend(['https://c', 'https://d'])
+    bot.persist_change('channel_links', 'extend', -100, ['https://c', 'https://d'])
+
+    bot.BLOCKED_USERS.update({7, 8})
+    bot.persist_change('blocked_users', 'add', value=7)
+    bot.persist_change('blocked_users', 'add', value=8)
+    bot.BLOCKED_USERS.discard(8)
+    bot.persist_change('blocked_users', 'discard', value=8)
+
+    bot.GLOBAL_FALLBACK_CHANNEL = 'https://t.me/fallback'
+    bot.persist_change('global_fallback_channel', 'set', value=bot.GLOBAL_FALLBACK_CHANNEL)
+
+    bot.track_user_activity(42, -100, 'approved', {'first_name': 'Ann', 'username': 'ann'})
+    bot.PENDING_VERIFICATIONS[43] = {
+        'code': '7', 'chat_ids': [-100], 'timestamp': datetime(2025, 1, 2, 3, 4, 5),
+        'captcha_question': '3 + 4'
+    }
+    bot.persist_change('pending_verifications', 'set', 43, bot.PENDING_VERIFICATIONS[43])
+
+
+def assert_state():
+    assert bot.MANAGED_CHANNELS == {-100: {'name': 'Main'}}
+    assert bot.CHANNEL_LINKS == {-100: ['https://a', 'https://b', 'https://c', 'https://d']}
+    assert bot.BLOCKED_USERS == {7}
+    assert bot.GLOBAL_FALLBACK_CHANNEL == 'https://t.me/fallback'
+    assert bot.USER_DATABASE[42]['first_name'] == 'Ann'
+    assert bot.USER_DATABASE[42]['channels'][-100]['status'] == 'approved'
+    assert isinstance(bot.USER_DATABASE[42]['channels'][-100]['request_date'], datetime)
+    assert bot.PENDING_VERIFICATIONS[43]['timestamp'] == datetime(2025, 1, 2, 3, 4, 5)
+
+
+def test_replay_restores_every_op(storage):
+    make_changes()
+    assert bot.JOURNAL_RECORDS == 12
+
+    restart(storage)
+    assert_state()
+    assert bot.JOURNAL_SEQ == 12
+
+
+def test_replaying_twice_does_not_duplicate_list_items(storage):
+    make_changes()
+    with open(storage.journal_file) as f:
+        journal = f.read()
+    with open(storage.journal_file, 'a') as f:
+        f.write(journal)
+
+    restart(storage)
+    assert_state()
+
+
+def test_torn_journal_tail_is_ignored(storage):
+    make_changes()
+    with open(storage.journal_file, 'a') as f:
+        f.write('{"seq": 99, "key": "managed_ch')
+
+    restart(storage)
+    assert_state()
+
+
+def test_compaction_folds_journal_into_sections(storage):
+    make_changes()
+    storage.compact()
+    with open(storage.journal_file) as f:
+        assert f.read() == ''
+
+    restart(storage)
+    assert_state()
+
+
+def test_changes_after_compaction_replay_on_top(storage):
+    make_changes()
+    storage.compact()
+    bot.CHANNEL_LINKS[-100].append('https://e')
+    bot.persist_change('channel_links', 'append', -100, 'https://e')
+    bot.track_user_activity(44, -100, 'pending', {'first_name': 'Bo'})
+
+    reloaded = restart(storage)
+    assert bot.CHANNEL_LINKS[-100][-1] == 'https://e'
+    assert bot.USER_DATABASE[44]['first_name'] == 'Bo'
+    assert bot.USER_DATABASE[42]['first_name'] == 'Ann'
+    # Only the sections with journal records are rewritten by the next compaction
+    assert reloaded.dirty == {'links', 'users'}
+
+
+def test_compaction_rewrites_only_dirty_sections(storage):
+    make_changes()
+    storage.compact()
+    versions = dict(storage.section_version)
+
+    bot.POST_COUNTER[-100] = 3
+    bot.persist_change('post_counter', 'set', -100, 3)
+    storage.compact()
+    changed = {section for section, version in storage.section_version.items()
+               if version != versions.get(section)}
+    assert changed == {'counters'}
+
+
+def test_failed_write_is_requeued_and_newer_change_wins(monkeypatch):
+    class FlakyStorage:
+        name = 'flaky'
+        failures = 1
+        batches = []
+
+        def write(self, records):
+            if self.failures:
+                self.failures -= 1
+                raise OSError('disk full')
+            self.batches.append([(r['key'], r.get('item'), r['op'], r.get('value')) for r in records])
+
+    storage = FlakyStorage()
+    monkeypatch.setattr(bot, 'STORAGE', storage)
+
+    bot.persist_change('post_counter', 'set', 1, 5)
+    assert storage.batches == []
+    assert len(bot.PENDING_CHANGES) == 1  # Kept for the next attempt
+
+    bot.persist_change('post_counter', 'set', 1, 6)
+    bot.persist_change('post_counter', 'set', 2, 7)
+    assert storage.batches == [[('post_counter', 1, 'set', 6)], [('post_counter', 2, 'set', 7)]]
+    assert bot.PENDING_CHANGES == {}
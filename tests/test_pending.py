@@ -0,0 +1,87 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from telegram.error import BadRequest
+
+import bot
+
+
+@pytest.fixture(autouse=True)
+def expiry(monkeypatch):
+    monkeypatch.setattr(bot, 'PENDING_EXPIRY', bot.ExpiryHeap())
+
+
+@pytest.fixture
+def failing():
+    return set()  # Chats whose call raises a permanent error
+
+
+@pytest.fixture
+def calls(monkeypatch, failing):
+    """call_with_retry stub: records (op, chat_id) and yields to the loop like an API call"""
+    made = []
+
+    async def call_with_retry(_bot, op, chat_id, user_id, **args):
+        made.append((op, chat_id))
+        await asyncio.sleep(0)
+        if chat_id in failing:
+            raise BadRequest('Chat not found')
+        return True
+
+    monkeypatch.setattr(bot, 'call_with_retry', call_with_retry)
+    return made
+
+
+def pending(user_id, *chat_ids):
+    bot.PENDING_VERIFICATIONS[user_id] = {'chat_ids': list(chat_ids), 'timestamp': datetime.now()}
+    bot.schedule_pending_expiry(user_id, bot.PENDING_VERIFICATIONS[user_id])
+
+
+async def gather(*resolutions):
+    return await asyncio.gather(*resolutions, return_exceptions=True)
+
+
+def test_concurrent_resolutions_handle_each_chat_once(calls):
+    pending(5, -100, -200)
+    results = asyncio.run(gather(bot.approve_pending(None, 5), bot.decline_pending(None, 5)))
+
+    assert results == [[-100, -200], []]
+    assert calls == [('approve_join', -100), ('approve_join', -200)]
+    assert 5 not in bot.PENDING_VERIFICATIONS and len(bot.PENDING_EXPIRY) == 0
+
+
+def test_concurrent_resolutions_split_the_chats(calls):
+    pending(5, -100, -200, -300)
+    results = asyncio.run(gather(
+        bot._resolve_pending(None, 5, True, {}, [-100]),
+        bot._resolve_pending(None, 5, False, None, [-200, -100, -300])))
+
+    assert results == [[-100], [-200, -300]]
+    assert sorted(chat for _, chat in calls) == [-300, -200, -100]
+    assert 5 not in bot.PENDING_VERIFICATIONS
+
+
+def test_missing_record_resolves_nothing(calls):
+    assert asyncio.run(bot.approve_pending(None, 7)) == []
+    assert calls == []
+
+
+def test_permanent_error_puts_unhandled_chats_back(calls, failing):
+    pending(5, -100, -200, -300)
+    failing.add(-200)
+    with pytest.raises(BadRequest):
+        asyncio.run(bot.approve_pending(None, 5))
+    assert bot.PENDING_VERIFICATIONS[5]['chat_ids'] == [-200, -300]
+
+
+def test_failure_restores_a_record_dropped_meanwhile(calls, failing):
+    pending(5, -100, -200)
+    failing.add(-200)
+    results = asyncio.run(gather(
+        bot._resolve_pending(None, 5, True, {}, [-200]),
+        bot._resolve_pending(None, 5, True, {}, [-100])))
+
+    assert results[1] == [-100] and isinstance(results[0], BadRequest)
+    assert bot.PENDING_VERIFICATIONS[5]['chat_ids'] == [-200]
+    assert len(bot.PENDING_EXPIRY) == 1
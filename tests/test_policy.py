@@ -0,0 +1,105 @@
+import asyncio
+import itertools
+
+import pytest
+
+import bot
+
+
+class FakeBot:
+    """get_user_profile_photos answering from a fixed photo count (None raises)"""
+
+    def __init__(self, photos):
+        self.photos = photos
+        self.calls = 0
+
+    async def get_user_profile_photos(self, user_id, limit=None):
+        self.calls += 1
+        if self.photos is None:
+            raise RuntimeError('Forbidden')
+        return type('Photos', (), {'total_count': self.photos})()
+
+
+async def old_check_user_legitimacy(profile: dict, fake_bot) -> dict:
+    """check_user_legitimacy's fixed 40/30/30 scoring from before policies"""
+    score = 0
+    reasons = []
+    if profile['type'] == "bot":
+        return {"legitimate": False, "reason": "Bot account", "score": 0}
+    if not profile['first_name'] or bot.is_name_suspicious(profile['first_name']):
+        reasons.append("Suspicious name")
+    else:
+        score += 40
+    if profile['username']:
+        score += 30
+    else:
+        reasons.append("No username")
+    if bot.REQUIRE_PROFILE_PHOTO:
+        try:
+            photos = await fake_bot.get_user_profile_photos(profile['user_id'], limit=1)
+            if photos.total_count > 0:
+                score += 30
+            else:
+                reasons.append("No profile photo")
+        except Exception:
+            reasons.append("Cannot check photo")
+    else:
+        score += 30
+
+    if score >= 70:
+        return {"legitimate": True, "score": 100}
+    elif score >= 30:
+        return {"legitimate": False, "score": 50, "reason": ", ".join(reasons)}
+    else:
+        return {"legitimate": False, "score": 0, "reason": ", ".join(reasons)}
+
+
+@pytest.fixture(autouse=True)
+def empty_profile_cache(monkeypatch):
+    monkeypatch.setattr(bot, 'PROFILE_CACHE', bot.TTLCache(100, 60))
+
+
+PROFILES = [
+    {'user_id': 1000 + n, 'type': kind, 'first_name': name, 'username': username,
+     'is_premium': False, 'language_code': 'en', 'has_photo': None}
+    for n, (kind, name, username) in enumerate(itertools.product(
+        ('private', 'bot'), ('Alice', '', '12345678', 'x'), ('alice', None)))
+]
+
+
+@pytest.mark.parametrize('require_photo', [False, True])
+@pytest.mark.parametrize('photos', [0, 2, None])
+@pytest.mark.parametrize('profile', PROFILES, ids=lambda p: f"{p['type']}-{p['first_name']!r}-{p['username']}")
+def test_default_policy_matches_old_scorer(monkeypatch, profile, photos, require_photo):
+    monkeypatch.setattr(bot, 'REQUIRE_PROFILE_PHOTO', require_photo)
+    expected = asyncio.run(old_check_user_legitimacy(profile, FakeBot(photos)))
+    verdict, complete = asyncio.run(
+        bot.CompiledPolicy(bot.default_policy()).evaluate(dict(profile), FakeBot(photos)))
+
+    assert (verdict['legitimate'], verdict['score']) == (expected['legitimate'], expected['score'])
+    if 'reason' in verdict:
+        # Evaluation may stop before the remaining rules; what it reports is what the old scorer did
+        old_reasons = expected['reason'].split(', ')
+        assert set(filter(None, verdict['reason'].split(', '))) <= set(old_reasons)
+    assert complete or (require_photo and photos is None)
+
+
+def test_photo_is_only_fetched_when_it_can_change_the_outcome(monkeypatch):
+    monkeypatch.setattr(bot, 'REQUIRE_PROFILE_PHOTO', True)
+    policy = bot.CompiledPolicy(bot.default_policy())
+
+    fake_bot = FakeBot(1)
+    verdict, _ = asyncio.run(policy.evaluate(dict(PROFILES[0]), fake_bot))  # Name + username: 70
+    assert verdict['legitimate'] and fake_bot.calls == 0
+
+    borderline = dict(PROFILES[0], username=None)
+    verdict, _ = asyncio.run(policy.evaluate(borderline, fake_bot))
+    assert verdict['legitimate'] and fake_bot.calls == 1
+
+
+def test_offline_evaluation_counts_the_photo_as_unchecked(monkeypatch):
+    monkeypatch.setattr(bot, 'REQUIRE_PROFILE_PHOTO', True)
+    borderline = dict(PROFILES[0], username=None)
+    verdict, complete = asyncio.run(bot.CompiledPolicy(bot.default_policy()).evaluate(borderline))
+    assert verdict == {'legitimate': False, 'score': 50, 'reason': 'No username, Cannot check photo'}
+    assert not complete
@@ -0,0 +1,56 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import bot
+
+NOW = datetime.now()
+
+
+@pytest.fixture(autouse=True)
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, 'ARCHIVE_DIR', str(tmp_path / 'archive'))
+    monkeypatch.setattr(bot, 'ARCHIVE_SCAN_CHUNK', 2)
+    monkeypatch.setattr(bot, 'RECENT_ACTIVITY', bot.ActivityLog(bot.RECENT_ACTIVITY_CAPACITY, 'type'))
+
+
+def add_user(user_id, status, days_ago):
+    bot.USER_DATABASE[user_id] = {
+        'first_name': f'User {user_id}', 'last_name': '', 'username': '',
+        'channels': {-100: {'channel_name': 'Main', 'status': status,
+                            'request_date': NOW - timedelta(days=days_ago), 'approval_date': None}}
+    }
+
+
+def test_archives_users_past_retention():
+    add_user(1, 'pending', 40)   # stale_pending
+    add_user(2, 'approved', 40)  # kept
+    add_user(3, 'approved', 200)  # inactive
+    add_user(4, 'pending', 1)    # kept
+    asyncio.run(bot.retention_job())
+
+    assert sorted(bot.USER_DATABASE) == [2, 4]
+    archived = {user_id: user for user_id, user, _ in bot.iter_archived_users()}
+    assert sorted(archived) == [1, 3]
+    assert archived[3]['channels'][-100]['status'] == 'approved'
+
+
+def test_user_active_again_during_the_write_is_kept(monkeypatch):
+    add_user(1, 'pending', 40)
+    add_user(2, 'pending', 40)
+    append_archive = bot._append_archive
+
+    def join_while_writing(kind, partitions):
+        # What track_user_activity does on the loop while the worker writes
+        bot.USER_DATABASE[1]['channels'][-200] = {'channel_name': 'Other', 'status': 'pending',
+                                                  'request_date': NOW, 'approval_date': None}
+        append_archive(kind, partitions)
+
+    monkeypatch.setattr(bot, '_append_archive', join_while_writing)
+    asyncio.run(bot.retention_job())
+
+    assert sorted(bot.USER_DATABASE) == [1]
+    archived = {user_id: user for user_id, user, _ in bot.iter_archived_users()}
+    assert sorted(archived) == [1, 2]
+    assert list(archived[1]['channels']) == [-100]  # The copy taken on the loop
@@ -0,0 +1,51 @@
+import gc
+import os
+import pickle
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+import bot
+
+
+def test_round_trip_keeps_types():
+    data = {
+        'format': 1,
+        'data': {
+            'user_database': {42: {'first_name': 'Ann', 'channels': {-100: {
+                'request_date': datetime(2025, 1, 2, 3, 4, 5), 'approval_date': None}}}},
+            'blocked_users': {7, 8},
+            'intervals': (date(2024, 2, 29), timedelta(minutes=5),
+                          datetime(2025, 1, 1, tzinfo=timezone.utc)),
+            'raw': b'\x00\x01',
+            'nested': [1, 2.5, 'three', None, True]
+        }
+    }
+    payload = bot.encode_snapshot(data)
+    assert payload.startswith(bot.SNAPSHOT_MAGIC)
+    assert bot.decode_snapshot(payload) == data
+
+
+class Payload:
+    def __reduce__(self):
+        return (os.system, ('echo pwned',))
+
+
+def test_rejects_classes_outside_the_allow_list():
+    payload = bot.SNAPSHOT_MAGIC + bytes([bot.SNAPSHOT_VERSION]) + pickle.dumps({'x': Payload()})
+    with pytest.raises(pickle.UnpicklingError, match='system'):
+        bot.decode_snapshot(payload)
+
+
+def test_rejects_foreign_and_newer_files():
+    with pytest.raises(ValueError, match='Not a snapshot'):
+        bot.decode_snapshot(b'{"json": true}')
+    newer = bot.SNAPSHOT_MAGIC + bytes([bot.SNAPSHOT_VERSION + 1]) + pickle.dumps({})
+    with pytest.raises(ValueError, match='Unsupported snapshot version'):
+        bot.decode_snapshot(newer)
+
+
+def test_decode_restores_gc_state():
+    assert gc.isenabled()
+    bot.decode_snapshot(bot.encode_snapshot({'a': 1}))
+    assert gc.isenabled()
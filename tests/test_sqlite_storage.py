@@ -0,0 +1,103 @@
+from datetime import datetime
+
+import pytest
+
+import bot
+from conftest import reset_state
+
+
+@pytest.fixture
+def storage(tmp_path):
+    store = bot.SQLiteStorage(str(tmp_path / 'bot_data.sqlite3'))
+    yield store
+    store.close()
+
+
+def restart(storage):
+    reset_state()
+    storage.load()
+
+
+def set_user(user_id: int, **channels) -> dict:
+    bot.USER_DATABASE[user_id] = {
+        'first_name': f'User {user_id}', 'last_name': '', 'username': f'user{user_id}',
+        'channels': {int(chat_id): membership for chat_id, membership in channels.items()}
+    }
+    return {'key': 'user_database', 'op': 'set', 'item': user_id, 'value': bot.USER_DATABASE[user_id]}
+
+
+def membership(status: str, requested: datetime, approved: datetime = None) -> dict:
+    return {'channel_name': 'Main', 'status': status, 'request_date': requested, 'approval_date': approved}
+
+
+def test_users_and_membership_dates_round_trip(storage):
+    assert storage.is_empty()
+    storage.write([
+        set_user(1, **{'-100': membership('approved', datetime(2025, 1, 2, 3, 4, 5), datetime(2025, 1, 3))}),
+        set_user(2, **{'-100': membership('pending', datetime(2025, 2, 1)),
+                       '-200': membership('rejected', datetime(2025, 2, 2))})
+    ])
+    assert not storage.is_empty()
+    expected = {user_id: dict(user) for user_id, user in bot.USER_DATABASE.items()}
+
+    restart(storage)
+    assert dict(bot.USER_DATABASE) == expected
+    assert bot.USER_DATABASE[1]['channels'][-100]['approval_date'] == datetime(2025, 1, 3)
+    assert isinstance(bot.USER_DATABASE[2]['channels'][-200]['request_date'], datetime)
+
+
+def test_user_set_updates_memberships_in_place(storage):
+    storage.write([set_user(1, **{'-100': membership('pending', datetime(2025, 1, 1))})])
+    storage.write([set_user(1, **{'-100': membership('approved', datetime(2025, 1, 1), datetime(2025, 1, 5)),
+                                  '-200': membership('pending', datetime(2025, 1, 6))})])
+
+    assert len(storage._fetch('memberships')) == 2
+    restart(storage)
+    assert bot.USER_DATABASE[1]['channels'][-100]['status'] == 'approved'
+    assert bot.USER_DATABASE[1]['channels'][-100]['approval_date'] == datetime(2025, 1, 5)
+    assert list(bot.USER_DATABASE[1]['channels']) == [-100, -200]
+
+
+def test_user_delete_removes_memberships(storage):
+    storage.write([set_user(1, **{'-100': membership('pending', datetime(2025, 1, 1))}),
+                   set_user(2, **{'-100': membership('pending', datetime(2025, 1, 1))})])
+    storage.write([{'key': 'user_database', 'op': 'del', 'item': 1}])
+
+    assert [row['user_id'] for row in storage._fetch('memberships')] == [2]
+    restart(storage)
+    assert list(bot.USER_DATABASE) == [2]
+
+
+def test_channels_counters_and_kv_round_trip(storage):
+    bot.MANAGED_CHANNELS[-100] = {'name': 'Main'}
+    bot.POST_COUNTER[-100] = 7
+    bot.BLOCKED_USERS.update({5, 6})
+    bot.DEFAULT_CAPTION = 'Hello'
+    storage.write([
+        {'key': 'managed_channels', 'op': 'set', 'item': -100, 'value': {'name': 'Main'}},
+        {'key': 'post_counter', 'op': 'set', 'item': -100, 'value': 7},
+        {'key': 'blocked_users', 'op': 'add', 'value': 5},
+        {'key': 'blocked_users', 'op': 'add', 'value': 6},
+        {'key': 'blocked_users', 'op': 'discard', 'value': 5},
+        {'key': 'default_caption', 'op': 'set', 'value': 'Hello'}
+    ])
+
+    restart(storage)
+    assert bot.MANAGED_CHANNELS == {-100: {'name': 'Main'}}
+    assert bot.POST_COUNTER == {-100: 7}
+    assert bot.BLOCKED_USERS == {6}
+    assert bot.DEFAULT_CAPTION == 'Hello'
+
+
+def test_journal_changes_reach_the_database(storage, monkeypatch):
+    monkeypatch.setattr(bot, 'STORAGE', storage)
+    set_user(1, **{'-100': membership('pending', datetime(2025, 1, 1))})
+    bot.persist_change('user_database', 'set', 1, bot.USER_DATABASE[1])
+    del bot.USER_DATABASE[1]
+    bot.persist_change('user_database', 'del', 1)
+    set_user(2, **{'-100': membership('pending', datetime(2025, 1, 1))})
+    bot.persist_change('user_database', 'set', 2, bot.USER_DATABASE[2])
+    assert bot.PENDING_CHANGES == {}
+
+    restart(storage)
+    assert list(bot.USER_DATABASE) == [2]
@@ -0,0 +1,92 @@
+from datetime import datetime
+
+import pytest
+
+import bot
+from conftest import reset_state
+from fake_postgrest import FakePostgREST
+
+pytest.importorskip('httpx')
+
+
+@pytest.fixture
+def server():
+    with FakePostgREST() as fake:
+        yield fake
+
+
+@pytest.fixture
+def storage(server, monkeypatch):
+    monkeypatch.setattr(bot, 'SUPABASE_RETRIES', 1)  # Fail a batch on the first error, no backoff sleeps
+    store = bot.SupabaseStorage(server.url, 'test-key', batch_size=2)
+    yield store
+    store.close()
+
+
+def user_records(first: int, count: int) -> list:
+    records = []
+    for user_id in range(first, first + count):
+        bot.USER_DATABASE[user_id] = {
+            'first_name': f'User {user_id}', 'last_name': '', 'username': '',
+            'channels': {-100: {'channel_name': 'Main', 'status': 'approved',
+                                'request_date': datetime(2025, 1, 1), 'approval_date': None}}
+        }
+        records.append({'key': 'user_database', 'op': 'set', 'item': user_id,
+                        'value': bot.USER_DATABASE[user_id]})
+    return records
+
+
+def test_upserts_are_batched_per_table(storage, server):
+    storage.write(user_records(1, 5))
+
+    posts = [entry for entry in server.log if entry[0] == 'POST']
+    assert [(table, rows) for _, table, rows in posts if table == 'users'] == [
+        ('users', 2), ('users', 2), ('users', 1)]
+    assert len(server.rows('users')) == 5
+    assert len(server.rows('memberships')) == 5
+
+
+def test_failed_batch_is_retried_from_backlog(storage, server):
+    server.fail_next(1)
+    with pytest.raises(Exception):
+        storage.write(user_records(1, 3))
+    assert storage.backlog
+    assert server.rows('users') == []
+
+    # The next write re-sends the backlog ahead of its own records
+    bot.MANAGED_CHANNELS[-100] = {'name': 'Main'}
+    storage.write(user_records(4, 1) + [
+        {'key': 'managed_channels', 'op': 'set', 'item': -100, 'value': {'name': 'Main'}}])
+    assert storage.backlog == []
+    assert sorted(row['user_id'] for row in server.rows('users')) == [1, 2, 3, 4]
+
+    reset_state()
+    storage.load()
+    assert sorted(bot.USER_DATABASE) == [1, 2, 3, 4]
+    assert bot.USER_DATABASE[2]['channels'][-100]['request_date'] == datetime(2025, 1, 1)
+    assert bot.MANAGED_CHANNELS == {-100: {'name': 'Main'}}
+
+
+def test_backlog_keeps_order_of_deletes(storage, server):
+    storage.write(user_records(1, 2))
+    server.fail_next(1)
+    with pytest.raises(Exception):
+        storage.write([{'key': 'user_database', 'op': 'del', 'item': 1}])
+
+    storage.write([])
+    assert [row['user_id'] for row in server.rows('users')] == [2]
+    assert [row['user_id'] for row in server.rows('memberships')] == [2]
+
+
+def test_journal_flush_survives_a_failed_request(storage, server, monkeypatch):
+    monkeypatch.setattr(bot, 'STORAGE', storage)
+    server.fail_next(1)
+    bot.BLOCKED_USERS.add(9)
+    bot.persist_change('blocked_users', 'add', value=9)
+    assert bot.PENDING_CHANGES  # Requeued by the journal, and kept in the backlog
+
+    bot.POST_COUNTER[-100] = 4
+    bot.persist_change('post_counter', 'set', -100, 4)
+    assert bot.PENDING_CHANGES == {}
+    assert server.rows('blocked_users') == [{'user_id': 9}]
+    assert server.rows('counters') == [{'name': 'post_counter', 'channel_id': -100, 'value': 4}]
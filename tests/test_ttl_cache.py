@@ -0,0 +1,70 @@
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(bot.time, 'time', lambda: now[0])
+    return now
+
+
+def test_hit_and_miss_counters(clock):
+    cache = bot.TTLCache(10, 60)
+    assert cache.get('a') is None
+    cache.put('a', 1)
+    assert cache.get('a') == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.summary() == "1 hits / 1 misses (50%), 1 cached"
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = bot.TTLCache(10, 60)
+    cache.put('a', 1)
+    clock[0] += 59
+    assert cache.get('a') == 1
+    clock[0] += 2
+    assert cache.get('a', 'gone') == 'gone'
+    assert len(cache) == 0  # Expired entries are dropped on lookup
+
+
+def test_least_recently_used_is_evicted(clock):
+    cache = bot.TTLCache(2, 60)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')  # 'b' is now the least recently used
+    cache.put('c', 3)
+    assert list(cache.entries) == ['a', 'c']
+
+
+def test_put_refreshes_expiry(clock):
+    cache = bot.TTLCache(10, 60)
+    cache.put('a', 1)
+    clock[0] += 50
+    cache.put('a', 2)
+    clock[0] += 50
+    assert cache.get('a') == 2
+
+
+def test_dump_and_restore_skip_expired_entries(clock):
+    cache = bot.TTLCache(10, 60)
+    cache.put('old', 1)
+    clock[0] += 30
+    cache.put(('user', None), {'legitimate': True})
+    dumped = cache.dump()
+
+    restored = bot.TTLCache(10, 60)
+    clock[0] += 40  # 'old' expired while the bot was down
+    restored.restore(dumped)
+    assert list(restored.entries) == [('user', None)]
+    assert restored.get(('user', None)) == {'legitimate': True}
+
+
+def test_restore_respects_maxsize(clock):
+    cache = bot.TTLCache(5, 60)
+    for key in range(5):
+        cache.put(key, key)
+    small = bot.TTLCache(2, 60)
+    small.restore(cache.dump())
+    assert list(small.entries) == [3, 4]
@@ -0,0 +1,79 @@
+import pytest
+
+import bot
+
+
+def user(name: str) -> dict:
+    return {'first_name': name, 'last_name': '', 'username': '', 'channels': {}}
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    return str(tmp_path / 'users.idx')
+
+
+def test_write_index_round_trip(index_path):
+    store = bot.UserStore(records={3: user('C'), 1: user('A'), 2: user('B')})
+    store.write_index(index_path, {'version': 1})
+
+    index = bot.UserIndexFile(index_path)
+    assert list(index) == [1, 2, 3]
+    assert index.meta == {'version': 1}
+    assert index.get(2) == user('B')
+    assert index.get(4) is None
+
+    reopened = bot.UserStore(index)
+    assert sorted(reopened) == [1, 2, 3] and len(reopened) == 3
+    assert reopened[3] == user('C')
+
+
+def test_changes_after_a_write_are_kept_by_the_next(index_path):
+    store = bot.UserStore(records={1: user('A'), 2: user('B')})
+    store.write_index(index_path, {})
+
+    store[1]['first_name'] = 'Changed'  # Decoded on lookup, mutated in place
+    del store[2]
+    store[5] = user('E')
+    assert sorted(store) == [1, 5] and len(store) == 2
+    with pytest.raises(KeyError):
+        store[2]
+
+    store.write_index(index_path, {})
+    reopened = bot.UserStore(bot.UserIndexFile(index_path))
+    assert sorted(reopened) == [1, 5]
+    assert reopened[1]['first_name'] == 'Changed'
+
+
+def changed_during_write(monkeypatch, change):
+    """Run change() after the new index is written, before the store switches to it"""
+    open_index = bot.UserIndexFile
+
+    def open_and_change(path):
+        change()
+        return open_index(path)
+
+    monkeypatch.setattr(bot, 'UserIndexFile', open_and_change)
+
+
+def test_user_deleted_during_write_stays_deleted(index_path, monkeypatch):
+    store = bot.UserStore(records={1: user('A'), 2: user('B')})
+    changed_during_write(monkeypatch, lambda: store.__delitem__(2))
+    store.write_index(index_path, {})
+
+    assert 2 not in store and len(store) == 1 and list(store) == [1]
+    monkeypatch.undo()
+    store.write_index(index_path, {})
+    assert list(bot.UserIndexFile(index_path)) == [1]
+
+
+def test_user_added_back_during_write_is_kept(index_path, monkeypatch):
+    store = bot.UserStore(records={1: user('A'), 2: user('B')})
+    store.write_index(index_path, {})
+    del store[2]
+    changed_during_write(monkeypatch, lambda: store.__setitem__(2, user('Again')))
+    store.write_index(index_path, {})
+
+    assert store[2] == user('Again') and len(store) == 2 and sorted(store) == [1, 2]
+    monkeypatch.undo()
+    store.write_index(index_path, {})
+    assert bot.UserIndexFile(index_path).get(2) == user('Again')